@@ -18,6 +18,9 @@ import attack
 
 from tensorboardX import SummaryWriter
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from checkpoint import CheckpointManager
+
 from model import ReconstructionNet
 from dataset import Dataset
 from utils import Logger
@@ -114,6 +117,12 @@ class Reconstruction(object):
         self.parameter = self.model.parameters()
         self.optimizer = optim.Adam(self.parameter, lr=0.0001*16/args.batch_size, betas=(0.9, 0.999), weight_decay=1e-6)
 
+        # snapshots stay <dataset>_<epoch>.pkl, the optimizer and RNG state go next to them
+        self.checkpoints = CheckpointManager(self.save_dir, mode='min',
+                                             model_name=self.dataset_name + '_%d.pkl',
+                                             state_name=self.dataset_name + '_%d_state.pkl',
+                                             strip_module=True)
+
 
     def run(self):
         self.train_hist = {
@@ -125,19 +134,19 @@ class Reconstruction(object):
         print('Training start!!')
         start_time = time.time()
         self.model.train()
+        start_epoch = 0
         if self.model_path != '':
-            start_epoch = self.model_path[-7:-4]
-            if start_epoch[0] == '_':
-                start_epoch = start_epoch[1:]
-            start_epoch = int(start_epoch)
-        else:
-            start_epoch = 0
+            # the weights are already loaded by _load_pretrain
+            start_epoch, _ = self.checkpoints.resume(self.model_path, optimizer=self.optimizer)
+            if start_epoch is None:
+                # snapshot from before the state files, the epoch is only in its name
+                start_epoch = int(self.model_path[:-4].split('_')[-1])
         for epoch in range(start_epoch, self.epochs):
             loss = self.train_epoch(epoch)
             
             # save snapeshot
             if (epoch + 1) % self.snapshot_interval == 0:
-                self._snapshot(epoch + 1)
+                self._snapshot(epoch + 1, loss)
                 if loss < best_loss:
                     best_loss = loss
                     self._snapshot('best')
@@ -148,7 +157,8 @@ class Reconstruction(object):
                 self.writer.add_scalar('Learning Rate', self._get_lr(), epoch)
         
         # finish all epoch
-        self._snapshot(epoch + 1)
+        self._snapshot(epoch + 1, loss)
+        self.checkpoints.close()
         if loss < best_loss:
             best_loss = loss
             self._snapshot('best')
@@ -196,7 +206,12 @@ class Reconstruction(object):
         return np.mean(loss_buf)
 
 
-    def _snapshot(self, epoch):
+    def _snapshot(self, epoch, loss=None):
+        if epoch != 'best':
+            # epoch counts finished epochs, which is also where training resumes
+            self.checkpoints.save(epoch, self.model, self.optimizer, metric=loss, resume_epoch=epoch)
+            print(f"Save model to {os.path.join(self.save_dir, self.dataset_name)}_{str(epoch)}.pkl")
+            return
         state_dict = self.model.state_dict()
         from collections import OrderedDict
         new_state_dict = OrderedDict()
@@ -0,0 +1,142 @@
+'''
+Description: content-addressed on-disk store of generated adversarial examples
+Autor: Jiachen Sun
+Date: 2021-08-07 11:03:52
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-07 16:21:10
+'''
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+
+def model_fingerprint(model):
+    """
+    sha1 over the state dict (names, dtypes, shapes and raw bytes), with any
+    DataParallel 'module.' prefix stripped so wrapped and bare models agree.
+    """
+    h = hashlib.sha1()
+    for name, val in sorted(model.state_dict().items()):
+        if name.startswith('module.'):
+            name = name[7:]
+        val = val.detach().cpu().contiguous()
+        h.update(name.encode())
+        h.update(str(val.dtype).encode())
+        h.update(str(tuple(val.shape)).encode())
+        h.update(val.numpy().tobytes())
+    return h.hexdigest()
+
+
+class AdvCache():
+    """
+    Each entry is one .npy shard named after the sha1 of
+    (model fingerprint, attack config, dataset slice). Shards are written
+    atomically, memory-mapped on read, and the least recently used ones are
+    deleted once the store grows past max_gb.
+    """
+    def __init__(self, root, max_gb=20.):
+        self.root = root
+        self.max_bytes = int(max_gb * (1 << 30))
+        self.fingerprints = {}
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def fingerprint(self, model):
+        # hashing the weights is not free, do it once per model object
+        if id(model) not in self.fingerprints:
+            self.fingerprints[id(model)] = model_fingerprint(model)
+        return self.fingerprints[id(model)]
+
+    def key(self, model, attack_cfg, data_cfg):
+        # model may be a list, e.g. the members an ensemble attack runs against
+        if isinstance(model, (list, tuple)):
+            fp = [self.fingerprint(m) for m in model]
+        else:
+            fp = self.fingerprint(model)
+        desc = json.dumps({'model': fp, 'attack': attack_cfg, 'data': data_cfg},
+                          sort_keys=True, default=str)
+        return hashlib.sha1(desc.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.npy')
+
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            arr = np.load(path, mmap_mode='r')
+        except (ValueError, OSError):
+            # partially written or corrupt shard
+            return None
+        os.utime(path, None)
+        return arr
+
+    def put(self, key, adv_data):
+        if torch.is_tensor(adv_data):
+            adv_data = adv_data.detach().cpu().numpy()
+        path = self.path(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(adv_data))
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        shards = []
+        for name in os.listdir(self.root):
+            if name.endswith('.npy'):
+                path = os.path.join(self.root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                shards.append((st.st_mtime, st.st_size, path))
+        total = sum(s[1] for s in shards)
+        for _, size, path in sorted(shards):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def fetch(self, model, attack_cfg, data_cfg, attack_fn, device):
+        """
+        Return the cached adversarial batch for this key, or run attack_fn() and store it.
+        """
+        key = self.key(model, attack_cfg, data_cfg)
+        arr = self.get(key)
+        if arr is not None:
+            return torch.from_numpy(np.array(arr)).to(device)
+        adv_data = attack_fn()
+        self.put(key, adv_data)
+        return adv_data
+
+
+def attack_config(args, model_name=None, **extra):
+    """
+    The attack-defining subset of an eval script's args.
+    """
+    cfg = {'attack': args.attack, 'eps': args.eps, 'alpha': args.alpha,
+           'iters': args.test_iter, 'seed': args.seed, 'samples': getattr(args, 'samples', None),
+           'amp': getattr(args, 'amp', None)}
+    if model_name is not None:
+        cfg['model'] = model_name
+    cfg.update(extra)
+    return cfg
+
+
+def data_config(args, batch_idx, partition='test', size=None):
+    cfg = {'dataset': args.dataset, 'partition': partition, 'num_points': args.num_points,
+           'batch_size': args.test_batch_size, 'batch': batch_idx}
+    if getattr(args, 'shards', 1) > 1:
+        # batch_idx counts from the start of the shard, whose bounds depend on --total
+        cfg['shard'] = [args.shard, args.shards, args.total]
+    if size is not None and size != args.test_batch_size:
+        # a short last batch, e.g. cut at --total
+        cfg['size'] = size
+    return cfg
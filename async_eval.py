@@ -0,0 +1,138 @@
+'''
+Description: run per-epoch evaluation in a background process so it stays off the training critical path
+Autor: Jiachen Sun
+Date: 2021-08-11 10:05:40
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-11 17:32:18
+'''
+import copy
+import queue
+import time
+import traceback
+import torch
+import torch.nn as nn
+from util import IOStream
+
+
+class EpochIO():
+    """
+    IOStream look-alike that tags every line with the epoch it evaluates.
+    """
+    def __init__(self, io, epoch):
+        self.io = io
+        self.epoch = epoch
+
+    def cprint(self, text):
+        self.io.cprint('[eval epoch %d] %s' % (self.epoch, text))
+
+
+def _eval_worker(model, parallel, eval_fn, log_path, best_path, jobs, results):
+    io = IOStream(log_path)
+    wrapped = None
+    best = None
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            epoch, state, args = job
+            if wrapped is None:
+                device = torch.device("cuda" if args.cuda else "cpu")
+                # same wrapping as the training model so the state dict keys match
+                wrapped = nn.DataParallel(model.to(device)) if parallel else model.to(device)
+            wrapped.load_state_dict(state)
+            del state
+            start = time.time()
+            metric = eval_fn(args, EpochIO(io, epoch), wrapped, epoch)
+            if metric is not None and best_path is not None and (best is None or metric > best):
+                best = metric
+                torch.save(wrapped.state_dict(), best_path)
+            results.put((epoch, metric, time.time() - start))
+    except BaseException:
+        # the traceback goes to the eval log, the non-zero exit code tells the trainer
+        io.cprint(traceback.format_exc())
+        raise
+    finally:
+        io.close()
+
+
+class AsyncEvaluator():
+    """
+    Owns one spawned worker holding its own copy of the model. submit() copies
+    the current weights to (shared) CPU memory and returns; the worker loads them
+    and runs eval_fn(args, io, model, epoch), logging to log_path with lines tagged
+    by epoch. If eval_fn returns a metric, the best weights so far are saved to
+    best_path. At most max_pending snapshots wait in the queue, after that submit
+    blocks until the worker catches up; if the worker has died (its traceback is
+    in log_path) submit and close raise instead.
+    """
+    def __init__(self, model, eval_fn, log_path, best_path=None, max_pending=2):
+        ctx = torch.multiprocessing.get_context('spawn')
+        self.jobs = ctx.Queue(max_pending)
+        self.results = ctx.Queue()
+        self.finished = []
+        self.submitted = 0
+        self.log_path = log_path
+        parallel = isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel))
+        base = copy.deepcopy(model.module if parallel else model).cpu()
+        # daemonic, so eval_fn must not start DataLoader worker processes
+        self.proc = ctx.Process(target=_eval_worker,
+                                args=(base, parallel, eval_fn, log_path, best_path, self.jobs, self.results),
+                                daemon=True)
+        self.proc.start()
+
+    def _check(self):
+        if not self.proc.is_alive():
+            raise Exception("Background evaluation exited with code %s, see %s" % (self.proc.exitcode, self.log_path))
+
+    def _put(self, job):
+        # a dead worker never frees a slot in the full queue, so never block on it for good
+        while True:
+            self._check()
+            try:
+                self.jobs.put(job, timeout=1.)
+                return
+            except queue.Full:
+                pass
+
+    def submit(self, epoch, model, args):
+        state = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+        self._put((epoch, state, copy.copy(args)))
+        self.submitted += 1
+        return self.poll()
+
+    def poll(self):
+        """
+        Results (epoch, metric, seconds) that arrived since the last call.
+        """
+        new = []
+        while True:
+            try:
+                new.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        self.finished.extend(new)
+        return new
+
+    def close(self):
+        """
+        Wait for every submitted snapshot and return all results, in epoch order.
+        """
+        if self.proc.is_alive():
+            self._put(None)
+        # drain before joining, a child blocked on a full pipe never exits
+        while len(self.finished) < self.submitted and (self.proc.is_alive() or not self.results.empty()):
+            try:
+                self.finished.append(self.results.get(timeout=1.))
+            except queue.Empty:
+                pass
+        self.proc.join()
+        if self.proc.exitcode != 0:
+            raise Exception("Background evaluation exited with code %d, see %s" % (self.proc.exitcode, self.log_path))
+        return sorted(self.finished)
+
+    def best_epoch(self):
+        scored = [r for r in self.finished if r[1] is not None]
+        if len(scored) == 0:
+            return None
+        return max(scored, key=lambda r: r[1])[0]
@@ -20,10 +20,13 @@ torch.backends.cudnn.deterministic=True
 torch.backends.cudnn.benchmark = False
 import torch.nn.functional as F
 from util import cross_entropy_with_probs, cal_loss, margin_logit_loss, cal_loss_no_reduce, margin_logit_loss_reduce
+from util import amp_autocast, amp_loss_scale, amp_input_grad
  
-def pgd_attack(model,data,labels,eps=0.01,alpha=0.0002,iters=50,repeat=1,mixup=False,self=False):
+def pgd_attack(model,data,labels,eps=0.01,alpha=0.0002,iters=50,repeat=1,mixup=False,self=False,amp=None,targeted=False):
+    # targeted: labels are target classes and the attack pushes towards them
+    sign = -1. if targeted else 1.
     model.eval()
-    max_loss = -1
+    max_loss = -float('inf')
     best_examples=None
     for i in range(repeat):
         adv_data=data.clone()
@@ -32,18 +35,20 @@ def pgd_attack(model,data,labels,eps=0.01,alpha=0.0002,iters=50,repeat=1,mixup=F
         adv_data.detach()
         for i in range(iters):
             adv_data.requires_grad=True
-            try:
-                outputs,_,trans = model(adv_data,self)
-            except:
-                outputs,_,trans = model(adv_data)
+            with amp_autocast(amp, data.device):
+                try:
+                    outputs,_,trans = model(adv_data,self)
+                except:
+                    outputs,_,trans = model(adv_data)
+            outputs = outputs.float()
             if mixup:
                 loss = cross_entropy_with_probs(outputs,labels)
             else:
-                loss = cal_loss(outputs,None,labels)
+                loss = sign * cal_loss(outputs,None,labels)
             # print(torch.autograd.grad(loss,adv_data,create_graph=True))   
-            loss.backward()
+            (loss * amp_loss_scale(amp)).backward()
             with torch.no_grad():
-                adv_data = adv_data + alpha*adv_data.grad.sign()
+                adv_data = adv_data + alpha*amp_input_grad(adv_data.grad).sign()
                 delta = adv_data-data
                 delta = torch.clamp(delta,-eps,eps)
                 adv_data = data+delta
@@ -53,19 +58,238 @@ def pgd_attack(model,data,labels,eps=0.01,alpha=0.0002,iters=50,repeat=1,mixup=F
                 max_loss=loss
                 best_examples=adv_data
         
-        try:
-            outputs,_,trans = model(best_examples,self)
-        except:
-            outputs,_,trans = model(best_examples)
+        with amp_autocast(amp, data.device):
+            try:
+                outputs,_,trans = model(best_examples,self)
+            except:
+                outputs,_,trans = model(best_examples)
+        outputs = outputs.float()
         if mixup:
             loss = cross_entropy_with_probs(outputs,labels)
         else:
-            loss = cal_loss(outputs,None,labels)
+            loss = sign * cal_loss(outputs,None,labels)
         if loss > max_loss:
             max_loss=loss
             best_examples=adv_data.cpu()
             
-    return best_examples.cuda()
+    return best_examples.to(data.device)
+
+
+def targeted_pairs(labels, n_classes):
+    """
+    (sample, target) index pairs for every class except each sample's own label
+    """
+    target = torch.arange(n_classes, device=labels.device).repeat(labels.shape[0])
+    sample = torch.arange(labels.shape[0], device=labels.device).repeat_interleave(n_classes)
+    keep = target != labels[sample]
+    return sample[keep], target[keep]
+
+def target_margin(logits, target):
+    """
+    logit of the target minus the largest other logit, > 0 once the target wins
+    """
+    target_logits = logits.gather(1, target[:, None]).squeeze(1)
+    other_logits = logits.scatter(1, target[:, None], -float('inf'))
+    return target_logits - other_logits.max(dim=1)[0]
+
+def all_targets_attack(attack_fn, model, data, labels, n_classes, max_batch=256):
+    """
+    Runs attack_fn(x, targets) on every (sample, target != label) pair, with inputs
+    expanded along the batch dimension and processed max_batch pairs at a time.
+    Returns (success, margin), both (B, n_classes); entries where the target is the
+    true label are False / nan.
+    """
+    sample, target = targeted_pairs(labels, n_classes)
+    success = torch.zeros(data.shape[0], n_classes, dtype=torch.bool, device=data.device)
+    margin = torch.full((data.shape[0], n_classes), float('nan'), device=data.device)
+    for start in range(0, sample.shape[0], max_batch):
+        s, t = sample[start:start + max_batch], target[start:start + max_batch]
+        adv_data = attack_fn(data[s], t)
+        with torch.no_grad():
+            logits,_,_ = model(adv_data)
+            m = target_margin(logits.float(), t)
+        margin[s, t] = m
+        success[s, t] = m > 0
+    return success, margin
+
+def pgd_attack_all_targets(model,data,labels,n_classes,eps=0.01,alpha=0.0002,iters=50,max_batch=256,amp=None):
+    attack_fn = lambda x, t: pgd_attack(model,x,t,eps=eps,alpha=alpha,iters=iters,amp=amp,targeted=True)
+    return all_targets_attack(attack_fn, model, data, labels, n_classes, max_batch)
+
+def pgd_from(model,data,start,labels,eps=0.01,alpha=0.0002,iters=50,amp=None):
+    """
+    PGD from the given starting points (projected onto the eps ball). A sample
+    counts as broken once any iterate is misclassified, and then keeps that iterate.
+    Returns (adv_data, still_correct).
+    """
+    adv_data = data + torch.clamp(start - data, -eps, eps)
+    correct = torch.ones_like(labels, dtype=torch.bool)
+    for i in range(iters + 1):
+        adv_data = adv_data.detach().requires_grad_(i < iters)
+        with torch.set_grad_enabled(i < iters):
+            with amp_autocast(amp, data.device):
+                outputs,_,_ = model(adv_data)
+            outputs = outputs.float()
+        correct = correct & (outputs.max(dim=1)[1] == labels)
+        if i == iters:
+            break
+        loss = cal_loss(outputs,None,labels)
+        grad, = torch.autograd.grad(loss * amp_loss_scale(amp), adv_data)
+        with torch.no_grad():
+            next_data = adv_data + alpha * amp_input_grad(grad).sign()
+            next_data = data + torch.clamp(next_data - data, -eps, eps)
+            # broken samples stay at the point that broke them
+            adv_data = torch.where(correct[:, None, None], next_data, adv_data)
+    return adv_data.detach(), correct
+
+def pgd_sweep(model,data,labels,eps_list,iters_list,alpha_ratio=0.1,amp=None):
+    """
+    Robust accuracy over an (iters, eps) grid in one pass. Cell (t, e) counts a
+    sample as broken if any cell with no more iterations and no larger eps broke
+    it, so each eps starts from the previous eps's adversarial points and only the
+    samples that survived so far are attacked. eps_list and iters_list must be
+    ascending; alpha is eps * alpha_ratio.
+    Returns (clean_correct (B,), correct (len(iters_list), len(eps_list), B), steps)
+    where steps counts per-sample gradient steps taken.
+    """
+    model.eval()
+    with torch.no_grad():
+        with amp_autocast(amp, data.device):
+            logits,_,_ = model(data)
+    clean_correct = logits.float().max(dim=1)[1] == labels
+    correct = torch.zeros(len(iters_list), len(eps_list), data.shape[0], dtype=torch.bool, device=data.device)
+    steps = 0
+    for ti, iters in enumerate(iters_list):
+        adv_data = data + (torch.rand_like(data) * eps_list[0] * 2 - eps_list[0])
+        alive = clean_correct.clone()
+        for ei, eps in enumerate(eps_list):
+            if ti > 0:
+                alive = alive & correct[ti - 1, ei]
+            idx = alive.nonzero().squeeze(1)
+            if idx.numel() > 0:
+                adv, still = pgd_from(model,data[idx],adv_data[idx],labels[idx],eps=eps,alpha=eps*alpha_ratio,iters=iters,amp=amp)
+                adv_data[idx] = adv
+                alive[idx] = still
+                steps += idx.numel() * iters
+            correct[ti, ei] = alive
+    return clean_correct, correct, steps
+
+
+class FreeAdversary():
+    """
+    Perturbation state for free adversarial training (minibatch replay). Each
+    batch is trained on `replays` times; the backward pass of a replay gives the
+    weight gradient and the input gradient at once, and the input gradient moves
+    the perturbation (step alpha, eps by default) for the next replay. The
+    perturbation carries over to the next batch and is reset only when the batch
+    shape changes.
+
+        for _ in range(free.replays):
+            opt.zero_grad()
+            loss = criterion(model(free.perturb(data)), ...)
+            loss.backward()
+            free.step()
+            opt.step()
+    """
+    def __init__(self, eps, alpha=None, replays=4):
+        self.eps = eps
+        self.alpha = eps if alpha is None else alpha
+        self.replays = replays
+        self.delta = None
+        self.adv_data = None
+
+    def perturb(self, data):
+        if self.delta is None or self.delta.shape != data.shape:
+            self.delta = torch.zeros_like(data)
+        self.adv_data = (data.detach() + self.delta).requires_grad_(True)
+        return self.adv_data
+
+    def step(self):
+        # call after backward(): the input gradient is a by-product of the weight gradient
+        with torch.no_grad():
+            self.delta = torch.clamp(self.delta + self.alpha * amp_input_grad(self.adv_data.grad).sign(), -self.eps, self.eps)
+        self.adv_data = None
+
+
+class PerturbationBank():
+    """
+    Per-sample perturbations for ATTA (accumulated adversarial training), kept
+    across epochs. Entries are stored as (3, num_points) in the dataset's
+    canonical point order: load() re-applies this epoch's point permutation
+    (perm[b, j] is the stored point shown at position j) and save() inverts it.
+    With fold_jitter the stored offset is relative to the un-jittered cloud, so
+    a new jitter draw does not move the adversarial point (the view is clipped
+    back to the eps ball); otherwise it is relative to the jittered input.
+    Lives on device, or in a .npy memmap at path for sets too large for it.
+    """
+    def __init__(self, n_samples, num_points, eps, device='cpu', path=None, fold_jitter=False):
+        self.eps = eps
+        self.device = device
+        self.fold_jitter = fold_jitter
+        if path is not None:
+            self.store = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_samples, 3, num_points))
+        else:
+            self.store = torch.zeros(n_samples, 3, num_points, device=device)
+        self.reset()
+
+    def reset(self):
+        # same as the random start of pgd_attack
+        if torch.is_tensor(self.store):
+            self.store.uniform_(-self.eps, self.eps)
+        else:
+            for i in range(0, self.store.shape[0], 1024):
+                chunk = self.store[i:i+1024]
+                chunk[:] = np.random.uniform(-self.eps, self.eps, chunk.shape)
+            self.store.flush()
+
+    def load(self, items, perm, jitter=None):
+        if torch.is_tensor(self.store):
+            delta = self.store[items.to(self.store.device)].to(self.device)
+        else:
+            delta = torch.from_numpy(self.store[items.cpu().numpy()]).to(self.device)
+        delta = torch.gather(delta, 2, perm.unsqueeze(1).expand_as(delta))
+        if self.fold_jitter and jitter is not None:
+            delta = torch.clamp(delta - jitter.permute(0, 2, 1), -self.eps, self.eps)
+        return delta
+
+    def save(self, items, perm, delta, jitter=None):
+        delta = delta.detach()
+        if self.fold_jitter and jitter is not None:
+            delta = delta + jitter.permute(0, 2, 1)
+        canonical = torch.empty_like(delta).scatter_(2, perm.unsqueeze(1).expand_as(delta), delta)
+        if torch.is_tensor(self.store):
+            self.store[items.to(self.store.device)] = canonical.to(self.store.device)
+        else:
+            self.store[items.cpu().numpy()] = canonical.cpu().numpy()
+
+    def state_dict(self):
+        store = self.store if torch.is_tensor(self.store) else torch.from_numpy(np.array(self.store))
+        return {'store': store}
+
+    def load_state_dict(self, state):
+        if torch.is_tensor(self.store):
+            self.store.copy_(state['store'])
+        else:
+            self.store[:] = state['store'].numpy()
+            self.store.flush()
+
+
+def pgd_continue(model,data,start,labels,eps=0.01,alpha=0.0002,iters=1,amp=None):
+    """
+    iters PGD steps from start (no random init, no early stop), for ATTA.
+    """
+    model.eval()
+    adv_data = data + torch.clamp(start - data, -eps, eps)
+    for i in range(iters):
+        adv_data = adv_data.detach().requires_grad_(True)
+        with amp_autocast(amp, data.device):
+            outputs,_,_ = model(adv_data)
+        loss = cal_loss(outputs.float(),None,labels)
+        grad, = torch.autograd.grad(loss * amp_loss_scale(amp), adv_data)
+        with torch.no_grad():
+            adv_data = adv_data + alpha * amp_input_grad(grad).sign()
+            adv_data = data + torch.clamp(adv_data - data, -eps, eps)
+    return adv_data.detach()
 
 
 def pgd_attack_ensemble(model1,model2,model3,data,labels,eps=0.01,alpha=0.0002,iters=50,repeat=1,mixup=False):
@@ -630,7 +854,7 @@ def evolution(model,data,labels_og,eps=0.01,iters=2000,variance=0.05,samples=32,
 class APGDAttack():
     def __init__(self, model, n_iter=100, norm='Linf', n_restarts=1, eps=None,
                  seed=0, loss='ce', eot_iter=1, rho=.75, verbose=False,
-                 device='cuda'):
+                 device='cuda', amp=None, targeted=False):
         self.model = model
         self.n_iter = n_iter
         self.eps = eps
@@ -642,13 +866,30 @@ class APGDAttack():
         self.thr_decr = rho
         self.verbose = verbose
         self.device = device
+        self.amp = amp
+        self.targeted = targeted
+    
+    def is_robust(self, logits, y):
+        # untargeted: still the true class, targeted: y is the target and not reached yet
+        if self.targeted:
+            return logits.detach().max(1)[1] != y
+        return logits.detach().max(1)[1] == y
+    
+    def get_logits(self, x):
+        with amp_autocast(self.amp, x.device):
+            logits,_,_ = self.model(x)
+        return logits.float()
+    
+    def get_grad(self, loss, x):
+        grad = torch.autograd.grad(loss * amp_loss_scale(self.amp), [x])[0].detach()
+        return amp_input_grad(grad) / amp_loss_scale(self.amp)
     
     def check_oscillation(self, x, j, k, y5, k3=0.75):
-        t = np.zeros(x.shape[1])
+        t = torch.zeros(x.shape[1], device=x.device)
         for counter5 in range(k):
-          t += x[j - counter5] > x[j - counter5 - 1]
+          t += (x[j - counter5] > x[j - counter5 - 1]).float()
           
-        return t <= k*k3*np.ones(t.shape)
+        return t <= k*k3
         
     def check_shape(self, x):
         return x if len(x.shape) > 0 else np.expand_dims(x, 0)
@@ -657,9 +898,24 @@ class APGDAttack():
         x_sorted, ind_sorted = x.sort(dim=1)
         ind = (ind_sorted[:, -1] == y).float()
         
-        return -(x[np.arange(x.shape[0]), y] - x_sorted[:, -2] * ind - x_sorted[:, -1] * (1. - ind)) / (x_sorted[:, -1] - x_sorted[:, -3] + 1e-12)
+        return -(x[torch.arange(x.shape[0], device=x.device), y] - x_sorted[:, -2] * ind - x_sorted[:, -1] * (1. - ind)) / (x_sorted[:, -1] - x_sorted[:, -3] + 1e-12)
     
-    def attack_single_run(self, x_in, y_in):
+    def init_noise(self, x, n_restarts):
+        # one draw per restart, in restart order, so restart r sees the same
+        # noise as the r-th call of a sequential loop over the same samples
+        if self.norm == 'Linf':
+            t = torch.cat([2 * torch.rand(x.shape) - 1 for _ in range(n_restarts)]).to(x.device)
+            return self.eps * t / (t.reshape([t.shape[0], -1]).abs().max(dim=1, keepdim=True)[0].reshape([-1, 1, 1]))
+        elif self.norm == 'L2':
+            t = torch.cat([torch.randn(x.shape) for _ in range(n_restarts)]).to(x.device)
+            return self.eps * t / ((t ** 2).sum(dim=(1, 2), keepdim=True).sqrt() + 1e-12)
+    
+    def attack_single_run(self, x_in, y_in, n_restarts=1):
+        """
+        Runs n_restarts independent APGD runs as one batch of size n_restarts * B
+        (restart-major). All bookkeeping stays on the input's device, nothing in
+        here synchronises with the host unless verbose is set.
+        """
         x = x_in.clone() if len(x_in.shape) == 3 else x_in.clone().unsqueeze(0)
         y = y_in.clone() if len(y_in.shape) == 1 else y_in.clone().unsqueeze(0)
         
@@ -667,17 +923,15 @@ class APGDAttack():
         if self.verbose:
             print('parameters: ', self.n_iter, self.n_iter_2, self.n_iter_min, self.size_decr)
         
-        if self.norm == 'Linf':
-            t = 2 * torch.rand(x.shape).to(self.device).detach() - 1
-            x_adv = x.detach() + self.eps * torch.ones([x.shape[0], 1, 1]).to(self.device).detach() * t / (t.reshape([t.shape[0], -1]).abs().max(dim=1, keepdim=True)[0].reshape([-1, 1, 1]))
-        elif self.norm == 'L2':
-            t = torch.randn(x.shape).to(self.device).detach()
-            x_adv = x.detach() + self.eps * torch.ones([x.shape[0], 1, 1]).to(self.device).detach() * t / ((t ** 2).sum(dim=(1, 2), keepdim=True).sqrt() + 1e-12)
+        noise = self.init_noise(x, n_restarts)
+        x = x.repeat([n_restarts, 1, 1])
+        y = y.repeat([n_restarts])
+        x_adv = x.detach() + noise.detach()
         # x_adv = x_adv.clamp(0., 1.)
         x_best = x_adv.clone()
         x_best_adv = x_adv.clone()
-        loss_steps = torch.zeros([self.n_iter, x.shape[0]])
-        loss_best_steps = torch.zeros([self.n_iter + 1, x.shape[0]])
+        loss_steps = torch.zeros([self.n_iter, x.shape[0]], device=x.device)
+        loss_best_steps = torch.zeros([self.n_iter + 1, x.shape[0]], device=x.device)
         acc_steps = torch.zeros_like(loss_best_steps)
         
         if self.loss == 'ce':
@@ -688,34 +942,35 @@ class APGDAttack():
             criterion_indiv = margin_logit_loss
         else:
             raise ValueError('unknowkn loss')
+        if self.targeted:
+            # every loss above grows when y becomes less likely, flip it to pull towards y
+            untargeted_criterion = criterion_indiv
+            criterion_indiv = lambda logits, y: -untargeted_criterion(logits, y)
         
         x_adv.requires_grad_()
         grad = torch.zeros_like(x)
         for _ in range(self.eot_iter):
             with torch.enable_grad():
-                logits,_,_ = self.model(x_adv) # 1 forward pass (eot_iter = 1)
+                logits = self.get_logits(x_adv) # 1 forward pass (eot_iter = 1)
                 loss_indiv = criterion_indiv(logits, y)
                 loss = loss_indiv.sum()
                     
-            grad += torch.autograd.grad(loss, [x_adv])[0].detach() # 1 backward pass (eot_iter = 1)
+            grad += self.get_grad(loss, x_adv) # 1 backward pass (eot_iter = 1)
             
         grad /= float(self.eot_iter)
         grad_best = grad.clone()
         
-        acc = logits.detach().max(1)[1] == y
+        acc = self.is_robust(logits, y)
         acc_steps[0] = acc + 0
         loss_best = loss_indiv.detach().clone()
         
-        step_size = self.eps * torch.ones([x.shape[0], 1, 1]).to(self.device).detach() * torch.Tensor([2.0]).to(self.device).detach().reshape([1, 1, 1])
+        step_size = 2.0 * self.eps * torch.ones([x.shape[0], 1, 1], device=x.device)
         x_adv_old = x_adv.clone()
-        counter = 0
         k = self.n_iter_2 + 0
-        u = np.arange(x.shape[0])
         counter3 = 0
         
         loss_best_last_check = loss_best.clone()
-        reduced_last_check = np.zeros(loss_best.shape) == np.zeros(loss_best.shape)
-        n_reduced = 0
+        reduced_last_check = torch.ones_like(acc)
         
         for i in range(self.n_iter):
             ### gradient step
@@ -741,63 +996,66 @@ class APGDAttack():
             grad = torch.zeros_like(x)
             for _ in range(self.eot_iter):
                 with torch.enable_grad():
-                    logits,_,_ = self.model(x_adv) # 1 forward pass (eot_iter = 1)
+                    logits = self.get_logits(x_adv) # 1 forward pass (eot_iter = 1)
                     loss_indiv = criterion_indiv(logits, y)
                     loss = loss_indiv.sum()
                 
-                grad += torch.autograd.grad(loss, [x_adv])[0].detach() # 1 backward pass (eot_iter = 1)
+                grad += self.get_grad(loss, x_adv) # 1 backward pass (eot_iter = 1)
                 
             
             grad /= float(self.eot_iter)
             
-            pred = logits.detach().max(1)[1] == y
-            acc = torch.min(acc, pred)
-            acc_steps[i + 1] = acc + 0
-            x_best_adv[(pred == 0).nonzero().squeeze()] = x_adv[(pred == 0).nonzero().squeeze()] + 0.
-            if self.verbose:
-                print('iteration: {} - Best loss: {:.6f}'.format(i, loss_best.sum()))
-            
-            ### check step size
             with torch.no_grad():
+              x_adv = x_adv.detach()
+              pred = self.is_robust(logits, y)
+              acc = torch.min(acc, pred)
+              acc_steps[i + 1] = acc + 0
+              x_best_adv = torch.where(~pred[:, None, None], x_adv, x_best_adv)
+              if self.verbose:
+                  print('iteration: {} - Best loss: {:.6f}'.format(i, loss_best.sum()))
+            
+              ### check step size
               y1 = loss_indiv.detach().clone()
-              loss_steps[i] = y1.cpu() + 0
-              ind = (y1 > loss_best).nonzero().squeeze()
-              x_best[ind] = x_adv[ind].clone()
-              grad_best[ind] = grad[ind].clone()
-              loss_best[ind] = y1[ind] + 0
-              loss_best_steps[i + 1] = loss_best + 0
+              loss_steps[i] = y1
+              ind = y1 > loss_best
+              x_best = torch.where(ind[:, None, None], x_adv, x_best)
+              grad_best = torch.where(ind[:, None, None], grad, grad_best)
+              loss_best = torch.where(ind, y1, loss_best)
+              loss_best_steps[i + 1] = loss_best
               
               counter3 += 1
           
               if counter3 == k:
-                  fl_oscillation = self.check_oscillation(loss_steps.detach().cpu().numpy(), i, k, loss_best.detach().cpu().numpy(), k3=self.thr_decr)
-                  fl_reduce_no_impr = (~reduced_last_check) * (loss_best_last_check.cpu().numpy() >= loss_best.cpu().numpy())
-                  fl_oscillation = ~(~fl_oscillation * ~fl_reduce_no_impr)
-                  reduced_last_check = np.copy(fl_oscillation)
+                  fl_oscillation = self.check_oscillation(loss_steps, i, k, loss_best, k3=self.thr_decr)
+                  fl_reduce_no_impr = ~reduced_last_check & (loss_best_last_check >= loss_best)
+                  fl_oscillation = fl_oscillation | fl_reduce_no_impr
+                  reduced_last_check = fl_oscillation.clone()
                   loss_best_last_check = loss_best.clone()
                   
-                  if np.sum(fl_oscillation) > 0:
-                      step_size[u[fl_oscillation]] /= 2.0
-                      n_reduced = fl_oscillation.astype(float).sum()
-                      
-                      fl_oscillation = np.where(fl_oscillation)
-                      
-                      x_adv[fl_oscillation] = x_best[fl_oscillation].clone()
-                      grad[fl_oscillation] = grad_best[fl_oscillation].clone()
+                  # halve the step and restart from the best point where the loss stalled
+                  step_size = torch.where(fl_oscillation[:, None, None], step_size / 2.0, step_size)
+                  x_adv = torch.where(fl_oscillation[:, None, None], x_best, x_adv)
+                  grad = torch.where(fl_oscillation[:, None, None], grad_best, grad)
                       
                   counter3 = 0
-                  k = np.maximum(k - self.size_decr, self.n_iter_min)
+                  k = max(k - self.size_decr, self.n_iter_min)
               
         return x_best, acc, loss_best, x_best_adv
     
     def perturb(self, x_in, y_in, best_loss=False, cheap=True):
+        """
+        Restarts run one after another on the samples still unbroken, as in
+        the reference algorithm; the only host syncs are those index lookups
+        (plus prints if verbose). With best_loss every restart attacks every
+        sample, so those run as one batched attack_single_run.
+        """
         assert self.norm in ['Linf', 'L2']
         x = x_in.clone() if len(x_in.shape) == 3 else x_in.clone().unsqueeze(0)
         y = y_in.clone() if len(y_in.shape) == 1 else y_in.clone().unsqueeze(0)
         
         adv = x.clone()
-        acc = self.model(x)[0].max(1)[1] == y
-        loss = -1e10 * torch.ones_like(acc).float()
+        with torch.no_grad():
+            acc = self.is_robust(self.get_logits(x), y)
         if self.verbose:
             print('-------------------------- running {}-attack with epsilon {:.4f} --------------------------'.format(self.norm, self.eps))
             print('initial accuracy: {:.2%}'.format(acc.float().mean()))
@@ -812,33 +1070,49 @@ class APGDAttack():
             
             else:
                 for counter in range(self.n_restarts):
-                    ind_to_fool = acc.nonzero().squeeze()
-                    if len(ind_to_fool.shape) == 0: ind_to_fool = ind_to_fool.unsqueeze(0)
-                    if ind_to_fool.numel() != 0:
-                        x_to_fool, y_to_fool = x[ind_to_fool].clone(), y[ind_to_fool].clone()
-                        best_curr, acc_curr, loss_curr, adv_curr = self.attack_single_run(x_to_fool, y_to_fool)
-                        ind_curr = (acc_curr == 0).nonzero().squeeze()
-                        acc[ind_to_fool[ind_curr]] = 0
-                        adv[ind_to_fool[ind_curr]] = adv_curr[ind_curr].clone()
-                        if self.verbose:
-                            print('restart {} - robust accuracy: {:.2%} - cum. time: {:.1f} s'.format(
-                                counter, acc.float().mean(), time.time() - startt))
+                    # every restart only attacks the samples no earlier restart has broken
+                    ind_to_fool = acc.nonzero().view(-1)
+                    if ind_to_fool.numel() == 0:
+                        break
+                    x_to_fool, y_to_fool = x[ind_to_fool].clone(), y[ind_to_fool].clone()
+                    _, acc_curr, _, adv_curr = self.attack_single_run(x_to_fool, y_to_fool)
+                    fooled = acc_curr == 0
+                    acc[ind_to_fool] = ~fooled
+                    adv[ind_to_fool] = torch.where(fooled[:, None, None], adv_curr, adv[ind_to_fool])
+                    if self.verbose:
+                        print('restart {} - robust accuracy: {:.2%} - cum. time: {:.1f} s'.format(
+                            counter, acc.float().mean(), time.time() - startt))
             
             return acc, adv
         
         else:
             adv_best = x.detach().clone()
-            loss_best = torch.ones([x.shape[0]]).to(self.device) * (-float('inf'))
+            loss_best = torch.ones([x.shape[0]], device=x.device) * (-float('inf'))
+            best_curr, _, loss_curr, _ = self.attack_single_run(x, y, self.n_restarts)
+            best_curr = best_curr.view(self.n_restarts, *x.shape)
+            loss_curr = loss_curr.view(self.n_restarts, -1)
             for counter in range(self.n_restarts):
-                best_curr, _, loss_curr, _ = self.attack_single_run(x, y)
-                ind_curr = (loss_curr > loss_best).nonzero().squeeze()
-                adv_best[ind_curr] = best_curr[ind_curr] + 0.
-                loss_best[ind_curr] = loss_curr[ind_curr] + 0.
+                ind_curr = loss_curr[counter] > loss_best
+                adv_best = torch.where(ind_curr[:, None, None], best_curr[counter], adv_best)
+                loss_best = torch.where(ind_curr, loss_curr[counter], loss_best)
             
                 if self.verbose:
                     print('restart {} - loss: {:.5f}'.format(counter, loss_best.sum()))
             
             return loss_best, adv_best
+    
+    def perturb_all_targets(self, x, y, n_classes, max_batch=256):
+        """
+        Targeted APGD towards every class at once, see all_targets_attack.
+        max_batch caps the expanded batch (restarts run one after another).
+        """
+        targeted = self.targeted
+        self.targeted = True
+        try:
+            attack_fn = lambda x_t, t: self.perturb(x_t, t)[1]
+            return all_targets_attack(attack_fn, self.model, x, y, n_classes, max_batch)
+        finally:
+            self.targeted = targeted
 
 
 def uniform_attack(model,data,eps):
@@ -863,13 +1137,26 @@ def gaussian_attack(model,data,eps):
 
     return adv_data.cuda()
 
-def saliency(model,data,labels,number,iters):
+# points dropped -> number of saliency iterations, as used in eval_adv.py
+SALIENCY_SCHEDULE = {50: 10, 100: 20, 200: 40}
+
+def gather_points(data, indices):
+    """
+    data: (B, C, N), indices: (B, M) -> (B, C, M), on data's device
+    """
+    return torch.gather(data, 2, indices.unsqueeze(1).expand(-1, data.shape[1], -1))
+
+def saliency(model,data,labels,number,iters=None):
     model.eval()
+    if iters is None:
+        iters = SALIENCY_SCHEDULE[number]
 
-    adv_data=data.clone()
+    adv_data=data.clone().detach()
     alpha = number // iters
 
     for i in range(iters):
+        # the last iteration also drops the remainder so exactly `number` points go
+        n_drop = alpha if i < iters - 1 else number - alpha * (iters - 1)
         adv_data.requires_grad=True
         outputs,_,trans = model(adv_data)
         loss = cal_loss(outputs,None,labels)
@@ -880,24 +1167,18 @@ def saliency(model,data,labels,number,iters):
             sphere_axis = adv_data - sphere_core
 
             sphere_map = - torch.mul(torch.sum(torch.mul(adv_data.grad, sphere_axis), dim=1), torch.pow(sphere_r, 2))
-            _,indice = torch.topk(sphere_map, k=adv_data.shape[2] - alpha, dim=-1, largest=False)
-            tmp = torch.zeros((adv_data.shape[0], 3, adv_data.shape[2] - alpha))
-            for i in range(adv_data.shape[0]):
-                tmp[i] = adv_data[i][:,indice[i]]
-            adv_data = tmp.clone()
+            _,indice = torch.topk(sphere_map, k=adv_data.shape[2] - n_drop, dim=-1, largest=False)
+            adv_data = gather_points(adv_data.detach(), indice)
             
-    return adv_data.cuda()
+    return adv_data
 
 def random_drop(model,data,number):
     model.eval()
-    adv_data=data.clone()
-    indices = torch.Tensor(np.random.choice(adv_data.shape[2], (adv_data.shape[0],adv_data.shape[2]-number))).long()
-    tmp = torch.zeros((adv_data.shape[0], 3, adv_data.shape[2] - number))
-    for i in range(adv_data.shape[0]):
-        tmp[i] = adv_data[i][:,indices[i]]
-    adv_data = tmp.clone()
+    # a random permutation per sample, keep the first N - number points
+    indices = torch.rand(data.shape[0], data.shape[2], device=data.device).argsort(dim=1)[:, :data.shape[2] - number]
+    adv_data = gather_points(data.clone(), indices)
 
-    return adv_data.cuda()
+    return adv_data
 
 
 def pgd_adding_attack(model,data,labels,number,eps=0.01,alpha=0.0002,iters=50,repeat=1,mixup=False):
@@ -984,20 +1265,31 @@ DECREASE_FACTOR = 0.9
 CONSTANT_FACTOR = 2
 
 
-def cw_li_attack(model, images, labels, targeted=False, c=1e-4, kappa=0, max_iter=1000, learning_rate=0.01) :
-
-    images = torch.unsqueeze(images,0)
-    # print(images.shape)
-    labels = torch.unsqueeze(labels,0)
+def cw_li_attack(model, images, labels, targeted=False, c=1e-4, kappa=0, max_iter=1000, learning_rate=0.01,
+                 tau=0.1, tau_min=0.05, eps=0.05, verbose=False):
+    """
+    Batched CW-L_inf. images is (B, 3, N) (a single (3, N) cloud is also accepted),
+    every sample keeps its own w, tau and convergence flag and one Adam optimizer
+    runs over the whole batch. A sample's tau is shrunk by DECREASE_FACTOR once its
+    perturbation fits inside tau; it is frozen when tau drops below tau_min.
+    Samples whose final perturbation exceeds eps are returned unchanged.
+    """
+    single = images.dim() == 2
+    if single:
+        images = torch.unsqueeze(images,0)
+        labels = torch.unsqueeze(labels,0)
+    model.eval()
+    batch_size = images.shape[0]
+    images = images.detach()
 
     # Define f-function
     def f(x):
         
         outputs,_,_ = model(x)
-        one_hot_labels = torch.eye(len(outputs[0]))[labels].cuda()
+        one_hot_labels = F.one_hot(labels, outputs.shape[1]).bool()
 
-        i, _ = torch.max((1-one_hot_labels)*outputs, dim=1)
-        j = torch.masked_select(outputs, one_hot_labels.bool())
+        i, _ = torch.max(outputs.masked_fill(one_hot_labels, -float('inf')), dim=1)
+        j = outputs[one_hot_labels]
         
         # If targeted, optimize for making the other class most likely 
         if targeted :
@@ -1007,41 +1299,46 @@ def cw_li_attack(model, images, labels, targeted=False, c=1e-4, kappa=0, max_ite
         else :
             return torch.clamp(j-i, min=-kappa)
     
-    w = torch.zeros_like(images, requires_grad=True)
-
+    # start from the clean cloud, tanh keeps points inside the unit cube
+    w = torch.atanh(torch.clamp(images, -1 + 1e-6, 1 - 1e-6)).requires_grad_()
     optimizer = optim.Adam([w], lr=learning_rate)
 
-    prev = 1e10
-    tau = 0.1
-    step = 0
-    while tau > 0.05 and step < max_iter:
+    tau = torch.full((batch_size,), tau, device=images.device)
+    frozen = torch.zeros(batch_size, dtype=torch.bool, device=images.device)
+    check_every = max(max_iter // 10, 1)
+    for it in range(max_iter):
 
-        a = nn.Tanh()(w)
+        a = torch.tanh(w)
+        dist = torch.abs(a - images).view(batch_size, -1)
 
-        loss1 = torch.clamp(torch.max(torch.abs(a - images) - tau), min = 0)
-        loss2 = torch.sum(c*f(a))
+        loss1 = torch.clamp(torch.max(dist - tau[:, None], dim=1)[0], min=0)
+        loss2 = c * f(a)
 
-        cost = loss1 + loss2
+        cost = torch.sum((loss1 + loss2) * (~frozen).float())
 
         optimizer.zero_grad()
         cost.backward()
+        w_prev = w.detach().clone()
         optimizer.step()
 
-        # # Early Stop when loss does not converge.
-        # if step % (max_iter//10) == 0 :
-        #     if cost > prev :
-        #         print('Attack Stopped due to CONVERGENCE....')
-        #         return a
-        #     prev = cost
-        
-        print('- Learning Progress : %2.2f %%        ' %((step+1)/max_iter*100), end='\r')
-        step += 1
-
-        tau *= DECREASE_FACTOR
-
-    attack_images = nn.Tanh()(w)
+        with torch.no_grad():
+            # Adam momentum would keep moving frozen samples, pin them
+            w.data = torch.where(frozen[:, None, None], w_prev, w.data)
+            fits = (dist.max(dim=1)[0] <= tau) & ~frozen
+            tau = torch.where(fits, tau * DECREASE_FACTOR, tau)
+            frozen = frozen | (tau <= tau_min)
+
+        if (it + 1) % check_every == 0:
+            if verbose:
+                print('- Learning Progress : %2.2f %%, converged: %d/%d' % ((it+1)/max_iter*100, frozen.sum().item(), batch_size))
+            if frozen.all():
+                break
 
-    if torch.max(torch.abs(attack_images - images)) > 0.05:
-        return torch.squeeze(images)
+    with torch.no_grad():
+        attack_images = torch.tanh(w)
+        too_far = torch.abs(attack_images - images).view(batch_size, -1).max(dim=1)[0] > eps
+        attack_images = torch.where(too_far[:, None, None], images, attack_images)
 
-    return torch.squeeze(attack_images)
\ No newline at end of file
+    if single:
+        return torch.squeeze(attack_images, 0)
+    return attack_images
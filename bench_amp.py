@@ -0,0 +1,172 @@
+'''
+Description: speed / robust accuracy parity of mixed-precision attacks against fp32
+Autor: Jiachen Sun
+Date: 2021-08-06 10:12:31
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-06 14:40:02
+'''
+from __future__ import print_function
+import os
+import copy
+import argparse
+import json
+import time
+import torch
+import torch.nn as nn
+import numpy as np
+from torch.utils.data import DataLoader
+from data import PCData
+from model_finetune import PointNet, DGCNN, PointNet_Simple, Pct, DeepSym
+from util import IOStream, trades_loss
+import attack
+
+
+def build_model(args, device):
+    if args.dataset == 'modelnet40':
+        output_channel = 40
+    elif args.dataset == 'modelnet10':
+        output_channel = 10
+    elif args.dataset == 'scanobjectnn':
+        output_channel = 15
+    elif args.dataset == 'shapenet':
+        output_channel = 57
+    if args.model == 'pointnet':
+        model = PointNet(args,output_channels=output_channel).to(device)
+    elif args.model == 'dgcnn':
+        model = DGCNN(args,output_channels=output_channel).to(device)
+    elif args.model == 'pointnet_simple':
+        model = PointNet_Simple(args,output_channels=output_channel).to(device)
+    elif args.model == 'pct':
+        model = Pct(args,output_channels=output_channel).to(device)
+    elif args.model == 'deepsym':
+        model = DeepSym(args).to(device)
+    else:
+        raise Exception("Not implemented")
+    return nn.DataParallel(model)
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run_attack(args, model, test_loader, device, amp):
+    ''' Attack the first args.total test samples with a fixed seed, return (seconds, robust acc). '''
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    if device.type == 'cuda':
+        torch.cuda.manual_seed_all(args.seed)
+    if args.attack == 'apgd':
+        apgd = attack.APGDAttack(model,n_iter=args.test_iter,eps=args.eps,seed=args.seed,device=device,amp=amp)
+    elif args.attack == 'apgd_margin':
+        apgd = attack.APGDAttack(model,n_iter=args.test_iter,loss='ce_margin',eps=args.eps,seed=args.seed,device=device,amp=amp)
+
+    correct = 0
+    counter = 0
+    elapsed = 0.0
+    for data, label,_,_ in test_loader:
+        # score exactly args.total samples
+        data, label = data[:args.total - counter], label[:args.total - counter]
+        data, label = data.to(device).float(), label.to(device).long().squeeze(-1)
+        data = data.permute(0, 2, 1)
+        sync(device)
+        start = time.time()
+        if args.attack == 'pgd':
+            adv_data = attack.pgd_attack(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False,amp=amp)
+        elif args.attack == 'apgd' or args.attack == 'apgd_margin':
+            _,adv_data = apgd.perturb(data,label)
+        elif args.attack == 'trades':
+            # one TRADES inner maximisation + loss, as run per batch in adversarial training
+            opt = torch.optim.SGD(model.parameters(), lr=0.)
+            loss, adv_data = trades_loss(model,data,label,opt,step_size=args.alpha,epsilon=args.eps,
+                                         perturb_steps=args.test_iter,amp=amp,return_adv=True)
+            loss.backward()
+            model.eval()
+        sync(device)
+        elapsed += time.time() - start
+        with torch.no_grad():
+            logits,_,_ = model(adv_data)
+        correct += (logits.max(dim=1)[1] == label).sum().item()
+        counter += data.size(0)
+        if counter >= args.total:
+            break
+    return elapsed, correct / float(counter)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Mixed-precision attack benchmark')
+    parser.add_argument('--model', type=str, default='dgcnn', metavar='N',
+                        choices=['pointnet', 'dgcnn', 'pointnet_simple', 'pct', 'deepsym'],
+                        help='Model to use, [pointnet, dgcnn pointnet_simple]')
+    parser.add_argument('--model_path', type=str, nargs='+', default=[],
+                        help='Checkpoint files (.t7) to benchmark, random weights if empty')
+    parser.add_argument('--dataset', type=str, default='modelnet40', metavar='N')
+    parser.add_argument('--test_batch_size', type=int, default=32, metavar='batch_size',
+                        help='Size of batch)')
+    parser.add_argument('--no_cuda', type=bool, default=False,
+                        help='enables CUDA training')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0],
+                        help='random seeds, every precision runs on each of them')
+    parser.add_argument('--num_points', type=int, default=1024,
+                        help='num of points to use')
+    parser.add_argument('--dropout', type=float, default=0.5,
+                        help='dropout rate')
+    parser.add_argument('--emb_dims', type=int, default=1024, metavar='N',
+                        help='Dimension of embeddings')
+    parser.add_argument('--k', type=int, default=20, metavar='N',
+                        help='Num of nearest neighbors to use')
+    parser.add_argument('--eps',type=float,default=0.05,
+                        help="Maximum allowed L_inf Perturbation")
+    parser.add_argument('--alpha',type=float,default=0.005,
+                        help="Perturbation step size")
+    parser.add_argument('--test_iter',type=int,default=20,
+                        help="Number of attack steps")
+    parser.add_argument('--total',type=int,default=256,
+                        help="Number of samples to evaluate")
+    parser.add_argument('--attack', type=str, default='pgd',
+                        choices=['pgd', 'apgd', 'apgd_margin', 'trades'],
+                        help='Attack method')
+    parser.add_argument('--amp', type=str, default=None, choices=['bf16', 'fp16'],
+                        help='Precision to compare against fp32, defaults to bf16 on CPU and fp16 on GPU')
+    parser.add_argument('--out', type=str, default='bench_amp.json',
+                        help='Where to write the JSON report')
+    args = parser.parse_args()
+
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda" if args.cuda else "cpu")
+    if args.amp is None:
+        args.amp = 'fp16' if args.cuda else 'bf16'
+    io = IOStream(os.path.splitext(args.out)[0] + '.log')
+    io.cprint(str(args))
+
+    test_loader = DataLoader(PCData(name=args.dataset,partition='test', num_points=args.num_points), num_workers=8,
+                             batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+
+    results = []
+    for path in (args.model_path or ['']):
+        model = build_model(args, device)
+        if path != '':
+            model.load_state_dict(torch.load(path, map_location=device))
+        model = model.eval()
+        # trades runs train-mode forwards (BatchNorm statistics, dropout), every run starts from these weights
+        state = copy.deepcopy(model.state_dict())
+        for seed in args.seeds:
+            args.seed = seed
+            model.load_state_dict(state)
+            t_fp32, acc_fp32 = run_attack(args, model, test_loader, device, None)
+            model.load_state_dict(state)
+            t_amp, acc_amp = run_attack(args, model, test_loader, device, args.amp)
+            res = {'checkpoint': path, 'seed': seed, 'attack': args.attack,
+                   'fp32_time': t_fp32, 'fp32_acc': acc_fp32,
+                   args.amp + '_time': t_amp, args.amp + '_acc': acc_amp,
+                   'speedup': t_fp32 / max(t_amp, 1e-12), 'acc_delta': acc_amp - acc_fp32}
+            results.append(res)
+            io.cprint('%s seed %d :: fp32 %.2fs acc %.6f, %s %.2fs acc %.6f, speedup %.2fx, delta %.6f' % (
+                path or 'random', seed, t_fp32, acc_fp32, args.amp, t_amp, acc_amp, res['speedup'], res['acc_delta']))
+
+    io.cprint('mean speedup: %.2fx, mean acc delta: %.6f, max |acc delta|: %.6f' % (
+        np.mean([r['speedup'] for r in results]),
+        np.mean([r['acc_delta'] for r in results]),
+        np.max([abs(r['acc_delta']) for r in results])))
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,192 @@
+'''
+Description: eager vs compiled (compile_model) parity and speed for the model zoo, including the rotation / jigsaw heads
+Autor: Jiachen Sun
+Date: 2021-08-20 14:21:09
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-20 18:02:51
+'''
+from __future__ import print_function
+import os
+import sys
+import argparse
+import json
+import time
+import numpy as np
+import torch
+import model as model_zoo
+import model_finetune
+from compile_model import compile_model, uncompile_model, resolve_backend
+from util import IOStream
+
+# name -> (constructor, forward flag settings to specialise)
+MODELS = {
+    'pointnet': (lambda a: model_finetune.PointNet(a, output_channels=a.n_classes), [{}]),
+    'pointnet_simple': (lambda a: model_finetune.PointNet_Simple(a, output_channels=a.n_classes), [{}]),
+    'dgcnn': (lambda a: model_finetune.DGCNN(a, output_channels=a.n_classes), [{}]),
+    'pct': (lambda a: model_finetune.Pct(a, output_channels=a.n_classes), [{}]),
+    'dgcnn_rotation': (lambda a: model_finetune.DGCNN_Rotation(a), [{}]),
+    'dgcnn_jigsaw': (lambda a: model_finetune.DGCNN_Jigsaw(a), [{}]),
+    'pct_rotation': (lambda a: model_finetune.Pct_Rotation(a), [{}]),
+    'pct_jigsaw': (lambda a: model_finetune.Pct_Jigsaw(a), [{}]),
+    # the classification / rotation / jigsaw heads behind a Python flag
+    'deepsym': (lambda a: model_finetune.DeepSym(a, output_channels=a.n_classes), [{'rotation': False}, {'rotation': True}]),
+    'pointnet_flag': (lambda a: model_zoo.PointNet(a, output_channels=a.n_classes), [{'rotation': False}, {'rotation': True}]),
+    'pointnet_jigsaw_flag': (lambda a: model_zoo.PointNet_Jigsaw(a, output_channels=a.n_classes), [{'jigsaw': False}, {'jigsaw': True}]),
+}
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def input_grad(model, data, flags):
+    x = data.detach().requires_grad_(True)
+    logits = model(x, **flags)[0]
+    loss = logits.float().pow(2).mean()
+    grad, = torch.autograd.grad(loss, x)
+    return logits.detach(), grad
+
+
+def parity(args, model, data, flags):
+    """
+    Largest absolute difference of the logits (eval mode) and of the input
+    gradient an attack would take, compiled against eager. The first compiled
+    call also builds the graph.
+    """
+    model.eval()
+    uncompile_model(model)
+    with torch.no_grad():
+        eager = model(data, **flags)[0]
+    eager_logits, eager_grad = input_grad(model, data, flags)
+    compile_model(model, args.backend)
+    with torch.no_grad():
+        compiled = model(data, **flags)[0]
+    compiled_logits, compiled_grad = input_grad(model, data, flags)
+    # a second batch size must build its own graph (or reuse a dynamic one) and still match
+    half = data[:max(1, data.size(0) // 2)]
+    uncompile_model(model)
+    with torch.no_grad():
+        eager_half = model(half, **flags)[0]
+    compile_model(model, args.backend)
+    with torch.no_grad():
+        compiled_half = model(half, **flags)[0]
+    uncompile_model(model)
+    return {'logits_max_abs': float((eager - compiled).abs().max()),
+            'train_logits_max_abs': float((eager_logits - compiled_logits).abs().max()),
+            'input_grad_max_abs': float((eager_grad - compiled_grad).abs().max()),
+            'half_batch_max_abs': float((eager_half - compiled_half).abs().max())}
+
+
+def time_step(args, model, data, flags, mode):
+    device = data.device
+    if mode == 'forward':
+        model.eval()
+        def step():
+            with torch.no_grad():
+                model(data, **flags)
+    else:
+        # forward + backward w.r.t. the input, the inner loop of the attacks
+        model.eval()
+        def step():
+            input_grad(model, data, flags)
+    for _ in range(args.warmup):
+        step()
+    sync(device)
+    times = []
+    for _ in range(args.repeats):
+        start = time.time()
+        step()
+        sync(device)
+        times.append(time.time() - start)
+    return float(np.percentile(np.array(times) * 1000., 50))
+
+
+def run(args, io, name, flags):
+    device = torch.device("cuda" if args.cuda else "cpu")
+    torch.manual_seed(args.seed)
+    model = MODELS[name][0](args).to(device)
+    data = torch.rand(args.batch_size, 3, args.num_points, device=device) * 2 - 1
+    res = {'model': name, 'flags': flags}
+    res.update(parity(args, model, data, flags))
+    for mode in ['forward', 'input_grad']:
+        eager = time_step(args, model, data, flags, mode)
+        compile_model(model, args.backend)
+        compiled = time_step(args, model, data, flags, mode)
+        uncompile_model(model)
+        res[mode] = {'eager_ms': eager, 'compiled_ms': compiled, 'speedup': eager / max(compiled, 1e-9)}
+    res['ok'] = max(res['logits_max_abs'], res['train_logits_max_abs'], res['half_batch_max_abs']) <= args.atol \
+        and res['input_grad_max_abs'] <= args.atol
+    io.cprint('%-22s %-20s :: logits %.2e, grad %.2e, half batch %.2e %s | forward %8.2f -> %8.2f ms (%.2fx), input grad %8.2f -> %8.2f ms (%.2fx)' % (
+        name, json.dumps(flags), res['logits_max_abs'], res['input_grad_max_abs'], res['half_batch_max_abs'],
+        'OK' if res['ok'] else 'MISMATCH',
+        res['forward']['eager_ms'], res['forward']['compiled_ms'], res['forward']['speedup'],
+        res['input_grad']['eager_ms'], res['input_grad']['compiled_ms'], res['input_grad']['speedup']))
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compiled model parity and speed')
+    parser.add_argument('--models', type=str, nargs='+', default=list(MODELS.keys()), choices=list(MODELS.keys()),
+                        help='Models to check')
+    parser.add_argument('--backend', type=str, default='auto', choices=['auto', 'trace', 'inductor'],
+                        help='compile_model backend')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='Batch size')
+    parser.add_argument('--num_points', type=int, default=1024,
+                        help='Points per cloud')
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(),
+                        help='Intra-op threads')
+    parser.add_argument('--warmup', type=int, default=3,
+                        help='Untimed iterations')
+    parser.add_argument('--repeats', type=int, default=10,
+                        help='Timed iterations')
+    parser.add_argument('--atol', type=float, default=1e-4,
+                        help='Largest absolute logit / gradient difference accepted as identical')
+    parser.add_argument('--no_cuda', type=bool, default=True,
+                        help='Benchmark on CPU (default) even if a GPU is available')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='random seed')
+    parser.add_argument('--n_classes', type=int, default=40,
+                        help='Output classes')
+    parser.add_argument('--k', type=int, default=20,
+                        help='Nearest neighbours (dgcnn)')
+    parser.add_argument('--k1', type=int, default=2,
+                        help='Jigsaw cells per axis')
+    parser.add_argument('--angles', type=int, default=6,
+                        help='Rotation classes')
+    parser.add_argument('--emb_dims', type=int, default=1024, metavar='N',
+                        help='Dimension of embeddings')
+    parser.add_argument('--dropout', type=float, default=0.5,
+                        help='dropout rate')
+    parser.add_argument('--out', type=str, default='bench_compile.json',
+                        help='Where to write the JSON report')
+    args = parser.parse_args()
+    # model constructor options kept at their training defaults
+    args.rotation = True
+    args.fspool_global = False
+    args.fspool_local = False
+    args.mlppool_global = False
+    args.set_transformer_maxpool = False
+
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    args.backend = resolve_backend(args.backend)
+    torch.set_num_threads(args.threads)
+    io = IOStream(os.path.splitext(args.out)[0] + '.log')
+    io.cprint(str(args))
+
+    results = []
+    for name in args.models:
+        for flags in MODELS[name][1]:
+            try:
+                results.append(run(args, io, name, flags))
+            except Exception as e:
+                io.cprint('%-22s %-20s :: %s: %s' % (name, json.dumps(flags), type(e).__name__, e))
+                results.append({'model': name, 'flags': flags, 'ok': False, 'error': '%s: %s' % (type(e).__name__, e)})
+    with open(args.out, 'w') as f:
+        json.dump({'meta': {'torch': torch.__version__, 'backend': args.backend, 'device': 'cuda' if args.cuda else 'cpu',
+                            'batch_size': args.batch_size, 'num_points': args.num_points, 'threads': args.threads},
+                   'results': results}, f, indent=2)
+    failed = [r for r in results if not r['ok']]
+    io.cprint('%d of %d configurations match eager' % (len(results) - len(failed), len(results)))
+    sys.exit(1 if len(failed) > 0 else 0)
@@ -0,0 +1,440 @@
+'''
+Description: latency / throughput / memory of the classification models across batch size, points, k, threads and precision
+Autor: Jiachen Sun
+Date: 2021-08-12 09:48:03
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-12 18:20:44
+'''
+from __future__ import print_function
+import os
+import sys
+import argparse
+import copy
+import json
+import time
+import resource
+import itertools
+import numpy as np
+import torch
+from model_finetune import PointNet, PointNet_Simple, DeepSym, DGCNN, Pct, SetTransformer, set_activation_checkpointing, CHECKPOINT_BLOCKS
+from util import IOStream, cal_loss, amp_autocast, amp_loss_scale, amp_input_grad, MixedPrecision
+
+MODELS = ['pointnet', 'pointnet_simple', 'deepsym', 'dgcnn', 'pct', 'set_transformer']
+MODES = ['forward', 'forward_backward', 'pgd_step', 'train_step']
+
+
+def build_model(args, name, device):
+    if name == 'pointnet':
+        model = PointNet(args,output_channels=args.n_classes)
+    elif name == 'pointnet_simple':
+        model = PointNet_Simple(args,output_channels=args.n_classes)
+    elif name == 'deepsym':
+        model = DeepSym(args)
+    elif name == 'dgcnn':
+        model = DGCNN(args,output_channels=args.n_classes)
+    elif name == 'pct':
+        model = Pct(args,output_channels=args.n_classes)
+    elif name == 'set_transformer':
+        model = SetTransformer(args,dim_output=args.n_classes)
+    else:
+        raise Exception("Not implemented")
+    return model.to(device)
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def make_step(mode, model, data, label, precision, eps=0.05, alpha=0.005):
+    """
+    One unit of work for the given mode, as a closure so the timing loop stays the same.
+    """
+    if mode == 'forward':
+        model.eval()
+        def step():
+            with torch.no_grad():
+                with amp_autocast(precision, data.device):
+                    model(data)
+    elif mode == 'forward_backward':
+        model.train()
+        def step():
+            model.zero_grad()
+            with amp_autocast(precision, data.device):
+                logits,_,_ = model(data)
+            (cal_loss(logits.float(),None,label) * amp_loss_scale(precision)).backward()
+    elif mode == 'pgd_step':
+        # the inner iteration of attack.pgd_attack
+        model.eval()
+        adv_data = data + (torch.rand_like(data) * eps * 2 - eps)
+        def step():
+            x = adv_data.detach().requires_grad_(True)
+            with amp_autocast(precision, data.device):
+                logits,_,_ = model(x)
+            loss = cal_loss(logits.float(),None,label)
+            grad, = torch.autograd.grad(loss * amp_loss_scale(precision), x)
+            with torch.no_grad():
+                x = x + alpha * amp_input_grad(grad).sign()
+                x = data + torch.clamp(x - data, -eps, eps)
+    elif mode == 'train_step':
+        # a full optimizer step as the training scripts take it with --amp_train
+        model.train()
+        mp = MixedPrecision(precision, data.device, model)
+        opt = torch.optim.Adam(model.parameters(), lr=0.001)
+        def step():
+            opt.zero_grad()
+            logits,_,_ = mp.forward(model, data)
+            mp.backward(cal_loss(logits,None,label))
+            mp.step(opt)
+    else:
+        raise Exception("Not implemented")
+    return step
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated() / float(1 << 20)
+    # process high-water mark, only per configuration with --isolate
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run_config(args, cfg):
+    device = torch.device("cuda" if args.cuda else "cpu")
+    torch.set_num_threads(cfg['threads'])
+    torch.manual_seed(args.seed)
+    model_args = copy.copy(args)
+    model_args.k = cfg['k']
+    model_args.num_points = cfg['num_points']
+    model = build_model(model_args, cfg['model'], device)
+    set_activation_checkpointing(model, cfg['checkpoint'])
+    data = torch.rand(cfg['batch_size'], 3, cfg['num_points'], device=device) * 2 - 1
+    label = torch.randint(args.n_classes, (cfg['batch_size'],), device=device)
+    step = make_step(cfg['mode'], model, data, label, cfg['precision'])
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    warmup_start = time.time()
+    for _ in range(args.warmup):
+        step()
+    sync(device)
+    warmup = time.time() - warmup_start
+    times = []
+    for _ in range(args.repeats):
+        start = time.time()
+        step()
+        sync(device)
+        times.append(time.time() - start)
+    times = np.array(times) * 1000.
+    return dict(cfg, warmup_s=warmup, mean_ms=float(times.mean()), std_ms=float(times.std()),
+                p50_ms=float(np.percentile(times, 50)), p90_ms=float(np.percentile(times, 90)),
+                p99_ms=float(np.percentile(times, 99)), min_ms=float(times.min()),
+                samples_per_s=cfg['batch_size'] / (times.mean() / 1000.),
+                peak_mem_mb=peak_memory_mb(device))
+
+
+def synthetic_task(args, num_points, n, seed):
+    """
+    Noisy, point-shuffled copies of one random prototype cloud per class, a
+    learnable stand-in for a dataset when comparing precisions.
+    """
+    g = torch.Generator().manual_seed(args.seed)
+    prototypes = torch.rand(args.n_classes, 3, num_points, generator=g) * 2 - 1
+    g = torch.Generator().manual_seed(seed)
+    label = torch.randint(args.n_classes, (n,), generator=g)
+    data = prototypes[label] + 0.05 * torch.randn(n, 3, num_points, generator=g)
+    perm = torch.argsort(torch.rand(n, num_points, generator=g), dim=1)
+    return torch.gather(data, 2, perm[:, None].expand_as(data)), label
+
+
+def accuracy_run(args, name, precision):
+    """
+    Train for --accuracy_steps optimizer steps in the given precision and return the
+    held-out accuracy. The seed, data and batch order do not depend on the precision.
+    """
+    device = torch.device("cuda" if args.cuda else "cpu")
+    torch.manual_seed(args.seed)
+    model_args = copy.copy(args)
+    model_args.k = args.k[0]
+    model_args.num_points = args.num_points[0]
+    model = build_model(model_args, name, device)
+    mp = MixedPrecision(precision, device, model)
+    opt = torch.optim.Adam(model.parameters(), lr=0.001)
+    batch_size = args.batch_sizes[-1]
+    train_data, train_label = synthetic_task(args, args.num_points[0], batch_size * args.accuracy_steps, args.seed + 1)
+    test_data, test_label = synthetic_task(args, args.num_points[0], 512, args.seed + 2)
+    model.train()
+    start = time.time()
+    for i in range(args.accuracy_steps):
+        data = train_data[i*batch_size:(i+1)*batch_size].to(device)
+        label = train_label[i*batch_size:(i+1)*batch_size].to(device)
+        opt.zero_grad()
+        logits,_,_ = mp.forward(model, data)
+        loss = cal_loss(logits,None,label)
+        mp.backward(loss)
+        mp.step(opt)
+    sync(device)
+    elapsed = time.time() - start
+    model.eval()
+    correct = 0
+    with torch.no_grad():
+        for i in range(0, test_data.shape[0], batch_size):
+            logits,_,_ = mp.forward(model, test_data[i:i+batch_size].to(device))
+            correct += (logits.max(dim=1)[1].cpu() == test_label[i:i+batch_size]).sum().item()
+    return {'model': name, 'precision': precision, 'steps': args.accuracy_steps,
+            'train_samples_per_s': batch_size * args.accuracy_steps / elapsed,
+            'final_loss': loss.item(), 'accuracy': correct / float(test_data.shape[0])}
+
+
+def compare_accuracy(io, runs):
+    """
+    Log every precision's accuracy and throughput next to the fp32 run of the same model.
+    """
+    base = {r['model']: r for r in runs if r['precision'] == 'fp32' and 'error' not in r}
+    for r in runs:
+        if 'error' in r:
+            io.cprint('%-16s %-5s :: %s' % (r['model'], r['precision'], r['error']))
+            continue
+        ref = base.get(r['model'])
+        if ref is None:
+            io.cprint('%-16s %-5s :: acc %.4f, %9.1f samples/s' % (r['model'], r['precision'], r['accuracy'], r['train_samples_per_s']))
+            continue
+        r['accuracy_delta'] = r['accuracy'] - ref['accuracy']
+        r['speedup'] = r['train_samples_per_s'] / ref['train_samples_per_s']
+        io.cprint('%-16s %-5s :: acc %.4f (%+.4f vs fp32), %9.1f samples/s (%.2fx)' % (
+            r['model'], r['precision'], r['accuracy'], r['accuracy_delta'], r['train_samples_per_s'], r['speedup']))
+
+
+def _isolated(args, cfg, results):
+    try:
+        results.put(run_config(args, cfg))
+    except Exception as e:
+        results.put(dict(cfg, error='%s: %s' % (type(e).__name__, e)))
+
+
+def run_isolated(args, cfg):
+    # a fresh process per configuration, so ru_maxrss is that configuration's peak
+    ctx = torch.multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    p = ctx.Process(target=_isolated, args=(args, cfg, results))
+    p.start()
+    res = results.get()
+    p.join()
+    return res
+
+
+def configs(args):
+    for model, mode, batch_size, num_points, threads, precision in itertools.product(
+            args.models, args.modes, args.batch_sizes, args.num_points, args.threads, args.precision):
+        # k only changes dgcnn, do not rerun the other models for every k
+        for k in (args.k if model == 'dgcnn' else args.k[:1]):
+            # checkpointing only exists for dgcnn and pct, and only matters with a backward pass
+            blocks = ['none']
+            if model in CHECKPOINT_BLOCKS and mode != 'forward':
+                blocks = [b for b in args.checkpoint_blocks
+                          if b in ['none', 'all'] or set(b.split(',')) <= set(CHECKPOINT_BLOCKS[model])]
+            for checkpoint in blocks:
+                yield {'model': model, 'mode': mode, 'batch_size': batch_size, 'num_points': num_points,
+                       'k': k, 'threads': threads, 'precision': precision, 'checkpoint': checkpoint}
+
+
+def config_key(res):
+    # reports written before --checkpoint_blocks have no checkpoint entry
+    return tuple(res[name] for name in ['model', 'mode', 'batch_size', 'num_points', 'k', 'threads', 'precision']) + \
+        (res.get('checkpoint', 'none'),)
+
+
+def compare_checkpointing(io, results):
+    """
+    Log the peak memory and throughput of every checkpointed configuration
+    relative to the same configuration without checkpointing.
+    """
+    base = {config_key(r)[:-1]: r for r in results if 'error' not in r and r['checkpoint'] == 'none'}
+    rows = []
+    for res in results:
+        key = config_key(res)
+        if 'error' in res or res['checkpoint'] == 'none' or key[:-1] not in base:
+            continue
+        ref = base[key[:-1]]
+        row = dict(res, memory_ratio=res['peak_mem_mb'] / max(ref['peak_mem_mb'], 1e-9),
+                   throughput_ratio=res['samples_per_s'] / max(ref['samples_per_s'], 1e-9))
+        rows.append(row)
+        io.cprint('%-16s %-16s bs %4d n %5d k %3d t %3d %-5s %-12s :: peak %8.1f MB vs %8.1f MB (%.2fx), %9.1f samples/s vs %9.1f (%.2fx)' % (
+            key + (res['peak_mem_mb'], ref['peak_mem_mb'], row['memory_ratio'],
+                   res['samples_per_s'], ref['samples_per_s'], row['throughput_ratio'])))
+    return rows
+
+
+def checkpoint_parity(args, name, blocks):
+    """
+    One train-mode forward + backward of the eager and the checkpointed model
+    from the same weights and seed: loss, parameter gradients and BatchNorm
+    running statistics must agree (allclose with --parity_rtol / --parity_atol).
+    """
+    device = torch.device("cuda" if args.cuda else "cpu")
+    torch.manual_seed(args.seed)
+    model_args = copy.copy(args)
+    model_args.k = args.k[0]
+    model_args.num_points = args.num_points[0]
+    eager = build_model(model_args, name, device)
+    checkpointed = set_activation_checkpointing(copy.deepcopy(eager), blocks)
+    data = torch.rand(args.batch_sizes[0], 3, args.num_points[0], device=device) * 2 - 1
+    label = torch.randint(args.n_classes, (args.batch_sizes[0],), device=device)
+    losses = []
+    for model in [eager, checkpointed]:
+        model.train()
+        torch.manual_seed(args.seed)
+        logits,_,_ = model(data)
+        loss = cal_loss(logits,None,label)
+        loss.backward()
+        losses.append(loss.detach())
+    def close(a, b):
+        return torch.allclose(a.float(), b.float(), rtol=args.parity_rtol, atol=args.parity_atol)
+    grads = [(p.grad, q.grad) for p, q in zip(eager.parameters(), checkpointed.parameters()) if p.grad is not None]
+    stats = [(a, b) for a, b in zip(eager.buffers(), checkpointed.buffers())]
+    res = {'model': name, 'checkpoint': blocks,
+           'loss_abs': float((losses[0] - losses[1]).abs()),
+           'grad_max_abs': max([float((a - b).abs().max()) for a, b in grads] or [0.]),
+           'buffer_max_abs': max([float((a.float() - b.float()).abs().max()) for a, b in stats] or [0.]),
+           'missing_grads': sum(q.grad is None for p, q in zip(eager.parameters(), checkpointed.parameters()) if p.grad is not None)}
+    res['ok'] = close(losses[0], losses[1]) and res['missing_grads'] == 0 and \
+        all(b is not None and close(a, b) for a, b in grads) and all(close(a, b) for a, b in stats)
+    return res
+
+
+def compare(io, results, baseline, tolerance):
+    """
+    Log the p50 change of every configuration also present in baseline, return the regressions.
+    """
+    base = {config_key(r): r for r in baseline['results'] if 'error' not in r}
+    regressions = []
+    for res in results:
+        key = config_key(res)
+        if 'error' in res or key not in base:
+            continue
+        ratio = res['p50_ms'] / max(base[key]['p50_ms'], 1e-9)
+        flag = ''
+        if ratio > 1. + tolerance:
+            flag = ' REGRESSION'
+            regressions.append(dict(res, baseline_p50_ms=base[key]['p50_ms'], ratio=ratio))
+        io.cprint('%-16s %-16s bs %4d n %5d k %3d t %3d %-5s %-12s :: p50 %9.3f ms vs %9.3f ms (%.2fx)%s' % (
+            key + (res['p50_ms'], base[key]['p50_ms'], ratio, flag)))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Model zoo latency benchmark')
+    parser.add_argument('--models', type=str, nargs='+', default=MODELS, choices=MODELS,
+                        help='Models to benchmark')
+    parser.add_argument('--modes', type=str, nargs='+', default=MODES, choices=MODES,
+                        help='forward (eval, no grad), forward_backward (train step without optimizer), pgd_step (one attack iteration)')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 32],
+                        help='Batch sizes to sweep')
+    parser.add_argument('--num_points', type=int, nargs='+', default=[256, 1024, 4096],
+                        help='Points per cloud to sweep')
+    parser.add_argument('--k', type=int, nargs='+', default=[20],
+                        help='Nearest neighbours to sweep (dgcnn only)')
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()],
+                        help='Intra-op thread counts to sweep')
+    parser.add_argument('--precision', type=str, nargs='+', default=['fp32'], choices=['fp32', 'bf16', 'fp16'],
+                        help='Autocast precisions to sweep (fp16 needs a GPU)')
+    parser.add_argument('--checkpoint_blocks', type=str, nargs='+', default=['none'],
+                        help='Activation checkpointing settings to sweep for dgcnn and pct, e.g. none all edge1,edge2 sa1,sa2,sa3,sa4 (use --isolate for CPU peak memory)')
+    parser.add_argument('--parity_rtol', type=float, default=1e-4,
+                        help='Relative tolerance of the checkpointed against eager loss / gradient / running statistic check')
+    parser.add_argument('--parity_atol', type=float, default=1e-6,
+                        help='Absolute tolerance of the same check')
+    parser.add_argument('--warmup', type=int, default=3,
+                        help='Untimed iterations per configuration')
+    parser.add_argument('--repeats', type=int, default=10,
+                        help='Timed iterations per configuration')
+    parser.add_argument('--isolate', type=bool, default=False,
+                        help='Run every configuration in its own process (per-configuration CPU peak memory)')
+    parser.add_argument('--no_cuda', type=bool, default=False,
+                        help='Benchmark on CPU even if a GPU is available')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='random seed')
+    parser.add_argument('--n_classes', type=int, default=40,
+                        help='Output classes')
+    parser.add_argument('--emb_dims', type=int, default=1024, metavar='N',
+                        help='Dimension of embeddings')
+    parser.add_argument('--dropout', type=float, default=0.5,
+                        help='dropout rate')
+    parser.add_argument('--out', type=str, default='bench_models.json',
+                        help='Where to write the JSON report')
+    parser.add_argument('--baseline', type=str, default='',
+                        help='Earlier report to compare p50 latencies against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative p50 slowdown reported as a regression')
+    parser.add_argument('--accuracy_steps', type=int, default=0,
+                        help='Also train every model for this many steps per precision on a synthetic task and compare accuracy and throughput with fp32')
+    args = parser.parse_args()
+    # model constructor options the benchmark keeps at their training defaults
+    args.fspool_global = False
+    args.set_transformer_maxpool = False
+
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    io = IOStream(os.path.splitext(args.out)[0] + '.log')
+    io.cprint(str(args))
+
+    results = []
+    for cfg in configs(args):
+        try:
+            res = run_isolated(args, cfg) if args.isolate else run_config(args, cfg)
+        except Exception as e:
+            # e.g. fp16 on CPU, or ops without a CPU kernel
+            res = dict(cfg, error='%s: %s' % (type(e).__name__, e))
+        results.append(res)
+        if 'error' in res:
+            io.cprint('%-16s %-16s bs %4d n %5d k %3d t %3d %-5s %-12s :: %s' % (config_key(res) + (res['error'],)))
+        else:
+            io.cprint('%-16s %-16s bs %4d n %5d k %3d t %3d %-5s %-12s :: p50 %9.3f ms, p90 %9.3f ms, %9.1f samples/s, peak %8.1f MB' % (
+                config_key(res) + (res['p50_ms'], res['p90_ms'], res['samples_per_s'], res['peak_mem_mb'])))
+
+    report = {'meta': {'torch': torch.__version__, 'device': 'cuda' if args.cuda else 'cpu',
+                       'cuda_device': torch.cuda.get_device_name() if args.cuda else None,
+                       'cpu_count': os.cpu_count(), 'warmup': args.warmup, 'repeats': args.repeats,
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+              'results': results}
+    if any(b != 'none' for b in args.checkpoint_blocks):
+        io.cprint('Activation checkpointing against no checkpointing')
+        report['checkpointing'] = compare_checkpointing(io, results)
+        io.cprint('Activation checkpointing parity with eager (train mode)')
+        parity = []
+        for name in [m for m in args.models if m in CHECKPOINT_BLOCKS]:
+            for blocks in args.checkpoint_blocks:
+                if blocks == 'none' or not (blocks == 'all' or set(blocks.split(',')) <= set(CHECKPOINT_BLOCKS[name])):
+                    continue
+                try:
+                    res = checkpoint_parity(args, name, blocks)
+                    io.cprint('%-16s %-12s :: loss %.2e, grad %.2e, running stats %.2e %s' % (
+                        name, blocks, res['loss_abs'], res['grad_max_abs'], res['buffer_max_abs'], 'OK' if res['ok'] else 'MISMATCH'))
+                except Exception as e:
+                    res = {'model': name, 'checkpoint': blocks, 'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+                    io.cprint('%-16s %-12s :: %s' % (name, blocks, res['error']))
+                parity.append(res)
+        report['checkpointing_parity'] = parity
+    if args.accuracy_steps > 0:
+        io.cprint('Training %d steps per model and precision' % args.accuracy_steps)
+        precisions = ['fp32'] + [p for p in args.precision if p != 'fp32']
+        runs = []
+        for name, precision in itertools.product(args.models, precisions):
+            try:
+                runs.append(accuracy_run(args, name, precision))
+            except Exception as e:
+                runs.append({'model': name, 'precision': precision, 'error': '%s: %s' % (type(e).__name__, e)})
+        compare_accuracy(io, runs)
+        report['accuracy'] = runs
+
+    regressions = []
+    if args.baseline != '':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        io.cprint('Comparing against %s' % args.baseline)
+        regressions = compare(io, results, baseline, args.tolerance)
+        report['baseline'] = args.baseline
+        report['regressions'] = regressions
+        io.cprint('%d regressions above %.0f%%' % (len(regressions), 100 * args.tolerance))
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    mismatches = [r for r in report.get('checkpointing_parity', []) if not r['ok']]
+    sys.exit(1 if len(regressions) > 0 or len(mismatches) > 0 else 0)
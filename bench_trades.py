@@ -0,0 +1,148 @@
+'''
+Description: fused TRADES loss (one clean forward, concatenated final batch) against the separate forwards: loss, gradient and BatchNorm parity, and speed
+Autor: Jiachen Sun
+Date: 2021-08-23 09:30:12
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-23 15:04:37
+'''
+from __future__ import print_function
+import os
+import sys
+import argparse
+import copy
+import json
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from model_finetune import PointNet, DGCNN, PointNet_Simple, Pct, DeepSym
+from util import IOStream, trades_loss
+
+
+def build_model(args, device):
+    if args.model == 'pointnet':
+        model = PointNet(args,output_channels=args.n_classes).to(device)
+    elif args.model == 'dgcnn':
+        model = DGCNN(args,output_channels=args.n_classes).to(device)
+    elif args.model == 'pointnet_simple':
+        model = PointNet_Simple(args,output_channels=args.n_classes).to(device)
+    elif args.model == 'pct':
+        model = Pct(args,output_channels=args.n_classes).to(device)
+    elif args.model == 'deepsym':
+        model = DeepSym(args,output_channels=args.n_classes).to(device)
+    else:
+        raise Exception("Not implemented")
+    # the separate forwards draw a dropout mask each, the fused one shares it
+    for m in model.modules():
+        if isinstance(m, nn.Dropout):
+            m.p = 0.
+    return nn.DataParallel(model)
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def step(args, model, data, label, fused):
+    ''' One TRADES loss + backward with a fixed seed, returns (seconds, loss, gradients). '''
+    opt = torch.optim.SGD(model.parameters(), lr=0.)
+    torch.manual_seed(args.seed)
+    sync(data.device)
+    start = time.time()
+    loss = trades_loss(model,data,label,opt,step_size=args.alpha,epsilon=args.eps,
+                       perturb_steps=args.test_iter,fused=fused)
+    loss.backward()
+    sync(data.device)
+    elapsed = time.time() - start
+    grads = [p.grad.detach().clone() for p in model.parameters() if p.grad is not None]
+    return elapsed, loss.item(), grads
+
+
+def max_diff(a, b):
+    return max([float((x.float() - y.float()).abs().max()) for x, y in zip(a, b)] or [0.])
+
+
+def all_close(args, a, b):
+    # per tensor: gradients span orders of magnitude (PointNet STN grads reach ~1e2)
+    return all(torch.allclose(x.float(), y.float(), rtol=args.rtol, atol=args.atol) for x, y in zip(a, b))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fused TRADES loss parity and speed')
+    parser.add_argument('--model', type=str, default='dgcnn', metavar='N',
+                        choices=['pointnet', 'dgcnn', 'pointnet_simple', 'pct', 'deepsym'],
+                        help='Model to use, [pointnet, dgcnn pointnet_simple]')
+    parser.add_argument('--batch_size', type=int, default=16,
+                        help='Size of batch)')
+    parser.add_argument('--no_cuda', type=bool, default=False,
+                        help='enables CUDA training')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='random seed')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Timed steps per variant')
+    parser.add_argument('--num_points', type=int, default=1024,
+                        help='num of points to use')
+    parser.add_argument('--n_classes', type=int, default=40,
+                        help='Output classes')
+    parser.add_argument('--dropout', type=float, default=0.5,
+                        help='dropout rate')
+    parser.add_argument('--emb_dims', type=int, default=1024, metavar='N',
+                        help='Dimension of embeddings')
+    parser.add_argument('--k', type=int, default=20, metavar='N',
+                        help='Num of nearest neighbors to use')
+    parser.add_argument('--eps',type=float,default=0.05,
+                        help="Maximum allowed L_inf Perturbation")
+    parser.add_argument('--alpha',type=float,default=0.01,
+                        help="Perturbation step size")
+    parser.add_argument('--test_iter',type=int,default=7,
+                        help="Number of TRADES steps")
+    parser.add_argument('--rtol',type=float,default=1e-4,
+                        help="Relative tolerance of the loss / gradient / running statistic check")
+    parser.add_argument('--atol',type=float,default=1e-6,
+                        help="Absolute tolerance of the same check")
+    parser.add_argument('--out', type=str, default='bench_trades.json',
+                        help='Where to write the JSON report')
+    args = parser.parse_args()
+    # model constructor options kept at their training defaults
+    args.fspool_global = False
+    args.fspool_local = False
+    args.mlppool_global = False
+    args.set_transformer_maxpool = False
+
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda" if args.cuda else "cpu")
+    io = IOStream(os.path.splitext(args.out)[0] + '.log')
+    io.cprint(str(args))
+
+    torch.manual_seed(args.seed)
+    reference = build_model(args, device)
+    data = torch.rand(args.batch_size, 3, args.num_points, device=device) * 2 - 1
+    label = torch.randint(args.n_classes, (args.batch_size,), device=device)
+
+    # parity: both variants start from the same weights and BatchNorm statistics
+    separate, fused = copy.deepcopy(reference), copy.deepcopy(reference)
+    _, loss_separate, grad_separate = step(args, separate, data, label, False)
+    _, loss_fused, grad_fused = step(args, fused, data, label, True)
+    res = {'model': args.model, 'loss_separate': loss_separate, 'loss_fused': loss_fused,
+           'loss_abs': abs(loss_separate - loss_fused),
+           'grad_max_abs': max_diff(grad_separate, grad_fused),
+           'buffer_max_abs': max_diff([b for b in separate.buffers() if b.is_floating_point()],
+                                      [b for b in fused.buffers() if b.is_floating_point()])}
+    res['ok'] = all_close(args, [torch.tensor(loss_separate)], [torch.tensor(loss_fused)]) and \
+        all_close(args, grad_separate, grad_fused) and \
+        all_close(args, [b for b in separate.buffers() if b.is_floating_point()],
+                  [b for b in fused.buffers() if b.is_floating_point()])
+
+    for name, flag in [('separate', False), ('fused', True)]:
+        model = copy.deepcopy(reference)
+        step(args, model, data, label, flag)
+        res[name + '_time'] = float(np.median([step(args, model, data, label, flag)[0] for _ in range(args.repeats)]))
+    res['speedup'] = res['separate_time'] / max(res['fused_time'], 1e-12)
+
+    io.cprint('%s :: loss %.6f vs %.6f (|d| %.2e), grad %.2e, running stats %.2e %s | %.3fs -> %.3fs per step (%.2fx)' % (
+        args.model, loss_separate, loss_fused, res['loss_abs'], res['grad_max_abs'], res['buffer_max_abs'],
+        'OK' if res['ok'] else 'MISMATCH', res['separate_time'], res['fused_time'], res['speedup']))
+    with open(args.out, 'w') as f:
+        json.dump(res, f, indent=2)
+    sys.exit(0 if res['ok'] else 1)
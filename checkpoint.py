@@ -0,0 +1,287 @@
+'''
+Description: full-state checkpoints written in the background, with retention of the last K and the best
+Autor: Jiachen Sun
+Date: 2021-08-18 09:47:20
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-18 16:12:05
+'''
+import os
+import json
+import inspect
+import random
+import queue
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+def _cpu_copy(obj):
+    # own copy of every tensor, training keeps updating the originals in place
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        out = type(obj)((k, _cpu_copy(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            # state_dict versions, load_state_dict reads them
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_copy(v) for v in obj)
+    return obj
+
+def _strip_module(state):
+    out = OrderedDict((k[7:] if k.startswith('module.') else k, v) for k, v in state.items())
+    if hasattr(state, '_metadata'):
+        out._metadata = OrderedDict((k[7:] if k.startswith('module.') else k, v) for k, v in state._metadata.items())
+    return out
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def load_model_state(model, state):
+    """
+    load_state_dict that accepts files saved with or without the module. prefix
+    of (Distributed)DataParallel, whichever way model is wrapped.
+    """
+    wrapped = any(k.startswith('module.') for k in model.state_dict().keys())
+    saved = any(k.startswith('module.') for k in state.keys())
+    if saved and not wrapped:
+        state = _strip_module(state)
+    elif wrapped and not saved:
+        state = OrderedDict(('module.' + k, v) for k, v in state.items())
+    model.load_state_dict(state)
+
+def _load(path, map_location):
+    # the state files pickle numpy / random RNG state; torch >= 2.6 only unpickles
+    # tensors by default, these are our own files so allow the rest
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    return torch.load(path, map_location=map_location)
+
+def _atomic_save(obj, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _atomic_json(obj, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class CheckpointManager():
+    """
+    Every save() writes two files into directory: model_name % epoch holds the
+    bare model state_dict, exactly what the scripts saved before, so evaluation
+    scripts load it unchanged; state_name % epoch holds the rest of the training
+    state (optimizer, scheduler, RNG streams, epoch, metric and any extra values
+    or objects with a state_dict). checkpoints.json lists the finished ones.
+
+    The state is copied to CPU on the calling thread and written by a background
+    thread (tmp file + rename, so a crash never leaves a truncated checkpoint).
+    At most max_pending saves wait, after that save() blocks. With keep_last > 0
+    only the last keep_last epochs plus the best by metric stay on disk.
+    """
+    def __init__(self, directory, keep_last=0, mode='max', async_write=True, max_pending=2,
+                 model_name='model_epoch%d.t7', state_name='state_epoch%d.t7', strip_module=False):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.mode = mode
+        self.model_name = model_name
+        self.state_name = state_name
+        self.strip_module = strip_module
+        self.index_path = os.path.join(directory, 'checkpoints.json')
+        self.entries = self._read_index(directory)
+        self.error = None
+        self.thread = None
+        if async_write:
+            self.jobs = queue.Queue(max_pending)
+            self.thread = threading.Thread(target=self._writer, daemon=True)
+            self.thread.start()
+
+    @staticmethod
+    def _read_index(directory):
+        path = os.path.join(directory, 'checkpoints.json')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return json.load(f)['checkpoints']
+
+    def _better(self, a, b):
+        return a > b if self.mode == 'max' else a < b
+
+    def best(self):
+        scored = [e for e in self.entries if e['metric'] is not None]
+        if len(scored) == 0:
+            return None
+        best = scored[0]
+        for e in scored[1:]:
+            if self._better(e['metric'], best['metric']):
+                best = e
+        return best
+
+    def latest(self):
+        return self.entries[-1] if len(self.entries) > 0 else None
+
+    def save(self, epoch, model, optimizer=None, scheduler=None, metric=None, resume_epoch=None,
+             pending_metric=False, **extra):
+        """
+        Snapshot the training state after epoch. resume() continues at
+        resume_epoch, epoch + 1 by default. Call it last in the epoch so the
+        saved RNG streams are the ones the next epoch starts from. With
+        pending_metric the metric arrives later through update_metric (e.g.
+        from a background evaluation); retention keeps the checkpoint until then.
+        """
+        self._check()
+        model_state = model.state_dict()
+        if self.strip_module:
+            model_state = _strip_module(model_state)
+        state = {'epoch': epoch,
+                 'resume_epoch': epoch + 1 if resume_epoch is None else resume_epoch,
+                 'metric': metric,
+                 'rng': rng_state(),
+                 'optimizer': optimizer.state_dict() if optimizer is not None else None,
+                 'scheduler': scheduler.state_dict() if scheduler is not None else None,
+                 'extra': {k: v.state_dict() if hasattr(v, 'state_dict') else v for k, v in extra.items()}}
+        model_state, state = _cpu_copy(model_state), _cpu_copy(state)
+
+        entry = {'epoch': epoch, 'model': self.model_name % epoch, 'state': self.state_name % epoch,
+                 'metric': None if metric is None else float(metric)}
+        if pending_metric:
+            entry['pending'] = True
+        self.entries = [e for e in self.entries if e['epoch'] != epoch] + [entry]
+        writes = [(model_state, os.path.join(self.directory, entry['model'])),
+                  (state, os.path.join(self.directory, entry['state']))]
+        self._submit(writes)
+
+    def update_metric(self, epoch, metric):
+        """
+        Record the metric of an already saved epoch and apply retention again.
+        """
+        self._check()
+        entries = [e for e in self.entries if e['epoch'] == epoch]
+        if len(entries) == 0:
+            return
+        entries[0]['metric'] = None if metric is None else float(metric)
+        entries[0].pop('pending', None)
+        self._submit([])
+
+    def _submit(self, writes):
+        removed = self._retain()
+        keep = set(f for e in self.entries for f in (e['model'], e['state']))
+        deletes = [os.path.join(self.directory, f) for e in removed for f in (e['model'], e['state']) if f not in keep]
+        # entries are updated in place later, the writer gets its own copy of the index
+        job = (writes, {'checkpoints': [dict(e) for e in self.entries]}, deletes)
+        if self.thread is None:
+            self._write(job)
+        else:
+            self.jobs.put(job)
+
+    def _retain(self):
+        if self.keep_last <= 0:
+            return []
+        best = self.best()
+        kept, removed = [], []
+        for i, e in enumerate(self.entries):
+            if i >= len(self.entries) - self.keep_last or e is best or e.get('pending', False):
+                kept.append(e)
+            else:
+                removed.append(e)
+        self.entries = kept
+        return removed
+
+    def _write(self, job):
+        writes, index, deletes = job
+        for obj, path in writes:
+            _atomic_save(obj, path)
+        _atomic_json(index, self.index_path)
+        for path in deletes:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _writer(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                if self.error is None:
+                    self._write(job)
+            except Exception as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise Exception("Writing a checkpoint failed: %r" % self.error)
+
+    def close(self):
+        """
+        Wait until every queued checkpoint is on disk.
+        """
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+        self._check()
+
+    def resume(self, path, model=None, optimizer=None, scheduler=None, map_location='cpu', **extra):
+        """
+        Restore what save() wrote. path is 'latest' (the newest checkpoint in
+        directory) or either file of a checkpoint. Objects passed in extra get
+        their state loaded; returns (resume_epoch, the extra values), or
+        (None, {}) when path has no saved training state, e.g. an older bare
+        model file.
+        """
+        if path == 'latest':
+            entry, directory = self.latest(), self.directory
+        else:
+            directory, name = os.path.split(path)
+            entries = [e for e in self._read_index(directory) if name in (e['model'], e['state'])]
+            entry = entries[-1] if len(entries) > 0 else None
+        if entry is None:
+            return None, {}
+        state = _load(os.path.join(directory, entry['state']), map_location)
+        if model is not None:
+            load_model_state(model, _load(os.path.join(directory, entry['model']), map_location))
+        if optimizer is not None and state['optimizer'] is not None:
+            optimizer.load_state_dict(state['optimizer'])
+        if scheduler is not None and state['scheduler'] is not None:
+            scheduler.load_state_dict(state['scheduler'])
+        values = {}
+        for k, v in state['extra'].items():
+            if k in extra and hasattr(extra[k], 'load_state_dict'):
+                extra[k].load_state_dict(v)
+            else:
+                values[k] = v
+        set_rng_state(state['rng'])
+        return state['resume_epoch'], values
+
+    def restore(self, path, io, model, optimizer=None, scheduler=None, **extra):
+        """
+        resume() for the --resume flag of the training scripts: '' starts from
+        scratch at epoch 0, anything else must name saved training state.
+        """
+        if path == '':
+            return 0, {}
+        start_epoch, values = self.resume(path, model, optimizer, scheduler, **extra)
+        if start_epoch is None:
+            raise Exception("No training state saved for %s" % path)
+        io.cprint('Resuming from %s at epoch %d' % (path, start_epoch))
+        return start_epoch, values
@@ -21,10 +21,13 @@ from torch.utils.data import DataLoader
 import sys
 sys.path.append("./emd/")
 import emd_module
-from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss
+from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss, MixedPrecision
 import sklearn.metrics as metrics
 import attack
 import time
+from stage_profiler import StageProfiler
+from checkpoint import CheckpointManager
+import distributed
 
 def _init_():
     if not os.path.exists(args.pre_path + 'ssl_checkpoints'):
@@ -101,9 +104,16 @@ def train(args, io):
 
     criterion = cal_loss
 
+    mp = MixedPrecision(args.amp_train, device, model)
+    prof = StageProfiler(args.profile, sync_cuda=args.profile_sync)
+    if args.profile_modules:
+        prof.attach(model)
+
+    checkpoints = CheckpointManager(args.pre_path + 'ssl_checkpoints/%s/models' % args.exp_name, keep_last=args.keep_checkpoints)
+    start_epoch, _ = checkpoints.restore(args.resume, io, model, opt, scheduler, amp=mp)
 
     best_test_acc = 0
-    for epoch in range(args.epochs):
+    for epoch in range(start_epoch, args.epochs):
         ####################
         # Train
         ####################
@@ -119,7 +129,9 @@ def train(args, io):
         train_pred_jigsaw = []
         train_true_jigsaw = []
 
+        prof.reset_lap()
         for aug_data_1, aug_label_1, aug_data_2, aug_label_2 in train_loader:
+            prof.lap('data')
             # print(rotated_data.shape)
             # print(rotation_label.shape)
             # data, label = data.to(device), label.to(device).squeeze()
@@ -130,12 +142,17 @@ def train(args, io):
 
 
             rotated_data, rotation_label = aug_data_1.to(device).float(), aug_label_1.to(device).squeeze()
+            prof.lap('h2d')
+            prof.count('samples', batch_size)
             if args.adversarial:
                 rotated_data = attack.pgd_attack(model,rotated_data,rotation_label,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False) 
                 model.train()
+                prof.lap('pgd')
+                prof.count('pgd_steps', args.train_iter)
             opt.zero_grad()
-            logits_rotation,_,_ = model(rotated_data,True)
+            logits_rotation,_,_ = mp.forward(model,rotated_data,True)
             loss_rotation = criterion(logits_rotation,None,rotation_label)
+            prof.lap('forward')
             # loss_rotation.backward()
             # opt.step()
             # preds = logits.max(dim=1)[1]
@@ -145,27 +162,35 @@ def train(args, io):
             train_loss_rotation += loss_rotation.item() * batch_size
             train_true_rotation.append(rotation_label.cpu().numpy())
             train_pred_rotation.append(preds_rotation.detach().cpu().numpy())    
+            prof.lap('metrics')
 
         
             jigsaw_data, jigsaw_label = aug_data_2.to(device).float(), aug_label_2.to(device).squeeze().long()
+            prof.lap('h2d')
             if args.adversarial:
                 jigsaw_data = attack.pgd_attack_seg(model,jigsaw_data,jigsaw_label,args.k1**3,eps=args.eps,alpha=args.alpha,iters=args.train_iter) 
                 model.train()
+                prof.lap('pgd')
+                prof.count('pgd_steps', args.train_iter)
             opt.zero_grad()
-            logits_jigsaw,_,_ = model(jigsaw_data,False)
+            logits_jigsaw,_,_ = mp.forward(model,jigsaw_data,False)
             logits_jigsaw = logits_jigsaw.view(-1,args.k1**3)
             jigsaw_label = jigsaw_label.view(-1,1)[:,0]
             loss_jigsaw = F.nll_loss(logits_jigsaw,jigsaw_label)
             
             loss_total = args.lambda1 * loss_rotation + (1-args.lambda1) * loss_jigsaw
-            loss_total.backward()
-            opt.step()
+            prof.lap('forward')
+            mp.backward(loss_total)
+            prof.lap('backward')
+            mp.step(opt)
+            prof.lap('optimizer')
             # count += batch_size   
 
             preds_jigsaw = logits_jigsaw.max(dim=1)[1]
             train_loss_jigsaw += loss_jigsaw.item() * batch_size
             train_true_jigsaw.append(jigsaw_label.cpu().numpy())
             train_pred_jigsaw.append(preds_jigsaw.detach().cpu().numpy())
+            prof.lap('metrics')
 
 
 
@@ -205,8 +230,10 @@ def train(args, io):
 
         io.cprint(outstr)
         scheduler.step()
+        prof.lap('epoch_summary')
         
         test(args,io,model=model, dataloader = test_loader)
+        prof.lap('eval')
         # io.cprint(outstr)
 
         # test_train(args,io,model=model, dataloader = train_loader)
@@ -216,7 +243,11 @@ def train(args, io):
             # adversarial(args,io,model=model, dataloader = test_loader)
             # io.cprint(outstr)
 
-            torch.save(model.state_dict(), args.pre_path + 'ssl_checkpoints/%s/models/model_epoch%d.t7' % (args.exp_name,epoch))
+            checkpoints.save(epoch, model, opt, scheduler, amp=mp)
+        prof.lap('checkpoint')
+        prof.epoch_end(io, epoch)
+    checkpoints.close()
+    prof.export(args.pre_path + 'ssl_checkpoints/%s/profile' % args.exp_name)
     return model
 
 def test(args, io,model=None, dataloader=None):
@@ -332,6 +363,10 @@ if __name__ == "__main__":
                         help='Name of the experiment')
     parser.add_argument('--exp_name', type=str, default='exp', metavar='N',
                         help='Name of the experiment')
+    parser.add_argument('--resume', type=str, default='',
+                        help='Continue training from a checkpoint: latest, or a model_epoch/state_epoch file')
+    parser.add_argument('--keep_checkpoints', type=int, default=0,
+                        help='Keep only the last N epoch checkpoints plus the best one, 0 keeps all')
     parser.add_argument('--model', type=str, default='pointnet_simple_combine', metavar='N',
                         choices=['pointnet_simple_combine','dgcnn_combine'],
                         help='Model to use, [pointnet, dgcnn]')
@@ -396,7 +431,16 @@ if __name__ == "__main__":
                         help="Which lr scheduler to use")
     parser.add_argument('--lambda1',type=float,default=1.,
                         help="Hyper-parameter lambda")
+    parser.add_argument('--amp_train', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                        help='Mixed-precision training (autocast, fp32 BatchNorm, GradScaler for fp16; bf16 on CPU)')
+    parser.add_argument('--profile',type=bool,default=False,
+                        help="Log a per-epoch breakdown of data loading, host-to-device copy, attack, forward, backward and eval time")
+    parser.add_argument('--profile_sync',type=bool,default=False,
+                        help="Synchronise CUDA at every stage boundary so kernels are charged to the right stage")
+    parser.add_argument('--profile_modules',type=bool,default=False,
+                        help="Also time forward and backward of every leaf module (implies extra overhead)")
     args = parser.parse_args()
+    distributed.reject_launch(os.path.basename(__file__))
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     _init_()
@@ -0,0 +1,124 @@
+'''
+Description: graph-compiled forward passes for the model zoo (torch.compile, or TorchScript tracing on older torch)
+Autor: Jiachen Sun
+Date: 2021-08-20 10:05:44
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-20 17:38:26
+'''
+import warnings
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+
+BACKENDS = ['none', 'auto', 'trace', 'inductor']
+
+
+def resolve_backend(backend):
+    if backend == 'auto':
+        return 'inductor' if hasattr(torch, 'compile') else 'trace'
+    if backend == 'inductor' and not hasattr(torch, 'compile'):
+        raise Exception("torch.compile needs PyTorch 2.0 or newer, use --compile trace")
+    return backend
+
+
+def _autocast_state():
+    if hasattr(torch, 'is_autocast_enabled'):
+        return torch.is_autocast_enabled(), getattr(torch, 'is_autocast_cpu_enabled', lambda: False)()
+    return False, False
+
+
+class _Specialized(nn.Module):
+    """
+    model with its forward flags (rotation=, jigsaw=, ...) fixed, so every
+    Python branch on them is resolved while the graph is built. Calls the
+    class forward, not the compiled one installed on the instance.
+    """
+    def __init__(self, model, flags):
+        super(_Specialized, self).__init__()
+        self.model = model
+        self.flags = dict(flags)
+
+    def forward(self, x):
+        return type(self.model).forward(self.model, x, **self.flags)
+
+
+class CompiledForward():
+    """
+    Replaces model.forward. One graph per (flags, train/eval, autocast) and,
+    for traced graphs, per input shape, dtype and device: a trace freezes the
+    sizes it saw (e.g. args.num_points in the jigsaw heads), so a new batch size
+    or point count builds a new graph instead of reusing a wrong one. At most
+    max_graphs are kept (least recently used dropped). A graph that cannot be
+    built falls back to eager for its key, with one warning.
+    """
+    def __init__(self, model, backend, max_graphs=8):
+        self.model = model
+        self.backend = backend
+        self.max_graphs = max_graphs
+        self.graphs = OrderedDict()
+
+    def _key(self, x, flags):
+        key = (tuple(sorted(flags.items())), self.model.training, _autocast_state())
+        if self.backend == 'trace':
+            key = key + (tuple(x.shape), x.dtype, x.device)
+        return key
+
+    def _build(self, x, flags):
+        specialized = _Specialized(self.model, flags)
+        if self.backend == 'inductor':
+            # dynamic=True: symbolic batch size and point count instead of a recompile per shape
+            return torch.compile(specialized, dynamic=True)
+        with torch.no_grad():
+            # check_trace reruns the graph, which dropout in train mode never matches
+            traced = torch.jit.trace(specialized, (x.detach(),), check_trace=False)
+        # the optimizer steps the eager parameters, the graph has to see them
+        shared = set(p.data_ptr() for p in self.model.parameters())
+        if any(p.data_ptr() not in shared for p in traced.parameters()):
+            raise Exception("traced graph does not share the model parameters")
+        return traced
+
+    def __call__(self, x, **flags):
+        key = self._key(x, flags)
+        graph = self.graphs.get(key, False)
+        if graph is False:
+            try:
+                graph = self._build(x, flags)
+            except Exception as e:
+                warnings.warn("compile (%s) failed for %s %s, running eager: %s" % (
+                    self.backend, type(self.model).__name__, flags, e))
+                graph = None
+            self.graphs[key] = graph
+            if len(self.graphs) > self.max_graphs:
+                self.graphs.popitem(last=False)
+        else:
+            self.graphs.move_to_end(key)
+        if graph is None:
+            return type(self.model).forward(self.model, x, **flags)
+        return graph(x)
+
+
+def compile_model(model, backend='auto', max_graphs=8):
+    """
+    Install a compiled forward on model (or on the module inside
+    DataParallel / DistributedDataParallel) and return model. Parameters,
+    buffers and state_dict keys stay those of the eager model, so optimizers,
+    checkpoints and attacks keep working on it. backend 'none' is a no-op.
+    """
+    if backend == 'none':
+        return model
+    backend = resolve_backend(backend)
+    target = model
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        if isinstance(model, nn.DataParallel) and len(model.device_ids) > 1:
+            # replicas would call the graph built on the first device
+            raise Exception("compiled models run on a single device per process, use --world_size for several GPUs")
+        target = model.module
+    target.forward = CompiledForward(target, backend, max_graphs)
+    return model
+
+
+def uncompile_model(model):
+    target = model.module if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)) else model
+    if isinstance(target.__dict__.get('forward'), CompiledForward):
+        del target.forward
+    return model
@@ -417,22 +417,48 @@ def jitter_pointcloud(pointcloud, sigma=0.01, clip=0.05):
     jitter = np.clip(sigma * np.random.randn(N, C), -1*clip, clip)
     return (pointcloud + jitter).astype('float32'),jitter.astype('float32') 
 
-# class ATTA_ModelNet40(Dataset):
-#     def __init__(self, num_points):
-#         self.data, self.label = load_data('train')
-#         self.num_points = num_points
+class ATTA_ModelNet40(Dataset):
+    """
+    ModelNet40 training set that also returns the sample index and the
+    augmentation (jitter, permutation), so per-sample perturbations can be
+    carried across epochs (see attack.PerturbationBank). The returned cloud is
+    (pointcloud + jitter)[perm], with jitter given in the returned point order.
+    """
+    def __init__(self, num_points, partition='train', jitter=True, shuffle_points=True):
+        self.data, self.label = load_data(partition)
+        self.num_points = num_points
+        self.jitter = jitter
+        self.shuffle_points = shuffle_points
         
-#     def __getitem__(self, item):
-#         pointcloud = self.data[item][:self.num_points]
-#         label = self.label[item]
-#         pointcloud,jitter=jitter_pointcloud(pointcloud)
-#         idx = np.arange(pointcloud.shape[0])
-#         np.random.shuffle(idx)
-#         transform=(jitter,idx)
-#         return pointcloud[idx], label,item,transform
-
-#     def __len__(self):
-#         return self.data.shape[0]
+    def __getitem__(self, item):
+        pointcloud = self.data[item][:self.num_points]
+        label = self.label[item]
+        if self.jitter:
+            pointcloud,jitter = jitter_pointcloud(pointcloud)
+        else:
+            jitter = np.zeros_like(pointcloud, dtype='float32')
+        idx = np.arange(pointcloud.shape[0])
+        if self.shuffle_points:
+            np.random.shuffle(idx)
+        transform = (jitter[idx], idx)
+        return pointcloud[idx].astype('float32'), label, item, transform
+
+    def __len__(self):
+        return self.data.shape[0]
+
+class WithIndex(Dataset):
+    """
+    Appends the sample index to every item of dataset, e.g. to key cached
+    mixup assignments (emd_auction.AssignmentCache) by sample.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, item):
+        return tuple(self.dataset[item]) + (item,)
+
+    def __len__(self):
+        return len(self.dataset)
 
 def rotate_data(data, label):
     """ Rotate a batch of points by the label
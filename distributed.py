@@ -0,0 +1,164 @@
+'''
+Description: multi-process (DistributedDataParallel) training on one or more hosts, gloo on CPU and nccl on GPU; wired into finetune_main.py only, the other training scripts stay on DataParallel and refuse a distributed launch
+Autor: Jiachen Sun
+Date: 2021-08-16 10:31:52
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-16 18:04:37
+'''
+import os
+import socket
+import datetime
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from util import IOStream
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main():
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+class NullIO():
+    """
+    IOStream stand-in for the ranks that do not log.
+    """
+    def cprint(self, text):
+        pass
+
+    def close(self):
+        pass
+
+def rank_io(path):
+    return IOStream(path) if is_main() else NullIO()
+
+
+def launched():
+    # started by torchrun / torch.distributed.launch
+    return 'RANK' in os.environ and 'WORLD_SIZE' in os.environ
+
+def reject_launch(script):
+    """
+    For the training scripts still on DataParallel (main.py, self_main.py,
+    main_joint.py, combine_main.py): their self-supervised / mixup steps run
+    several forwards per step that DDP would all-reduce separately, so they
+    are not wired up. Fail early instead of training world_size unsynchronised copies.
+    """
+    if launched():
+        raise Exception("%s does not support distributed training, use finetune_main.py --world_size or launch it as a single process" % script)
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def setup(args, rank, world_size):
+    backend = args.dist_backend
+    if backend is None:
+        backend = 'nccl' if args.cuda and dist.is_nccl_available() else 'gloo'
+    if args.cuda:
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', rank)) % torch.cuda.device_count())
+    dist.init_process_group(backend, rank=rank, world_size=world_size,
+                            timeout=datetime.timedelta(minutes=args.dist_timeout))
+
+def _worker(rank, fn, args, port):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    setup(args, rank, args.world_size)
+    try:
+        fn(args)
+    finally:
+        dist.destroy_process_group()
+
+def launch(fn, args):
+    """
+    Run fn(args) in every training process. Under torchrun the current process
+    joins the group from the environment; otherwise args.world_size processes
+    are spawned on this host (several per GPU, or several on the CPU with gloo).
+    fn must be a module-level function, it is pickled into the workers.
+    """
+    if launched():
+        setup(args, int(os.environ['RANK']), int(os.environ['WORLD_SIZE']))
+        try:
+            fn(args)
+        finally:
+            dist.destroy_process_group()
+    elif args.world_size > 1:
+        torch.multiprocessing.spawn(_worker, args=(fn, args, _free_port()), nprocs=args.world_size)
+    else:
+        fn(args)
+
+
+def get_device(args):
+    if not args.cuda:
+        return torch.device("cpu")
+    if is_distributed():
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cuda")
+
+def wrap_model(model, args):
+    """
+    DistributedDataParallel inside a process group, DataParallel otherwise. Both
+    prefix parameters with module., so checkpoints are interchangeable.
+    """
+    if not is_distributed():
+        return nn.DataParallel(model)
+    if args.sync_bn:
+        if not args.cuda:
+            raise Exception("SyncBatchNorm needs CUDA")
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    device = get_device(args)
+    return nn.parallel.DistributedDataParallel(model, device_ids=[device.index] if args.cuda else None)
+
+def local_model(model):
+    """
+    The process-local replica. Attacks and evaluation run on it, so their
+    backward passes do not all-reduce weight gradients across ranks.
+    """
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        return model.module
+    return model
+
+
+def train_loader(dataset, batch_size, num_workers=8, drop_last=True):
+    """
+    Shuffled training loader; in a process group every rank gets a disjoint shard
+    and batch_size // world_size samples per step, so the global batch is unchanged.
+    """
+    if not is_distributed():
+        return DataLoader(dataset, num_workers=num_workers, batch_size=batch_size, shuffle=True, drop_last=drop_last)
+    sampler = DistributedSampler(dataset, shuffle=True, drop_last=drop_last)
+    return DataLoader(dataset, num_workers=num_workers, batch_size=max(batch_size // get_world_size(), 1),
+                      sampler=sampler, drop_last=drop_last)
+
+def set_epoch(loader, epoch):
+    # reshuffles the DistributedSampler, no-op for plain loaders
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+def all_reduce_sum(*values):
+    """
+    Sum python numbers over all ranks.
+    """
+    if not is_distributed():
+        return values if len(values) > 1 else values[0]
+    t = torch.tensor([float(v) for v in values], dtype=torch.float64,
+                     device='cuda' if dist.get_backend() == 'nccl' else 'cpu')
+    dist.all_reduce(t)
+    out = tuple(t.tolist())
+    return out if len(out) > 1 else out[0]
@@ -0,0 +1,159 @@
+# Portable EMD approximation (auction algorithm) in plain PyTorch
+# runs on CPU or GPU, no compiled extension needed
+# memory complexity: O(n * m) per chunk of the batch
+# time complexity: O(n * m * iter)
+
+# Input:
+# xyz1: [#batch, #points1, 3], xyz2: [#batch, #points2, 3] with #points1 <= #points2
+# any point count and batch size, clouds are best normalized to [0, 1] as for emd_module
+# eps is the minimal bid increment, it balances the error rate and the speed of convergence
+# iters is the maximal number of bidding rounds, the auction stops early once every point is matched
+
+# Output:
+# dist: [#batch, #points1], squared L2 distance to the matched point (gradient w.r.t. xyz1 only)
+# assignment: [#batch, #points1], index of the matched point in xyz2
+# bidders still unmatched after iters rounds take their best point, so as with the
+# CUDA kernel the assignment is not guaranteed to be a bijection
+
+from collections import OrderedDict
+import torch
+
+
+def apply_assignment(points, assignment):
+    """
+    Batched gather: points [B, M, C], assignment [B, N] -> points[b, assignment[b]] as [B, N, C].
+    """
+    index = assignment.long().unsqueeze(-1).expand(-1, -1, points.size(2))
+    return torch.gather(points, 1, index)
+
+
+def _auction(benefit, eps, iters):
+    # benefit: [B, n, m], every row bids for the object with the largest benefit - price
+    B, n, m = benefit.size()
+    device = benefit.device
+    price = benefit.new_zeros(B, m)
+    assignment = torch.full((B, n), -1, dtype=torch.long, device=device)
+    owner = torch.full((B, m), -1, dtype=torch.long, device=device)
+    rows_m = torch.arange(B, device=device).unsqueeze(1).expand(B, m)
+    objects = torch.arange(m, device=device).unsqueeze(0).expand(B, m)
+    if m == 1:
+        return assignment.fill_(0)
+
+    for _ in range(iters):
+        unassigned = assignment < 0
+        if not unassigned.any():
+            break
+        value = benefit - price.unsqueeze(1)
+        top, arg = value.topk(2, dim=2)
+        bid = price.gather(1, arg[:, :, 0]) + top[:, :, 0] - top[:, :, 1] + eps
+        bid = bid.masked_fill(~unassigned, float('-inf'))
+        # every object goes to its highest bidder
+        bids = value.new_full((B, n, m), float('-inf')).scatter_(2, arg[:, :, :1], bid.unsqueeze(2))
+        best, winner = bids.max(1)
+        won = best > float('-inf')
+        released = won & (owner >= 0)
+        assignment[rows_m[released], owner[released]] = -1
+        assignment[rows_m[won], winner[won]] = objects[won]
+        owner = torch.where(won, winner, owner)
+        price = torch.where(won, best, price)
+
+    unassigned = assignment < 0
+    if unassigned.any():
+        greedy = (benefit - price.unsqueeze(1)).argmax(2)
+        assignment[unassigned] = greedy[unassigned]
+    return assignment
+
+
+def auction_assignment(xyz1, xyz2, eps, iters, max_elements=2**24):
+    """
+    Match every point of xyz1 to a point of xyz2 minimising the summed squared
+    distance. The batch is split so that no chunk holds more than max_elements
+    pairwise costs.
+    """
+    B, n, _ = xyz1.size()
+    m = xyz2.size(1)
+    assert n <= m, "xyz1 cannot have more points than xyz2"
+    assert xyz1.size(0) == xyz2.size(0)
+    chunk = max(1, max_elements // (n * m))
+    out = []
+    with torch.no_grad():
+        for s in range(0, B, chunk):
+            x1 = xyz1[s:s+chunk].float()
+            x2 = xyz2[s:s+chunk].float()
+            benefit = -torch.cdist(x1, x2).pow(2)
+            out.append(_auction(benefit, float(eps), int(iters)))
+    return torch.cat(out, 0)
+
+
+def assignment_dist(xyz1, xyz2, assignment):
+    return torch.sum((xyz1 - apply_assignment(xyz2.detach(), assignment)) ** 2, dim=2)
+
+
+class AssignmentCache():
+    """
+    LRU store of assignments keyed by the (i, j) sample indices of a mixup pair,
+    so a pair seen in an earlier epoch is not matched again. Only valid while
+    the point order of every sample is fixed (jitter is fine, point shuffling is not).
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.store = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.store)
+
+    def lookup(self, keys):
+        """
+        keys: [B, 2] sample indices. Returns a list with the cached assignment or None per row.
+        """
+        found = []
+        for key in map(tuple, keys.tolist()):
+            assignment = self.store.get(key)
+            if assignment is None:
+                self.misses += 1
+            else:
+                self.store.move_to_end(key)
+                self.hits += 1
+            found.append(assignment)
+        return found
+
+    def insert(self, keys, assignments):
+        # int16 halves the footprint for the usual <= 32768 points
+        dtype = torch.int16 if assignments.size(1) <= 32768 else torch.int32
+        assignments = assignments.to('cpu', dtype)
+        for key, assignment in zip(map(tuple, keys.tolist()), assignments):
+            self.store[key] = assignment
+            self.store.move_to_end(key)
+            if len(self.store) > self.capacity:
+                self.store.popitem(last=False)
+
+
+class auctionModule(torch.nn.Module):
+    """
+    Same call as emd_module.emdModule, plus optional keys ([B, 2] sample indices
+    of each pair) to reuse cached assignments. solver(xyz1, xyz2, eps, iters)
+    computes the assignments that are not cached.
+    """
+    def __init__(self, cache_size=0, solver=auction_assignment):
+        super(auctionModule, self).__init__()
+        self.cache = AssignmentCache(cache_size) if cache_size > 0 else None
+        self.solver = solver
+
+    def forward(self, input1, input2, eps, iters, keys=None):
+        if self.cache is None or keys is None:
+            assignment = self.solver(input1, input2, eps, iters)
+        else:
+            found = self.cache.lookup(keys)
+            missing = [i for i, a in enumerate(found) if a is None]
+            assignment = torch.empty(input1.size(0), input1.size(1), dtype=torch.long, device=input1.device)
+            if len(missing) > 0:
+                missing = torch.tensor(missing, device=input1.device)
+                computed = self.solver(input1[missing], input2[missing], eps, iters).long()
+                assignment[missing] = computed
+                self.cache.insert(keys[missing.to(keys.device)], computed)
+            hit = [i for i, a in enumerate(found) if a is not None]
+            if len(hit) > 0:
+                assignment[torch.tensor(hit, device=input1.device)] = torch.stack([found[i] for i in hit]).to(input1.device).long()
+        return assignment_dist(input1, input2, assignment), assignment.int()
@@ -17,13 +17,19 @@
 # dist: [#batch, #points],  sqrt(dist) -> L2 distance 
 # assignment: [#batch, #points], index of the matched point in the ground truth point cloud
 # the result is an approximation and the assignment is not guranteed to be a bijection
+# without the compiled extension, or for inputs it does not support (CPU tensors, other
+# point counts or batch sizes), emdModule falls back to the PyTorch auction in emd_auction.py
 
 import time
 import numpy as np
 import torch
 from torch import nn
 from torch.autograd import Function
-import emd
+from emd_auction import auctionModule, auction_assignment
+try:
+    import emd
+except ImportError:
+    emd = None
 
 
 
@@ -71,12 +77,26 @@ class emdFunction(Function):
         emd.backward(xyz1, xyz2, gradxyz1, graddist, assignment)
         return gradxyz1, gradxyz2, None, None
 
+def cuda_supported(xyz1, xyz2):
+    n, m = xyz1.size(1), xyz2.size(1)
+    return emd is not None and xyz1.is_cuda and n == m and n % 1024 == 0 and xyz1.size(0) <= 512
+
+def solve_assignment(xyz1, xyz2, eps, iters):
+    if cuda_supported(xyz1, xyz2):
+        with torch.no_grad():
+            return emdFunction.apply(xyz1, xyz2, eps, iters)[1].long()
+    return auction_assignment(xyz1, xyz2, eps, iters)
+
 class emdModule(nn.Module):
-    def __init__(self):
+    # cache_size > 0 keeps that many assignments for forward(..., keys=[B, 2] pair indices)
+    def __init__(self, cache_size=0):
         super(emdModule, self).__init__()
+        self.auction = auctionModule(cache_size, solver=solve_assignment)
 
-    def forward(self, input1, input2, eps, iters):
-        return emdFunction.apply(input1, input2, eps, iters)
+    def forward(self, input1, input2, eps, iters, keys=None):
+        if keys is None and cuda_supported(input1, input2):
+            return emdFunction.apply(input1, input2, eps, iters)
+        return self.auction(input1, input2, eps, iters, keys)
 
 def test_emd():
     x1 = torch.rand(20, 8192, 3).cuda()
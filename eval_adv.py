@@ -7,6 +7,8 @@ LastEditTime: 2021-08-05 22:49:03
 '''
 from __future__ import print_function
 import os
+import copy
+import json
 import argparse
 import torch
 import torch.nn as nn
@@ -16,15 +18,17 @@ from torch.optim.lr_scheduler import CosineAnnealingLR, ExponentialLR, StepLR, M
 from data import PCData_SSL, PCData, PCData_Jigsaw
 from model_finetune import PointNet_Rotation, DGCNN_Rotation, PointNet_Jigsaw, PointNet, DGCNN, PointNet_Simple, Pct, DeepSym
 import numpy as np
-from torch.utils.data import DataLoader
 import sys
 sys.path.append("./emd/")
 import emd_module
 from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss
-import sklearn.metrics as metrics
+from compile_model import compile_model, BACKENDS
 import attack
 import time
 import model_combine
+from adv_cache import AdvCache, attack_config, data_config
+from shard_eval import run_shards, save_shard, shard_loader
+from stream_metrics import RobustAccuracy
 # EPS=0.05
 # ALPHA=0.01
 # TRAIN_ITER=7
@@ -48,12 +52,77 @@ def _init_():
     torch.backends.cudnn.deterministic=True
     torch.backends.cudnn.benchmark = False
 
-    
-def adversarial(args,io,model=None, dataloader=None):
+
+def generate_adv(args, model, apgd, data, label):
+    if args.attack == 'pgd':
+        adv_data = attack.pgd_attack(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False,amp=getattr(args,'amp',None))
+    elif args.attack == 'pgd_margin':
+        adv_data = attack.pgd_attack_margin(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+    elif args.attack == 'nattack':
+        adv_data = attack.nattack(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,variance=0.1,samples=args.samples)
+    elif args.attack == 'spsa':
+        adv_data = attack.spsa(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,samples=args.samples)
+    elif args.attack == 'nes':
+        adv_data = attack.nes(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,variance=0.001,samples=args.samples)
+    elif args.attack == 'evolution':
+        adv_data = attack.evolution(model,data,label,eps=args.eps,iters=args.test_iter,variance=0.005,samples=args.samples,k=args.samples // 4)
+    elif args.attack == 'apgd' or args.attack == 'apgd_margin':
+        _,adv_data = apgd.perturb(data,label)
+    elif args.attack == 'mim':
+        adv_data = attack.mim(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+    elif args.attack == 'mim_margin':
+        adv_data = attack.mim_margin(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+    elif args.attack == 'gaussian':
+        adv_data = attack.gaussian_attack(model,data,args.eps)
+    elif args.attack == 'uniform':
+        adv_data = attack.uniform_attack(model,data,args.eps)
+    elif args.attack in ['saliency_50', 'saliency_100', 'saliency_200']:
+        adv_data = attack.saliency(model,data,label,int(args.attack.split('_')[1]))
+    elif args.attack in ['random_50', 'random_100', 'random_200']:
+        adv_data = attack.random_drop(model,data,int(args.attack.split('_')[1]))
+    elif args.attack == 'add_50':
+        adv_data = attack.pgd_adding_attack(model,data,label,50,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+    elif args.attack == 'add_512':
+        adv_data = attack.pgd_adding_attack(model,data,label,512,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+    elif args.attack == 'add_256':
+        adv_data = attack.pgd_adding_attack(model,data,label,256,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+    elif args.attack == 'cw':
+        adv_data = attack.cwattack(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+    elif args.attack == 'cw_li':
+        adv_data = attack.cw_li_attack(model,data,label,max_iter=args.test_iter,eps=args.eps)
+    # elif args.attack == 'add_200':
+    #     adv_data = attack.pgd_adding_attack(model,data,label,200,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+    # elif args.attack == 'add_400':
+    #     adv_data = attack.pgd_adding_attack(model,data,label,400,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False) 
+    # elif args.attack == 'add_1024':
+    #     adv_data = attack.pgd_adding_attack(model,data,label,1024,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)    
+    # elif args.attack == 'add_512':
+    #     adv_data = attack.pgd_adding_attack(model,data,label,512,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+    return adv_data
+
+def load_model(args, device, output_channel):
+    if args.model == 'pointnet':
+        model = PointNet(args,output_channels=output_channel).to(device)
+    elif args.model == 'dgcnn':
+        model = DGCNN(args,output_channels=output_channel).to(device)
+    elif args.model == 'pointnet_simple':
+        model = PointNet_Simple(args,output_channels=output_channel).to(device)
+    elif args.model == 'pct':
+        model = Pct(args,output_channels=output_channel).to(device)
+    elif args.model == 'deepsym':
+        model = DeepSym(args).to(device)
+    else:
+        raise Exception("Not implemented")
+    model = nn.DataParallel(model)
+    model.load_state_dict(torch.load(args.model_path + '/model_epoch' + str(args.epochs) + '.t7'))
+    return compile_model(model, args.compile)
+
+def adversarial(args,io,model=None, dataloader=None, shard_path=None):
 
     if dataloader == None:
-        test_loader = DataLoader(PCData(name=args.dataset,partition='test', num_points=args.num_points), num_workers=8,
-                             batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+        # exactly the first --total samples, the same ones the sharded run splits up
+        test_loader = shard_loader(PCData(name=args.dataset,partition='test', num_points=args.num_points),
+                                   0, 1, args.total, args.test_batch_size)
     else:
         test_loader = dataloader
 
@@ -69,105 +138,223 @@ def adversarial(args,io,model=None, dataloader=None):
         output_channel = 57
     #Try to load models
     if model is None:
-        if args.model == 'pointnet':
-            model = PointNet(args,output_channels=output_channel).to(device)
-        elif args.model == 'dgcnn':
-            model = DGCNN(args,output_channels=output_channel).to(device)
-        elif args.model == 'pointnet_simple':
-            model = PointNet_Simple(args,output_channels=output_channel).to(device)
-        elif args.model == 'pct':
-            model = Pct(args,output_channels=output_channel).to(device)
-        elif args.model == 'deepsym':
-            model = DeepSym(args).to(device)
-        else:
-            raise Exception("Not implemented")
-        model = nn.DataParallel(model)
-        model.load_state_dict(torch.load(args.model_path + '/model_epoch' + str(args.epochs) + '.t7'))
+        model = load_model(args, device, output_channel)
 
     model = model.eval()
 
+    apgd = None
     if args.attack == 'apgd':
-        apgd = attack.APGDAttack(model,n_iter=args.test_iter,eps=args.eps,seed=args.seed)
+        apgd = attack.APGDAttack(model,n_iter=args.test_iter,eps=args.eps,seed=args.seed,device=device,amp=args.amp)
     elif args.attack == 'apgd_margin':
-        apgd = attack.APGDAttack(model,n_iter=args.test_iter,loss='ce_margin',eps=args.eps,seed=args.seed)
+        apgd = attack.APGDAttack(model,n_iter=args.test_iter,loss='ce_margin',eps=args.eps,seed=args.seed,device=device,amp=args.amp)
     
     test_acc = 0.0
-    test_true = []
-    test_pred = []
+    # clean, the attack, and the worst case over both; all-targets scores a sample as broken if any target succeeds
+    attack_name = 'all_targets' if args.all_targets else args.attack
+    robust = RobustAccuracy([attack_name], output_channel, device)
     total = args.total
     counter = 0
-    for data, label,_,_ in test_loader:
-        data, label = data.to(device).float(), label.to(device).long().squeeze()
+    if args.all_targets:
+        # success_sum[i, j]: samples of class i pushed to class j
+        success_sum = torch.zeros(output_channel, output_channel, device=device)
+        margin_sum = torch.zeros(output_channel, output_channel, device=device)
+        label_count = torch.zeros(output_channel, device=device)
+    cache = AdvCache(args.adv_cache, args.adv_cache_gb) if args.adv_cache != '' else None
+    for batch_idx, (data, label,_,_) in enumerate(test_loader):
+        data, label = data.to(device).float(), label.to(device).long().reshape(-1)
         data = data.permute(0, 2, 1)
         batch_size = data.size()[0]
+        with torch.no_grad():
+            clean_pred = model(data)[0].max(dim=1)[1]
+
+        if args.all_targets:
+            if args.attack == 'pgd':
+                success, margin = attack.pgd_attack_all_targets(model,data,label,output_channel,eps=args.eps,alpha=args.alpha,iters=args.test_iter,max_batch=args.target_batch,amp=args.amp)
+            elif args.attack == 'apgd' or args.attack == 'apgd_margin':
+                success, margin = apgd.perturb_all_targets(data,label,output_channel,max_batch=args.target_batch)
+            else:
+                raise Exception("All-targets mode is only implemented for pgd and apgd")
+            success_sum.index_add_(0, label, success.float())
+            margin_sum.index_add_(0, label, torch.nan_to_num(margin))
+            label_count += torch.bincount(label, minlength=output_channel).float()
+            # the first successful target stands in for the prediction of a broken sample
+            broken = success.bool().any(dim=1)
+            target_pred = torch.where(broken, success.float().argmax(dim=1), label)
+            robust.update_preds(label, clean=clean_pred, all_targets=target_pred)
+            counter += batch_size
+            if counter >= total:
+                break
+            continue
+
+        if args.attack == 'cw':
+            # cw is targeted at the next class, accuracy is measured against that target
+            label = (label + 1) % 40
+            clean_pred = None
+        if cache is not None:
+            # seed per batch so a cached entry does not depend on which batches came before it
+            torch.manual_seed(args.seed * 100003 + batch_idx)
+            adv_data = cache.fetch(model, attack_config(args), data_config(args, batch_idx, size=batch_size),
+                                   lambda: generate_adv(args, model, apgd, data, label), device)
+        else:
+            adv_data = generate_adv(args, model, apgd, data, label)
 
-        if args.attack == 'pgd':
-            adv_data = attack.pgd_attack(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        elif args.attack == 'pgd_margin':
-            adv_data = attack.pgd_attack_margin(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        elif args.attack == 'nattack':
-            adv_data = attack.nattack(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,variance=0.1,samples=args.samples)
-        elif args.attack == 'spsa':
-            adv_data = attack.spsa(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,samples=args.samples)
-        elif args.attack == 'nes':
-            adv_data = attack.nes(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,variance=0.001,samples=args.samples)
-        elif args.attack == 'evolution':
-            adv_data = attack.evolution(model,data,label,eps=args.eps,iters=args.test_iter,variance=0.005,samples=args.samples,k=args.samples // 4)
-        elif args.attack == 'apgd' or args.attack == 'apgd_margin':
-            _,adv_data = apgd.perturb(data,label)
-        elif args.attack == 'mim':
-            adv_data = attack.mim(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        elif args.attack == 'mim_margin':
-            adv_data = attack.mim_margin(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        elif args.attack == 'gaussian':
-            adv_data = attack.gaussian_attack(model,data,args.eps)
-        elif args.attack == 'uniform':
-            adv_data = attack.uniform_attack(model,data,args.eps)
-        elif args.attack == 'saliency_50':
-            adv_data = attack.saliency(model,data,label,50,10)
-        elif args.attack == 'saliency_100':
-            adv_data = attack.saliency(model,data,label,100,20)
-        elif args.attack == 'saliency_200':
-            adv_data = attack.saliency(model,data,label,200,40)
-        # elif args.attack == 'random_100':
-        #     adv_data = attack.random_drop(model,data,100)
-        # elif args.attack == 'random_200':
-        #     adv_data = attack.random_drop(model,data,200)
-        elif args.attack == 'add_50':
-            adv_data = attack.pgd_adding_attack(model,data,label,50,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        elif args.attack == 'add_512':
-            adv_data = attack.pgd_adding_attack(model,data,label,512,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        elif args.attack == 'add_256':
-            adv_data = attack.pgd_adding_attack(model,data,label,256,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        elif args.attack == 'cw':
-            label += 1
-            label = label % 40
-            adv_data = attack.cwattack(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        # elif args.attack == 'add_200':
-        #     adv_data = attack.pgd_adding_attack(model,data,label,200,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        # elif args.attack == 'add_400':
-        #     adv_data = attack.pgd_adding_attack(model,data,label,400,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False) 
-        # elif args.attack == 'add_1024':
-        #     adv_data = attack.pgd_adding_attack(model,data,label,1024,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)    
-        # elif args.attack == 'add_512':
-        #     adv_data = attack.pgd_adding_attack(model,data,label,512,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)   
-        
-        print(adv_data.shape)
-        logits,trans,trans_feat = model(adv_data)
-        preds = logits.max(dim=1)[1]
+        with torch.no_grad():
+            logits,trans,trans_feat = model(adv_data)
         counter += batch_size
-        test_true.append(label.cpu().numpy())
-        test_pred.append(preds.detach().cpu().numpy())
+        preds = {attack_name: logits.max(dim=1)[1]}
+        if clean_pred is not None:
+            preds['clean'] = clean_pred
+        robust.update_preds(label, **preds)
         if counter >= total:
             break
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
-    test_acc = metrics.accuracy_score(test_true, test_pred)
-    avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
+    if args.all_targets:
+        success_rate = (success_sum / label_count.clamp(min=1)[:, None]).cpu().numpy()
+        mean_margin = (margin_sum / label_count.clamp(min=1)[:, None]).cpu().numpy()
+        np.save(args.pre_path + 'finetune_checkpoints/' + args.exp_name + '/targets_' + args.attack + '_success.npy', success_rate)
+        np.save(args.pre_path + 'finetune_checkpoints/' + args.exp_name + '/targets_' + args.attack + '_margin.npy', mean_margin)
+        off_diag = ~np.eye(output_channel, dtype=bool) & (label_count.cpu().numpy() > 0)[:, None]
+        outstr = ' All targets :: mean targeted success: %.6f, best target per class: %.6f' % (
+            success_rate[off_diag].mean(), success_rate.max(axis=1)[label_count.cpu().numpy() > 0].mean())
+        io.cprint(args.attack + outstr)
+        report_robust(io, args.attack + ' All targets', robust)
+        return success_rate[off_diag].mean()
+    if shard_path is not None:
+        # metrics are computed once all shards are merged
+        save_shard(shard_path, **{'confusion_' + name: mat[None] for name, mat in robust.matrices().items()})
+        return None
+    return report_robust(io, args.attack, robust)
+
+def report_robust(io, prefix, robust):
+    """
+    Log clean, attack and worst-case accuracy of a RobustAccuracy, return the worst-case accuracy.
+    """
+    summary = robust.summary()
+    if 'clean' in summary:
+        io.cprint(prefix + ' :: clean acc: %.6f, clean avg acc: %.6f' % summary['clean'])
+    test_acc, avg_per_class_acc = summary['worst']
     outstr = ' Adversarial :: ADV_test acc: %.6f, ADV_test avg acc: %.6f'%(test_acc, avg_per_class_acc)
-    io.cprint(args.attack + outstr)
+    io.cprint(prefix + outstr)
     return test_acc
 
+def cascade(args,io,model=None, dataloader=None):
+    '''
+    Runs the attacks of args.cascade in order, each one only on the samples that
+    every earlier attack (and the clean forward pass) failed to break. Entries are
+    attack names as in --attack, optionally with their own step count, e.g. apgd:100.
+    Returns the worst-case robust accuracy.
+    '''
+    if dataloader == None:
+        # exactly the first --total samples, the same ones the sharded run splits up
+        test_loader = shard_loader(PCData(name=args.dataset,partition='test', num_points=args.num_points),
+                                   0, 1, args.total, args.test_batch_size)
+    else:
+        test_loader = dataloader
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+
+    if args.dataset == 'modelnet40':
+        output_channel = 40
+    elif args.dataset == 'modelnet10':
+        output_channel = 10
+    elif args.dataset == 'scanobjectnn':
+        output_channel = 15
+    elif args.dataset == 'shapenet':
+        output_channel = 57
+    if model is None:
+        model = load_model(args, device, output_channel)
+    model = model.eval()
+
+    stages = []
+    for spec in args.cascade:
+        stage_args = copy.copy(args)
+        stage_args.attack = spec.split(':')[0]
+        if ':' in spec:
+            stage_args.test_iter = int(spec.split(':')[1])
+        if stage_args.attack == 'cw':
+            raise Exception("cw is targeted and cannot be part of a cascade")
+        apgd = None
+        if stage_args.attack == 'apgd':
+            apgd = attack.APGDAttack(model,n_iter=stage_args.test_iter,eps=args.eps,seed=args.seed,device=device,amp=args.amp)
+        elif stage_args.attack == 'apgd_margin':
+            apgd = attack.APGDAttack(model,n_iter=stage_args.test_iter,loss='ce_margin',eps=args.eps,seed=args.seed,device=device,amp=args.amp)
+        stages.append((spec, stage_args, apgd))
+
+    # every stage's meter holds the predictions after that stage, so it reads as the
+    # accuracy against the cascade so far; 'worst' is the whole cascade
+    robust = RobustAccuracy([spec for spec, _, _ in stages], output_channel, device)
+    attacked = [0] * len(stages)
+    broken = torch.zeros(len(stages), dtype=torch.long, device=device)
+    elapsed = [0.] * len(stages)
+    counter = 0
+    for data, label,_,_ in test_loader:
+        data, label = data.to(device).float(), label.to(device).long().squeeze(-1)
+        data = data.permute(0, 2, 1)
+        with torch.no_grad():
+            logits,_,_ = model(data)
+        clean_pred = logits.max(dim=1)[1]
+        worst_pred = clean_pred.clone()
+        alive = worst_pred == label
+        stage_preds = {}
+        for i, (spec, stage_args, apgd) in enumerate(stages):
+            idx = alive.nonzero().squeeze(1)
+            if idx.numel() == 0:
+                stage_preds[spec] = worst_pred.clone()
+                continue
+            start = time.time()
+            adv_data = generate_adv(stage_args, model, apgd, data[idx], label[idx])
+            with torch.no_grad():
+                logits,_,_ = model(adv_data)
+            preds = logits.max(dim=1)[1]
+            hit = preds != label[idx]
+            worst_pred[idx[hit]] = preds[hit]
+            alive[idx[hit]] = False
+            broken[i] += hit.sum()
+            attacked[i] += idx.numel()
+            elapsed[i] += time.time() - start
+            stage_preds[spec] = worst_pred.clone()
+        robust.update_preds(label, clean=clean_pred, **stage_preds)
+        counter += data.size(0)
+        if counter >= args.total:
+            break
+
+    summary = robust.summary()
+    robust_acc, robust_avg_acc = summary['worst']
+    broken = broken.cpu().numpy()
+    report = {'attacks': args.cascade, 'samples': counter, 'clean_acc': summary['clean'][0],
+              'robust_acc': robust_acc, 'robust_avg_acc': robust_avg_acc, 'stages': []}
+    io.cprint('Cascade :: clean acc: %.6f' % report['clean_acc'])
+    for i, (spec, _, _) in enumerate(stages):
+        stage = {'attack': spec, 'attacked': attacked[i], 'broken': int(broken[i]),
+                 'marginal': float(broken[i]) / counter, 'acc': summary[spec][0], 'seconds': elapsed[i]}
+        report['stages'].append(stage)
+        io.cprint('Cascade :: %s :: attacked %d, newly broken %d (-%.6f acc, %.6f so far), %.1fs' % (
+            spec, attacked[i], stage['broken'], stage['marginal'], stage['acc'], elapsed[i]))
+    io.cprint('Cascade :: worst-case ADV_test acc: %.6f, ADV_test avg acc: %.6f' % (robust_acc, robust_avg_acc))
+    with open(args.pre_path + 'finetune_checkpoints/' + args.exp_name + '/cascade_seed' + str(args.seed) + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    return robust_acc
+
+def adversarial_shard(shard, args, path):
+    io = IOStream(os.path.splitext(path)[0] + '.log')
+    test_loader = shard_loader(PCData(name=args.dataset,partition='test', num_points=args.num_points),
+                               shard, args.shards, args.total, args.test_batch_size)
+    adversarial(args,io,model=None,dataloader=test_loader,shard_path=path)
+
+def sharded_adversarial(args,io):
+    if args.all_targets:
+        raise Exception("All-targets mode does not support sharding")
+    shard_dir = args.shard_dir if args.shard_dir != '' else args.pre_path + 'finetune_checkpoints/' + args.exp_name
+    shard_dir = os.path.join(shard_dir, 'shards_' + str(args.epochs) + '_' + args.attack + '_' + str(args.test_iter) + '_seed' + str(args.seed))
+    config = attack_config(args, model_path=args.model_path, epochs=args.epochs, dataset=args.dataset,
+                           num_points=args.num_points, total=args.total, batch_size=args.test_batch_size)
+    merged = run_shards(adversarial_shard, args, shard_dir, config, io)
+    mats = {name[len('confusion_'):]: mat.sum(axis=0) for name, mat in merged.items() if name.startswith('confusion_')}
+    if 'confusion' in merged:
+        # shards written before clean accuracy was tracked
+        mats = {'worst': merged['confusion'].sum(axis=0)}
+    robust = RobustAccuracy([args.attack]).merge(mats)
+    return report_robust(io, '%s (%d shards)' % (args.attack, args.shards), robust)
+
 if __name__ == "__main__":
     # Training settings
     parser = argparse.ArgumentParser(description='Point Cloud Recognition')
@@ -217,6 +404,24 @@ if __name__ == "__main__":
                         help='Attack method')
     parser.add_argument('--samples', type=int, default=64, 
                         help='black box samples')
+    parser.add_argument('--amp', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                        help='Autocast precision for pgd/apgd attacks (bf16 on CPU)')
+    parser.add_argument('--compile', type=str, default='none', choices=BACKENDS,
+                        help='Run the model as a compiled graph: trace (TorchScript), inductor (torch.compile), auto picks the best available')
+    parser.add_argument('--all_targets', type=bool, default=False,
+                        help='Run pgd/apgd towards every target class and save the per-target success matrix')
+    parser.add_argument('--target_batch', type=int, default=256,
+                        help='Max (sample, target) pairs attacked at once in all-targets mode')
+    parser.add_argument('--adv_cache', type=str, default='',
+                        help='Directory of the adversarial example cache, disabled if empty')
+    parser.add_argument('--adv_cache_gb', type=float, default=20.,
+                        help='Size limit of the adversarial example cache')
+    parser.add_argument('--cascade', type=str, nargs='+', default=[],
+                        help='Ordered attacks (name or name:steps) run on the samples no earlier attack broke, replaces --attack')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split the evaluation over this many worker processes')
+    parser.add_argument('--shard_dir', type=str, default='',
+                        help='Where per-shard predictions are kept (default: the experiment folder), rerunning resumes unfinished shards')
 
     args = parser.parse_args()
 
@@ -240,7 +445,12 @@ if __name__ == "__main__":
         else:
             io.cprint('Using CPU')
 
-        acc.append(adversarial(args,io,model=None))
+        if len(args.cascade) > 0:
+            acc.append(cascade(args,io))
+        elif args.shards > 1:
+            acc.append(sharded_adversarial(args,io))
+        else:
+            acc.append(adversarial(args,io,model=None))
     
 
     outstr = ' mean: %.6f, std: %.6f' % (np.mean(acc), np.std(acc))
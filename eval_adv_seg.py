@@ -26,31 +26,9 @@ import sklearn.metrics as metrics
 import attack
 import time
 import model_combine
+from stream_metrics import calculate_shape_IoU
+from shard_eval import run_shards, save_shard, shard_loader
 
-def calculate_shape_IoU(pred_np, seg_np, label, class_choice):
-    label = label.squeeze()
-    shape_ious = []
-    for shape_idx in range(seg_np.shape[0]):
-        if not class_choice:
-            start_index = index_start[label[shape_idx]]
-            num = seg_num[label[shape_idx]]
-            parts = range(start_index, start_index + num)
-        else:
-            parts = range(seg_num[label[0]])
-        part_ious = []
-        for part in parts:
-            I = np.sum(np.logical_and(pred_np[shape_idx] == part, seg_np[shape_idx] == part))
-            U = np.sum(np.logical_or(pred_np[shape_idx] == part, seg_np[shape_idx] == part))
-            if U == 0:
-                iou = 1  # If the union of groundtruth and prediction points is empty, then count part IoU as 1
-            else:
-                iou = I / float(U)
-            part_ious.append(iou)
-        shape_ious.append(np.mean(part_ious))
-    return shape_ious
-
-seg_num = [4, 2, 2, 4, 4, 3, 3, 2, 4, 2, 6, 2, 3, 3, 3, 3]
-index_start = [0, 4, 6, 8, 12, 16, 19, 22, 24, 28, 30, 36, 38, 41, 44, 47]
 
 def _init_():
     if not os.path.exists(args.pre_path +'finetune_seg_checkpoints'):
@@ -71,7 +49,7 @@ def _init_():
     torch.backends.cudnn.benchmark = False
 
     
-def adversarial(args,io,model=None, dataloader=None):
+def adversarial(args,io,model=None, dataloader=None, shard_path=None):
 
     if dataloader == None:
         test_loader = DataLoader(ShapeNetPart(partition='test', num_points=args.num_points, class_choice=args.class_choice), 
@@ -81,8 +59,10 @@ def adversarial(args,io,model=None, dataloader=None):
 
     device = torch.device("cuda" if args.cuda else "cpu")
 
-    seg_num_all = test_loader.dataset.seg_num_all
-    seg_start_index = test_loader.dataset.seg_start_index
+    # a shard loader wraps the dataset in a Subset
+    test_set = getattr(test_loader.dataset, 'dataset', test_loader.dataset)
+    seg_num_all = test_set.seg_num_all
+    seg_start_index = test_set.seg_start_index
     
     #Try to load models
     if model is None:
@@ -134,13 +114,18 @@ def adversarial(args,io,model=None, dataloader=None):
         test_true_seg.append(seg_np)
         test_pred_seg.append(pred_np)
         test_label_seg.append(label.reshape(-1))
+    test_true_seg = np.concatenate(test_true_seg, axis=0)
+    test_pred_seg = np.concatenate(test_pred_seg, axis=0)
+    test_label_seg = np.concatenate(test_label_seg)
+    if shard_path is not None:
+        # per-point accuracy and IoU are computed once all shards are merged
+        save_shard(shard_path, true_seg=test_true_seg, pred_seg=test_pred_seg, label_seg=np.asarray(test_label_seg),
+                   loss_sum=np.array(test_loss), count=np.array(count))
+        return None
     test_true_cls = np.concatenate(test_true_cls)
     test_pred_cls = np.concatenate(test_pred_cls)
     test_acc = metrics.accuracy_score(test_true_cls, test_pred_cls)
     avg_per_class_acc = metrics.balanced_accuracy_score(test_true_cls, test_pred_cls)
-    test_true_seg = np.concatenate(test_true_seg, axis=0)
-    test_pred_seg = np.concatenate(test_pred_seg, axis=0)
-    test_label_seg = np.concatenate(test_label_seg)
     test_ious = calculate_shape_IoU(test_pred_seg, test_true_seg, test_label_seg, args.class_choice)
     outstr = ' Adversarial :: loss: %.6f, test acc: %.6f, test avg acc: %.6f, test iou: %.6f' % (
                                                                                             test_loss*1.0/count,
@@ -150,6 +135,33 @@ def adversarial(args,io,model=None, dataloader=None):
     io.cprint(args.attack + outstr)
     return np.mean(test_ious)
 
+def adversarial_shard(shard, args, path):
+    io = IOStream(os.path.splitext(path)[0] + '.log')
+    test_loader = shard_loader(ShapeNetPart(partition='test', num_points=args.num_points, class_choice=args.class_choice),
+                               shard, args.shards, None, args.test_batch_size)
+    adversarial(args,io,model=None,dataloader=test_loader,shard_path=path)
+
+def sharded_adversarial(args,io):
+    shard_dir = args.shard_dir if args.shard_dir != '' else args.pre_path + 'finetune_seg_checkpoints/' + args.exp_name
+    shard_dir = os.path.join(shard_dir, 'shards_' + str(args.epochs) + '_' + args.attack + '_' + str(args.test_iter) + '_seed' + str(args.seed))
+    config = {'model_path': args.model_path, 'epochs': args.epochs, 'attack': args.attack, 'eps': args.eps,
+              'alpha': args.alpha, 'iters': args.test_iter, 'seed': args.seed, 'num_points': args.num_points,
+              'class_choice': args.class_choice, 'batch_size': args.test_batch_size}
+    merged = run_shards(adversarial_shard, args, shard_dir, config, io)
+    test_true_cls = merged['true_seg'].reshape(-1)
+    test_pred_cls = merged['pred_seg'].reshape(-1)
+    test_acc = metrics.accuracy_score(test_true_cls, test_pred_cls)
+    avg_per_class_acc = metrics.balanced_accuracy_score(test_true_cls, test_pred_cls)
+    test_ious = calculate_shape_IoU(merged['pred_seg'], merged['true_seg'], merged['label_seg'], args.class_choice)
+    outstr = ' Adversarial :: loss: %.6f, test acc: %.6f, test avg acc: %.6f, test iou: %.6f (%d shards)' % (
+                                                                                            merged['loss_sum']*1.0/merged['count'],
+                                                                                            test_acc,
+                                                                                            avg_per_class_acc,
+                                                                                            np.mean(test_ious),
+                                                                                            args.shards)
+    io.cprint(args.attack + outstr)
+    return np.mean(test_ious)
+
 if __name__ == "__main__":
     # Training settings
     parser = argparse.ArgumentParser(description='Point Cloud Recognition')
@@ -201,6 +213,10 @@ if __name__ == "__main__":
                                  'motor', 'mug', 'pistol', 'rocket', 'skateboard', 'table'])
     parser.add_argument('--samples', type=int, default=64, 
                         help='black box samples')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split the evaluation over this many worker processes')
+    parser.add_argument('--shard_dir', type=str, default='',
+                        help='Where per-shard predictions are kept (default: the experiment folder), rerunning resumes unfinished shards')
 
     args = parser.parse_args()
 
@@ -218,4 +234,7 @@ if __name__ == "__main__":
     else:
         io.cprint('Using CPU')
 
-    adversarial(args,io,model=None)
\ No newline at end of file
+    if args.shards > 1:
+        sharded_adversarial(args,io)
+    else:
+        adversarial(args,io,model=None)
\ No newline at end of file
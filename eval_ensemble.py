@@ -25,6 +25,7 @@ import sklearn.metrics as metrics
 import attack
 import time
 import model_combine
+from adv_cache import AdvCache, attack_config, data_config
 # EPS=0.05
 # ALPHA=0.01
 # TRAIN_ITER=7
@@ -106,13 +107,21 @@ def adversarial(args,io,model=None, dataloader=None):
     total = args.total
     counter = 0
     
-    for data, label,_,_ in test_loader:
+    cache = AdvCache(args.adv_cache, args.adv_cache_gb) if args.adv_cache != '' else None
+    for batch_idx, (data, label,_,_) in enumerate(test_loader):
         data, label = data.to(device).float(), label.to(device).long().squeeze()
         data = data.permute(0, 2, 1)
         batch_size = data.size()[0]
 
         if args.attack == 'pgd':
-            adv_data = attack.pgd_attack_ensemble(model1,model2,model3,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+            attack_fn = lambda: attack.pgd_attack_ensemble(model1,model2,model3,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+            if cache is not None:
+                # seed per batch so a cached entry does not depend on which batches came before it
+                torch.manual_seed(args.seed * 100003 + batch_idx)
+                adv_data = cache.fetch([model1, model2, model3], attack_config(args, 'ensemble_max'),
+                                       data_config(args, batch_idx), attack_fn, device)
+            else:
+                adv_data = attack_fn()
         # elif args.attack == 'pgd_margin':
         #     adv_data = attack.pgd_attack_margin(model1,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
         # elif args.attack == 'nattack':
@@ -223,6 +232,10 @@ if __name__ == "__main__":
                         help='Attack method')
     parser.add_argument('--samples', type=int, default=64, 
                         help='black box samples')
+    parser.add_argument('--adv_cache', type=str, default='',
+                        help='Directory of the adversarial example cache, disabled if empty')
+    parser.add_argument('--adv_cache_gb', type=float, default=20.,
+                        help='Size limit of the adversarial example cache')
 
     args = parser.parse_args()
 
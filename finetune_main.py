@@ -9,6 +9,7 @@
 
 from __future__ import print_function
 import os
+import copy
 import argparse
 import torch
 import torch.nn as nn
@@ -16,17 +17,23 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.optim.lr_scheduler import CosineAnnealingLR, ExponentialLR, StepLR, MultiStepLR, ReduceLROnPlateau
 from data import PCData_SSL, PCData, PCData_Jigsaw
-from model_finetune import PointNet_Rotation, DGCNN_Rotation, PointNet_Jigsaw, PointNet, DGCNN, PointNet_Simple, Pct, DeepSym
+from model_finetune import PointNet_Rotation, DGCNN_Rotation, PointNet_Jigsaw, PointNet, DGCNN, PointNet_Simple, Pct, DeepSym, set_activation_checkpointing
 import numpy as np
 from torch.utils.data import DataLoader
 import sys
 sys.path.append("./emd/")
 import emd_module
-from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss
-import sklearn.metrics as metrics
+from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss, MixedPrecision
 import attack
 import time
 import model_combine
+from shard_eval import run_shards, save_shard, shard_loader
+from stream_metrics import ConfusionMatrix
+from async_eval import AsyncEvaluator
+from stage_profiler import StageProfiler
+from checkpoint import CheckpointManager
+from compile_model import compile_model, BACKENDS
+import distributed
 # EPS=0.05
 # ALPHA=0.01
 # TRAIN_ITER=7
@@ -119,12 +126,11 @@ def info_nce_loss(self, features):
 def train(args, io):
 
     # flag_translate = (args.model == 'pct')
-    train_loader = DataLoader(PCData(name=args.dataset, partition='train', num_points=args.num_points), num_workers=8,
-                              batch_size=args.batch_size, shuffle=True, drop_last=True)
+    train_loader = distributed.train_loader(PCData(name=args.dataset, partition='train', num_points=args.num_points), args.batch_size)
     test_loader = DataLoader(PCData(name=args.dataset, partition='test', num_points=args.num_points), num_workers=8,
                              batch_size=args.test_batch_size, shuffle=False, drop_last=False)
 
-    device = torch.device("cuda" if args.cuda else "cpu")
+    device = distributed.get_device(args)
 
     if args.dataset == 'modelnet40':
         output_channel = 40
@@ -175,10 +181,15 @@ def train(args, io):
                     # nn.init.constant_(m.bias, 0.)
 
 
-    print(str(model))
+    if distributed.is_main():
+        print(str(model))
 
-    model = nn.DataParallel(model)
-    print("Let's use", torch.cuda.device_count(), "GPUs!")
+    set_activation_checkpointing(model, args.checkpoint_blocks)
+    model = distributed.wrap_model(model, args)
+    if distributed.is_distributed():
+        io.cprint("Let's use %d processes (%s)" % (distributed.get_world_size(), torch.distributed.get_backend()))
+    else:
+        print("Let's use", torch.cuda.device_count(), "GPUs!")
 
     if args.use_sgd:
         print("Use SGD")
@@ -208,8 +219,35 @@ def train(args, io):
     best_model = None
     best_epoch = 0
 
-
-    for epoch in range(args.epochs):
+    evaluator = None
+    if args.async_eval and distributed.is_main():
+        # the worker keeps the best weights by adversarial accuracy in model_best.t7
+        evaluator = AsyncEvaluator(model, evaluate_epoch, args.pre_path+'finetune_checkpoints/' + args.exp_name + '/run.log',
+                                   best_path=args.pre_path+'finetune_checkpoints/%s/models/model_best.t7' % (args.exp_name))
+    # after the evaluator took its eager copy of the model
+    compile_model(model, args.compile)
+
+    mp = MixedPrecision(args.amp_train, device, model)
+    prof = StageProfiler(args.profile, sync_cuda=args.profile_sync)
+    if args.profile_modules:
+        prof.attach(model)
+
+    free = None
+    if args.adversarial and args.adv_mode == 'free':
+        if args.attack != 'pgd' or args.contrast:
+            raise Exception("Free adversarial training is only implemented for the pgd attack")
+        free = attack.FreeAdversary(args.eps, replays=args.free_replays)
+
+    # every rank restores, only rank 0 writes
+    checkpoints = CheckpointManager(args.pre_path+'finetune_checkpoints/%s/models' % (args.exp_name),
+                                    keep_last=args.keep_checkpoints, async_write=distributed.is_main())
+    start_epoch, resumed = checkpoints.restore(args.resume, io, model, opt, scheduler, amp=mp)
+    if start_epoch > 0:
+        best_test_acc_adv = resumed['best_test_acc_adv']
+        best_epoch = resumed['best_epoch']
+        best_model = model
+
+    for epoch in range(start_epoch, args.epochs):
         ####################
         # Train
         ####################
@@ -227,62 +265,112 @@ def train(args, io):
         train_loss = 0.0
         count = 0.0
         model.train()
-        train_pred = []
-        train_true = []
+        train_confusion = ConfusionMatrix(device=device)
+        distributed.set_epoch(train_loader, epoch)
 
         # test(args,io,model=model, dataloader = test_loader)
 
+        prof.reset_lap()
         for data, label, _, _ in train_loader:
+            prof.lap('data')
             # print(rotated_data.shape)
             # print(rotation_label.shape)
             data, label = data.to(device).float(), label.to(device).long().squeeze()
             batch_size, N, C = data.size()
             data = data.permute(0, 2, 1)
+            prof.lap('h2d')
+            prof.count('samples', batch_size)
+
+            if free is not None:
+                # every replay's backward updates both the weights and the perturbation
+                for _ in range(free.replays):
+                    opt.zero_grad()
+                    logits,trans,trans_feat = mp.forward(model,free.perturb(data))
+                    loss = criterion(logits, trans_feat, label)
+                    prof.lap('forward')
+                    mp.backward(loss)
+                    free.step()
+                    prof.lap('backward')
+                    mp.step(opt)
+                    prof.lap('optimizer')
+                prof.count('replays', free.replays)
+                count += batch_size
+                train_loss += loss.item() * batch_size
+                train_confusion.add_logits(logits.detach(), label)
+                prof.lap('metrics')
+                continue
 
             if args.adversarial:
+                # attacks run on the local replica, their backward must not all-reduce
+                replica = distributed.local_model(model)
                 if args.attack == 'pgd':
-                    data = attack.pgd_attack(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False) 
+                    data = attack.pgd_attack(replica,data,label,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False,amp=args.amp) 
                 elif args.attack == 'add':
-                    data = attack.pgd_adding_attack(model,data,label,100,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False)
+                    data = attack.pgd_adding_attack(replica,data,label,100,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False)
                 elif args.attack == 'saliency':
-                    data = attack.saliency(model,data,label,100,args.train_iter)
+                    data = attack.saliency(replica,data,label,100,args.train_iter)
                 elif args.attack == 'add_512':
-                    data = attack.pgd_adding_attack(model,data,label,512,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False)
+                    data = attack.pgd_adding_attack(replica,data,label,512,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False)
                 elif args.attack == 'saliency_200':
-                    data = attack.saliency(model,data,label,200,args.train_iter)
+                    data = attack.saliency(replica,data,label,200,args.train_iter)
                 model.train()
+                prof.lap('pgd')
+                prof.count('pgd_steps', args.train_iter)
             opt.zero_grad()
-            logits,trans,trans_feat = model(data)
+            logits,trans,trans_feat = mp.forward(model,data)
             if args.contrast:
                 c_logits, c_labels = info_nce_loss(trans_feat)
                 loss = criterion(c_logits, trans_feat, c_labels)
             else:
                 loss = criterion(logits, trans_feat, label)
-            loss.backward()
-            opt.step()
-            preds = logits.max(dim=1)[1]
+            prof.lap('forward')
+            mp.backward(loss)
+            prof.lap('backward')
+            mp.step(opt)
+            prof.lap('optimizer')
             count += batch_size
             train_loss += loss.item() * batch_size
-            train_true.append(label.cpu().numpy())
-            train_pred.append(preds.detach().cpu().numpy())
+            train_confusion.add_logits(logits.detach(), label)
+            prof.lap('metrics')
 
-        train_true = np.concatenate(train_true)
-        train_pred = np.concatenate(train_pred)
+        # one summed confusion matrix over all ranks instead of gathering every prediction
+        train_acc, train_avg_acc = train_confusion.all_reduce().summary()
+        train_loss, count = distributed.all_reduce_sum(train_loss, count)
 
         outstr = 'Train %d, loss: %.6f, train acc: %.6f, train avg acc: %.6f' % (epoch,
                                                                                      train_loss*1.0/count,
-                                                                                     metrics.accuracy_score(
-                                                                                         train_true, train_pred),
-                                                                                     metrics.balanced_accuracy_score(
-                                                                                         train_true, train_pred))
+                                                                                     train_acc,
+                                                                                     train_avg_acc)
 
         io.cprint(outstr)
         if args.scheduler == 'plateau':
             scheduler.step(train_loss*1.0/count)
         else:
             scheduler.step()
+        prof.lap('epoch_summary')
+
+        if not distributed.is_main():
+            # rank 0 evaluates and saves alone, the others wait for it
+            distributed.barrier()
+            prof.lap('eval')
+            prof.epoch_end(io, epoch)
+            continue
+
+        if evaluator is not None:
+            if epoch == args.epochs-1:
+                args.test_iter = 200
+                args.alpha = 0.005
+            evaluator.submit(epoch, model, args)
+            prof.lap('eval')
+            if epoch % 10 == 0 or epoch == args.epochs-1:
+                checkpoints.save(epoch, model, opt, scheduler, amp=mp,
+                                 best_test_acc_adv=best_test_acc_adv, best_epoch=best_epoch)
+            prof.lap('checkpoint')
+            distributed.barrier()
+            prof.epoch_end(io, epoch)
+            continue
         
-        acc = test(args,io,model=model, dataloader = test_loader)
+        acc = test(args,io,model=distributed.local_model(model), dataloader = test_loader)
 
         if epoch % 10 == 0 or epoch == args.epochs-1:
             if epoch == args.epochs-1:
@@ -290,18 +378,61 @@ def train(args, io):
                 args.alpha = 0.005
                 io.cprint('Best epoch: %d' % best_epoch)
                 io.cprint('Best model in 7-step test:')
-                adversarial(args,io,model=best_model, dataloader = test_loader)
+                adversarial(args,io,model=distributed.local_model(best_model), dataloader = test_loader)
                 torch.save(best_model.state_dict(), args.pre_path+'finetune_checkpoints/%s/models/model_best.t7' % (args.exp_name))
 
-            acc_adv = adversarial(args,io,model=model, dataloader = test_loader)
+            acc_adv = adversarial(args,io,model=distributed.local_model(model), dataloader = test_loader)
             if acc_adv > best_test_acc_adv:
                 best_model = model
                 best_epoch = epoch
                 best_test_acc_adv = acc_adv
 
-            torch.save(model.state_dict(), args.pre_path+'finetune_checkpoints/%s/models/model_epoch%d.t7' % (args.exp_name,epoch))
+            checkpoints.save(epoch, model, opt, scheduler, metric=acc_adv, amp=mp,
+                             best_test_acc_adv=best_test_acc_adv, best_epoch=best_epoch)
+        distributed.barrier()
+        prof.lap('eval')
+        prof.epoch_end(io, epoch)
+
+    checkpoints.close()
+    if distributed.is_main():
+        prof.export(args.pre_path+'finetune_checkpoints/%s/profile' % args.exp_name)
+    if evaluator is not None:
+        evaluator.close()
+        best_epoch = evaluator.best_epoch()
+        if best_epoch is not None:
+            io.cprint('Best epoch: %d' % best_epoch)
+            io.cprint('Best model in 200-step test:')
+            best_model = copy.deepcopy(distributed.local_model(model))
+            state = torch.load(args.pre_path+'finetune_checkpoints/%s/models/model_best.t7' % (args.exp_name), map_location=device)
+            if not isinstance(model, nn.DataParallel):
+                state = {k[7:]:v for k,v in state.items()} # module.
+            best_model.load_state_dict(state)
+            adversarial(args,io,model=best_model, dataloader = test_loader)
     return model
 
+def distributed_train(args):
+    '''
+    Entry point of every training process under distributed.launch; only rank 0 logs.
+    '''
+    io = distributed.rank_io(args.pre_path+'finetune_checkpoints/' + args.exp_name + '/run.log')
+    torch.manual_seed(args.seed)
+    start = time.time()
+    train(args,io)
+    io.cprint("Training took %.6f hours" % ((time.time() - start)/3600))
+    io.close()
+
+def evaluate_epoch(args, io, model, epoch):
+    '''
+    The per-epoch evaluation of train(), run in the background with --async_eval.
+    Returns the adversarial accuracy on the epochs that run it.
+    '''
+    # no loader workers, the evaluator process is daemonic
+    test_loader = DataLoader(PCData(name=args.dataset, partition='test', num_points=args.num_points),
+                             batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+    test(args,io,model=model, dataloader = test_loader)
+    if epoch % 10 == 0 or epoch == args.epochs-1:
+        return adversarial(args,io,model=model, dataloader = test_loader)
+
 def test(args, io,model=None, dataloader=None):
 
     if dataloader == None:
@@ -341,8 +472,7 @@ def test(args, io,model=None, dataloader=None):
     model = model.eval()
     test_acc = 0.0
     count = 0.0
-    test_true = []
-    test_pred = []
+    confusion = ConfusionMatrix(device=device)
     for data, label,_,_ in test_loader:
 
         data, label = data.to(device).float(), label.to(device).long().squeeze()
@@ -354,20 +484,15 @@ def test(args, io,model=None, dataloader=None):
         #     logits = logits.view(-1,args.k1**3)
         #     label = label.view(-1,1)[:,0]
 
-        preds = logits.max(dim=1)[1]
-        test_true.append(label.cpu().numpy())
-        test_pred.append(preds.detach().cpu().numpy())
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
-    test_acc = metrics.accuracy_score(test_true, test_pred)
-    avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
+        confusion.add_logits(logits, label)
+    test_acc, avg_per_class_acc = confusion.summary()
     outstr = 'Test :: test acc: %.6f, test avg acc: %.6f'%(test_acc, avg_per_class_acc)
     io.cprint(outstr)
 
     return test_acc
 
 
-def adversarial(args,io,model=None, dataloader=None):
+def adversarial(args,io,model=None, dataloader=None, shard_path=None):
 
     if dataloader == None:
         test_loader = DataLoader(PCData(name=args.dataset,partition='test', num_points=args.num_points), num_workers=8,
@@ -405,8 +530,7 @@ def adversarial(args,io,model=None, dataloader=None):
     model = model.eval()
     test_acc = 0.0
     count = 0.0
-    test_true = []
-    test_pred = []
+    confusion = ConfusionMatrix(device=device)
     for data, label,_,_ in test_loader:
         data, label = data.to(device).float(), label.to(device).long().squeeze()
         data = data.permute(0, 2, 1)
@@ -422,22 +546,42 @@ def adversarial(args,io,model=None, dataloader=None):
         elif args.attack == 'saliency_200':
             adv_data = attack.saliency(model,data,label,200,40)
         logits,trans,trans_feat = model(adv_data)
-        preds = logits.max(dim=1)[1]
-        test_true.append(label.cpu().numpy())
-        test_pred.append(preds.detach().cpu().numpy())
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
-    test_acc = metrics.accuracy_score(test_true, test_pred)
-    avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
+        confusion.add_logits(logits, label)
+    if shard_path is not None:
+        save_shard(shard_path, confusion=confusion.matrix()[None])
+        return
+    test_acc, avg_per_class_acc = confusion.summary()
     outstr = 'Adversarial :: ADV_test acc: %.6f, ADV_test avg acc: %.6f'%(test_acc, avg_per_class_acc)
     io.cprint(outstr)
     return test_acc
 
+def adversarial_shard(shard, args, path):
+    io = IOStream(os.path.splitext(path)[0] + '.log')
+    test_loader = shard_loader(PCData(name=args.dataset,partition='test', num_points=args.num_points),
+                               shard, args.shards, None, args.test_batch_size)
+    adversarial(args,io,model=None,dataloader=test_loader,shard_path=path)
+
+def sharded_adversarial(args,io):
+    shard_dir = args.shard_dir if args.shard_dir != '' else args.pre_path + 'finetune_checkpoints/' + args.exp_name
+    shard_dir = os.path.join(shard_dir, 'shards_' + args.attack + '_' + str(args.eps) + '_' + str(args.test_iter) + '_seed' + str(args.seed))
+    config = {'model_path': args.model_path, 'model': args.model, 'attack': args.attack, 'eps': args.eps, 'alpha': args.alpha,
+              'iters': args.test_iter, 'seed': args.seed, 'num_points': args.num_points, 'batch_size': args.test_batch_size}
+    merged = run_shards(adversarial_shard, args, shard_dir, config, io)
+    test_acc, avg_per_class_acc = ConfusionMatrix().merge(merged['confusion'].sum(axis=0)).summary()
+    outstr = 'Adversarial :: ADV_test acc: %.6f, ADV_test avg acc: %.6f (%d shards)'%(test_acc, avg_per_class_acc, args.shards)
+    io.cprint(outstr)
+    return test_acc
+
+
 if __name__ == "__main__":
     # Training settings
     parser = argparse.ArgumentParser(description='Point Cloud Recognition')
     parser.add_argument('--exp_name', type=str, default='exp', metavar='N',
                         help='Name of the experiment')
+    parser.add_argument('--resume', type=str, default='',
+                        help='Continue training from a checkpoint: latest, or a model_epoch/state_epoch file')
+    parser.add_argument('--keep_checkpoints', type=int, default=0,
+                        help='Keep only the last N epoch checkpoints plus the best one, 0 keeps all')
     parser.add_argument('--model', type=str, default='dgcnn', metavar='N',
                         choices=['pointnet', 'dgcnn', 'pointnet_simple', 'pct', 'deepsym'],
                         help='Model to use, [pointnet, dgcnn pointnet_simple]')
@@ -482,8 +626,20 @@ if __name__ == "__main__":
                         help="Number of steps taken to create adversarial test inputs")
     parser.add_argument('--adversarial',type=bool,default=False,
                         help="Whether to use adversarial examples")
+    parser.add_argument('--adv_mode',type=str,default='pgd',choices=['pgd','free'],
+                        help="Adversarial training with --adversarial: pgd (train_iter steps per batch) or free (minibatch replay)")
+    parser.add_argument('--free_replays',type=int,default=4,
+                        help="Replays per batch in free adversarial training, divide --epochs by it to keep the clean-training cost")
     parser.add_argument('--gpu',type=str,default='0',
                         help="Which gpu to use")
+    parser.add_argument('--world_size',type=int,default=1,
+                        help="Training processes to spawn on this host (DistributedDataParallel), 1 keeps DataParallel")
+    parser.add_argument('--dist_backend',type=str,default=None,choices=['gloo','nccl'],
+                        help="Process group backend, defaults to nccl with CUDA and gloo otherwise")
+    parser.add_argument('--dist_timeout',type=int,default=120,
+                        help="Minutes a rank waits at a collective, covers rank 0 evaluating alone")
+    parser.add_argument('--sync_bn',type=bool,default=False,
+                        help="Convert BatchNorm to SyncBatchNorm under DistributedDataParallel (CUDA only)")
     parser.add_argument('--rotation',type=bool,default=False,
                         help="Whether to use rotation")
     parser.add_argument('--combine',type=bool,default=False,
@@ -502,6 +658,26 @@ if __name__ == "__main__":
                         help="Which lr scheduler to use")
     parser.add_argument('--attack',type=str,default='pgd',
                         help="Which attack to use")
+    parser.add_argument('--amp', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                        help='Autocast precision for adversarial example generation (bf16 on CPU)')
+    parser.add_argument('--amp_train', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                        help='Mixed-precision training (autocast, fp32 BatchNorm, GradScaler for fp16; bf16 on CPU)')
+    parser.add_argument('--compile', type=str, default='none', choices=BACKENDS,
+                        help='Run the model as a compiled graph: trace (TorchScript), inductor (torch.compile), auto picks the best available')
+    parser.add_argument('--checkpoint_blocks', type=str, default='',
+                        help='Recompute these blocks in backward instead of storing activations: all, or comma separated edge1-edge4 (dgcnn) / graph1,graph2,sa1-sa4 (pct)')
+    parser.add_argument('--async_eval',type=bool,default=False,
+                        help="Run the per-epoch evaluation in a background process")
+    parser.add_argument('--profile',type=bool,default=False,
+                        help="Log a per-epoch breakdown of data loading, host-to-device copy, attack, forward, backward and eval time")
+    parser.add_argument('--profile_sync',type=bool,default=False,
+                        help="Synchronise CUDA at every stage boundary so kernels are charged to the right stage")
+    parser.add_argument('--profile_modules',type=bool,default=False,
+                        help="Also time forward and backward of every leaf module (implies extra overhead)")
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split the --eval robustness evaluation over this many worker processes')
+    parser.add_argument('--shard_dir', type=str, default='',
+                        help='Where per-shard predictions are kept (default: the experiment folder), rerunning resumes unfinished shards')
     args = parser.parse_args()
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
@@ -523,11 +699,17 @@ if __name__ == "__main__":
         # EPS=args.eps
         # ALPHA=args.alpha
         # TRAIN_ITER=args.train_iter
-        model=train(args,io)
-        end = time.time()
-        io.cprint("Training took %.6f hours" % ((end - start)/3600))
+        if args.world_size > 1 or distributed.launched():
+            distributed.launch(distributed_train, args)
+        else:
+            model=train(args,io)
+            end = time.time()
+            io.cprint("Training took %.6f hours" % ((end - start)/3600))
     else:
         # EPS=args.eps
         # ALPHA=args.alpha
         # TEST_ITER=args.test_iter
-        adversarial(args,io,model=model)
+        if args.shards > 1:
+            sharded_adversarial(args,io)
+        else:
+            adversarial(args,io,model=model)
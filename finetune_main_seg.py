@@ -23,14 +23,13 @@ from torch.utils.data import DataLoader
 import sys
 sys.path.append("./emd/")
 import emd_module
-from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss
+from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss, MixedPrecision
 import sklearn.metrics as metrics
 import attack
 import time
 import model_combine
+from stream_metrics import calculate_shape_IoU
 
-seg_num = [4, 2, 2, 4, 4, 3, 3, 2, 4, 2, 6, 2, 3, 3, 3, 3]
-index_start = [0, 4, 6, 8, 12, 16, 19, 22, 24, 28, 30, 36, 38, 41, 44, 47]
 
 def _init_():
     if not os.path.exists(args.pre_path +'finetune_seg_checkpoints'):
@@ -55,28 +54,6 @@ def set_bn_eval(m):
     if classname.find('BatchNorm') != -1:
       m.eval()
 
-def calculate_shape_IoU(pred_np, seg_np, label, class_choice):
-    label = label.squeeze()
-    shape_ious = []
-    for shape_idx in range(seg_np.shape[0]):
-        if not class_choice:
-            start_index = index_start[label[shape_idx]]
-            num = seg_num[label[shape_idx]]
-            parts = range(start_index, start_index + num)
-        else:
-            parts = range(seg_num[label[0]])
-        part_ious = []
-        for part in parts:
-            I = np.sum(np.logical_and(pred_np[shape_idx] == part, seg_np[shape_idx] == part))
-            U = np.sum(np.logical_or(pred_np[shape_idx] == part, seg_np[shape_idx] == part))
-            if U == 0:
-                iou = 1  # If the union of groundtruth and prediction points is empty, then count part IoU as 1
-            else:
-                iou = I / float(U)
-            part_ious.append(iou)
-        shape_ious.append(np.mean(part_ious))
-    return shape_ious
-
 def load_pretrain(model, pretrain):
     state_dict = torch.load(pretrain, map_location='cpu')
     from collections import OrderedDict
@@ -181,6 +158,7 @@ def train(args, io):
     best_epoch = 0
 
 
+    mp = MixedPrecision(args.amp_train, device, model)
     for epoch in range(args.epochs):
         ####################
         # Train
@@ -222,11 +200,11 @@ def train(args, io):
                 data = attack.pgd_attack_partseg(model,data,seg,label_one_hot,eps=args.eps,number=seg_num_all,alpha=args.alpha,iters=args.train_iter)
                 model.train()
             opt.zero_grad()
-            seg_pred = model(data, label_one_hot)
+            seg_pred = mp.forward(model,data, label_one_hot)
             seg_pred = seg_pred.permute(0, 2, 1).contiguous()
             loss = criterion(seg_pred.view(-1, seg_num_all),None, seg.view(-1,1).squeeze())
-            loss.backward()
-            opt.step()
+            mp.backward(loss)
+            mp.step(opt)
             # print(seg_pred.shape)
             pred = seg_pred.max(dim=2)[1]               # (batch_size, num_points)
             count += batch_size
@@ -500,6 +478,8 @@ if __name__ == "__main__":
                         help='Pretrained model path')
     parser.add_argument('--scheduler',type=str,default='default',
                         help="Which lr scheduler to use")
+    parser.add_argument('--amp_train', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                        help='Mixed-precision training (autocast, fp32 BatchNorm, GradScaler for fp16; bf16 on CPU)')
     parser.add_argument('--class_choice', type=str, default=None, metavar='N',
                         choices=['airplane', 'bag', 'cap', 'car', 'chair',
                                  'earphone', 'guitar', 'knife', 'lamp', 'laptop', 
@@ -10,22 +10,31 @@
 from __future__ import print_function
 import os
 import argparse
+import json
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.optim.lr_scheduler import CosineAnnealingLR, ExponentialLR, StepLR, MultiStepLR
-from data import ModelNet40, ATTA_ModelNet40, ModelNet40_Jigsaw
+from data import ModelNet40, ATTA_ModelNet40, ModelNet40_Jigsaw, WithIndex
 from model import PointNet, PointNet_2, DGCNN, SetTransformer, knn, PointNet_3, PointNet_Jigsaw
 import numpy as np
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import sys
 sys.path.append("./emd/")
 import emd_module
-from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss
+from emd_auction import apply_assignment
+from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss, MixedPrecision, mixup_labels, cutout
 import sklearn.metrics as metrics
 import attack
 import time
+from shard_eval import run_shards, save_shard, shard_loader
+from stream_metrics import ConfusionMatrix
+from async_eval import AsyncEvaluator
+from stage_profiler import StageProfiler
+from checkpoint import CheckpointManager
+import distributed
+from compile_model import compile_model, BACKENDS
 EPS=0.05
 ALPHA=0.01
 TRAIN_ITER=7
@@ -53,7 +62,10 @@ def set_bn_eval(m):
 
 def train(args, io):
     if not args.jigsaw:
-        train_loader = DataLoader(ModelNet40(partition='train', num_points=args.num_points, rotation=args.rotation, angles=args.angles), num_workers=8,
+        train_set = ModelNet40(partition='train', num_points=args.num_points, rotation=args.rotation, angles=args.angles)
+        if args.mixup and args.emd_cache > 0:
+            train_set = WithIndex(train_set)
+        train_loader = DataLoader(train_set, num_workers=8,
                                   batch_size=args.batch_size, shuffle=True, drop_last=True)
         test_loader = DataLoader(ModelNet40(partition='test', num_points=args.num_points), num_workers=8,
                                  batch_size=args.test_batch_size, shuffle=False, drop_last=False)
@@ -114,10 +126,32 @@ def train(args, io):
         criterion = cal_loss
 
     if args.mixup:
-        EMD = emd_module.emdModule()
+        EMD = emd_module.emdModule(cache_size=args.emd_cache)
+
+    evaluator = None
+    if args.async_eval:
+        # the worker keeps the best weights by test accuracy in model_best.t7
+        evaluator = AsyncEvaluator(model, evaluate_epoch, 'checkpoints/' + args.exp_name + '/run.log',
+                                   best_path='checkpoints/%s/models/model_best.t7' % args.exp_name)
+    # after the evaluator took its eager copy of the model
+    compile_model(model, args.compile)
+
+    mp = MixedPrecision(args.amp_train, device, model)
+    prof = StageProfiler(args.profile, sync_cuda=args.profile_sync)
+    if args.profile_modules:
+        prof.attach(model)
+
+    free = None
+    if args.adversarial and args.adv_mode == 'free':
+        if args.trades or args.rotation or args.jigsaw:
+            raise Exception("Free adversarial training is only implemented for plain classification")
+        free = attack.FreeAdversary(EPS, replays=args.free_replays)
+
+    checkpoints = CheckpointManager('checkpoints/%s/models' % args.exp_name, keep_last=args.keep_checkpoints)
+    start_epoch, _ = checkpoints.restore(args.resume, io, model, opt, scheduler, amp=mp)
 
     best_test_acc = 0
-    for epoch in range(args.epochs):
+    for epoch in range(start_epoch, args.epochs):
         ####################
         # Train
         ####################
@@ -148,50 +182,40 @@ def train(args, io):
             train_pred_jigsaw = []
             train_true_jigsaw = []
 
-        for data, label, aug_data, aug_label in train_loader:
+        prof.reset_lap()
+        for data, label, aug_data, aug_label, *item in train_loader:
+            prof.lap('data')
             # print(rotated_data.shape)
             # print(rotation_label.shape)
             data, label = data.to(device), label.to(device).squeeze()
             batch_size, N, C = data.size()
+            prof.lap('h2d')
+            prof.count('samples', batch_size)
             # print(batch_size,N,C)
             if args.mixup:
                 idx_minor = torch.randperm(batch_size)
                 mixrates = (0.5 - np.abs(np.random.beta(0.4, 0.4, batch_size) - 0.5))
-                label_main = label
-                label_minor = label[idx_minor]
-                label_new = torch.zeros(batch_size, 40)
-                for i in range(batch_size):
-                    if label_main[i] == label_minor[i]: # same label
-                        label_new[i][label_main[i]] = 1.0
-                    else:
-                        label_new[i][label_main[i]] = 1 - mixrates[i]
-                        label_new[i][label_minor[i]] = mixrates[i]
-                label = label_new
+                label = mixup_labels(label, label[idx_minor], mixrates)
 
                 data_minor = data[idx_minor]
-                mix_rate = torch.tensor(mixrates).cuda().float()
+                mix_rate = torch.tensor(mixrates).to(device).float()
                 mix_rate = mix_rate.unsqueeze_(1).unsqueeze_(2)
 
                 mix_rate_expand_xyz = mix_rate.expand(data.shape)
-                _, ass = EMD(data, data_minor, 0.005, 300)
-                ass = ass.long()
-                for i in range(batch_size):
-                    data_minor[i] = data_minor[i][ass[i]]
+                keys = torch.stack([item[0], item[0][idx_minor]], 1) if len(item) > 0 else None
+                _, ass = EMD(data, data_minor, 0.005, 300, keys=keys)
+                data_minor = apply_assignment(data_minor, ass)
                 data = data * (1 - mix_rate_expand_xyz) + data_minor * mix_rate_expand_xyz
                 
             if args.cutout:
-                idx = np.random.randint(args.num_points,size=batch_size)
-                for i in range(batch_size):
-                    picked = data[i][idx[i]]
-                    dist = torch.sum((data[i] - picked)**2, dim=1, keepdim=True)
-                    idx = dist.topk(k=100, largest=False, dim=0)[1]
-                    data[i,idx.squeeze()] = 0
+                data = cutout(data, k=100)
 
             # np.save('./test.npy',data.cpu().numpy())
 
             data = data.permute(0, 2, 1)
             if args.rotation or args.jigsaw:
                 aug_data = aug_data.permute(0, 2, 1)
+            prof.lap('augment')
 
             if args.trades:
                 opt.zero_grad()
@@ -204,39 +228,77 @@ def train(args, io):
                                    epsilon=args.eps,
                                    perturb_steps=args.test_iter,
                                    beta=1.0,
-                       distance='l_inf')
-                loss.backward()
-                opt.step()
+                       distance='l_inf',
+                                   amp=args.amp,
+                                   train_amp=mp.amp)
+                prof.lap('pgd_forward')
+                prof.count('pgd_steps', args.test_iter)
+                mp.backward(loss)
+                prof.lap('backward')
+                mp.step(opt)
+                prof.lap('optimizer')
                 count += batch_size
                 train_loss += loss.item() * batch_size
+                prof.lap('metrics')
             else:
-                if not args.rotation and not args.jigsaw:
+                if not args.rotation and not args.jigsaw and free is not None:
+                    # every replay's backward updates both the weights and the perturbation
+                    for _ in range(free.replays):
+                        opt.zero_grad()
+                        logits,trans,trans_feat = mp.forward(model,free.perturb(data))
+                        loss = criterion(logits, trans_feat, label)
+                        prof.lap('forward')
+                        mp.backward(loss)
+                        free.step()
+                        prof.lap('backward')
+                        mp.step(opt)
+                        prof.lap('optimizer')
+                    prof.count('replays', free.replays)
+                    preds = logits.max(dim=1)[1]
+                    count += batch_size
+                    train_loss += loss.item() * batch_size
+                    train_true.append(label.cpu().numpy())
+                    train_pred.append(preds.detach().cpu().numpy())
+                    prof.lap('metrics')
+                elif not args.rotation and not args.jigsaw:
                     if args.adversarial:
-                        data = attack.pgd_attack(model,data,label,eps=EPS,alpha=ALPHA,iters=TRAIN_ITER,mixup=args.mixup) 
+                        data = attack.pgd_attack(model,data,label,eps=EPS,alpha=ALPHA,iters=TRAIN_ITER,mixup=args.mixup,amp=args.amp) 
                         model.train()
+                        prof.lap('pgd')
+                        prof.count('pgd_steps', TRAIN_ITER)
                     opt.zero_grad()
-                    logits,trans,trans_feat = model(data)
+                    logits,trans,trans_feat = mp.forward(model,data)
                     loss = criterion(logits, trans_feat, label)
-                    loss.backward()
-                    opt.step()
+                    prof.lap('forward')
+                    mp.backward(loss)
+                    prof.lap('backward')
+                    mp.step(opt)
+                    prof.lap('optimizer')
                     preds = logits.max(dim=1)[1]
                     count += batch_size
                     train_loss += loss.item() * batch_size
                     train_true.append(label.cpu().numpy())
                     train_pred.append(preds.detach().cpu().numpy())
+                    prof.lap('metrics')
                 elif args.rotation:
                     rotated_data, rotation_label = aug_data.to(device).float(), aug_label.to(device).squeeze()
+                    prof.lap('h2d')
                     if args.adversarial:
-                        data = attack.pgd_attack(model,data,label,eps=EPS,alpha=ALPHA,iters=TRAIN_ITER,mixup=args.mixup) 
+                        data = attack.pgd_attack(model,data,label,eps=EPS,alpha=ALPHA,iters=TRAIN_ITER,mixup=args.mixup,amp=args.amp) 
                         model.train()
+                        prof.lap('pgd')
+                        prof.count('pgd_steps', TRAIN_ITER)
                     opt.zero_grad()
-                    logits,trans,trans_feat = model(data,rotation = False)
+                    logits,trans,trans_feat = mp.forward(model,data,rotation = False)
                     loss = criterion(logits, trans_feat, label)
-                    logits_rotation,_,_ = model(rotated_data,rotation = True)
+                    logits_rotation,_,_ = mp.forward(model,rotated_data,rotation = True)
                     loss_rotation = criterion(logits_rotation,None,rotation_label)
                     loss_total = loss + args.lambda1 * loss_rotation
-                    loss_total.backward()
-                    opt.step()
+                    prof.lap('forward')
+                    mp.backward(loss_total)
+                    prof.lap('backward')
+                    mp.step(opt)
+                    prof.lap('optimizer')
                     preds = logits.max(dim=1)[1]
                     count += batch_size
                     train_loss += loss.item() * batch_size
@@ -247,22 +309,29 @@ def train(args, io):
                     train_loss_rotation += loss_rotation.item() * batch_size
                     train_true_rotation.append(rotation_label.cpu().numpy())
                     train_pred_rotation.append(preds_rotation.detach().cpu().numpy())    
+                    prof.lap('metrics')
 
                 elif args.jigsaw:             
                     jigsaw_data, jigsaw_label = aug_data.to(device).float(), aug_label.to(device).squeeze().long()
+                    prof.lap('h2d')
                     if args.adversarial:
-                        data = attack.pgd_attack(model,data,label,eps=EPS,alpha=ALPHA,iters=TRAIN_ITER,mixup=args.mixup) 
+                        data = attack.pgd_attack(model,data,label,eps=EPS,alpha=ALPHA,iters=TRAIN_ITER,mixup=args.mixup,amp=args.amp) 
                         model.train()
+                        prof.lap('pgd')
+                        prof.count('pgd_steps', TRAIN_ITER)
                     opt.zero_grad()
-                    logits,trans,trans_feat = model(data,jigsaw = False)
+                    logits,trans,trans_feat = mp.forward(model,data,jigsaw = False)
                     loss = criterion(logits, trans_feat, label)
-                    logits_jigsaw,_,_ = model(jigsaw_data,jigsaw = True)
+                    logits_jigsaw,_,_ = mp.forward(model,jigsaw_data,jigsaw = True)
                     logits_jigsaw = logits_jigsaw.view(-1,args.k1**3)
                     jigsaw_label = jigsaw_label.view(-1,1)[:,0]
                     loss_jigsaw = F.nll_loss(logits_jigsaw,jigsaw_label)
                     loss_total = loss + args.lambda1 * loss_jigsaw
-                    loss_total.backward()
-                    opt.step()
+                    prof.lap('forward')
+                    mp.backward(loss_total)
+                    prof.lap('backward')
+                    mp.step(opt)
+                    prof.lap('optimizer')
                     preds = logits.max(dim=1)[1]
                     count += batch_size
                     train_loss += loss.item() * batch_size
@@ -273,6 +342,7 @@ def train(args, io):
                     train_loss_jigsaw += loss_jigsaw.item() * batch_size
                     train_true_jigsaw.append(jigsaw_label.cpu().numpy())
                     train_pred_jigsaw.append(preds_jigsaw.detach().cpu().numpy())
+                    prof.lap('metrics')
 
 
         if not args.trades:
@@ -323,20 +393,177 @@ def train(args, io):
                                                                                          train_true, train_pred))
         io.cprint(outstr)
         scheduler.step()
+        prof.lap('epoch_summary')
         
-        test(args,io,model=model, dataloader = test_loader)
-        # io.cprint(outstr)
+        test_acc = None
+        scored = []
+        if evaluator is not None:
+            scored = evaluator.submit(epoch, model, args)
+        else:
+            test_acc = test(args,io,model=model, dataloader = test_loader)
+            # io.cprint(outstr)
+
+            test_train(args,io,model=model, dataloader = train_loader)
+            # io.cprint(outstr)
+
+            if epoch % 10 == 0:
+               adversarial(args,io,model=model, dataloader = test_loader)
+               # io.cprint(outstr)
+        prof.lap('eval')
+
+        checkpoints.save(epoch, model, opt, scheduler, metric=test_acc, pending_metric=evaluator is not None, amp=mp)
+        if evaluator is not None:
+            # test accuracies of earlier epochs reported back by the background evaluation
+            for scored_epoch, metric, _ in scored + evaluator.poll():
+                checkpoints.update_metric(scored_epoch, metric)
+        prof.lap('checkpoint')
+        prof.epoch_end(io, epoch)
+    if evaluator is not None:
+        for scored_epoch, metric, _ in evaluator.close():
+            checkpoints.update_metric(scored_epoch, metric)
+    checkpoints.close()
+    prof.export('checkpoints/%s/profile' % args.exp_name)
+    return model
 
-        test_train(args,io,model=model, dataloader = train_loader)
-        # io.cprint(outstr)
+def atta_train(args, io):
+    '''
+    Adversarial training with accumulated perturbations (ATTA): every sample's
+    perturbation is kept in a bank across epochs, so --atta_iters PGD steps from
+    it replace the --train_iter steps from a random start. The bank is
+    re-randomised every --atta_reset epochs.
+    '''
+    train_set = ATTA_ModelNet40(num_points=args.num_points)
+    train_loader = DataLoader(train_set, num_workers=8,
+                              batch_size=args.batch_size, shuffle=True, drop_last=True)
+    test_loader = DataLoader(ModelNet40(partition='test', num_points=args.num_points), num_workers=8,
+                             batch_size=args.test_batch_size, shuffle=False, drop_last=False)
 
-        if epoch % 10 == 0:
-           adversarial(args,io,model=model, dataloader = test_loader)
-           # io.cprint(outstr)
+    device = torch.device("cuda" if args.cuda else "cpu")
+
+    if args.model == 'pointnet':
+        model = PointNet(args).to(device)
+    elif args.model == 'pointnet_2':
+        model = PointNet_2(args).to(device)
+    elif args.model == 'dgcnn':
+        model = DGCNN(args).to(device)
+    elif args.model == 'set_transformer':
+        model = SetTransformer(args).to(device)
+    elif args.model == 'pointnet_3':
+        model = PointNet_3(args).to(device)
+    else:
+        raise Exception("Not implemented")
+    print(str(model))
+
+    model = nn.DataParallel(model)
+    print("Let's use", torch.cuda.device_count(), "GPUs!")
 
-        torch.save(model.state_dict(), 'checkpoints/%s/models/model_epoch%d.t7' % (args.exp_name,epoch))
+    if args.use_sgd:
+        print("Use SGD")
+        opt = optim.SGD(model.parameters(), lr=args.lr*100, momentum=args.momentum, weight_decay=1e-4)
+    else:
+        print("Use Adam")
+        opt = optim.Adam(model.parameters(), lr=args.lr)
+    scheduler = StepLR(opt, 20, 0.7)
+    criterion = cal_loss
+
+    bank_path = None
+    if args.atta_bank == 'memmap':
+        bank_path = 'checkpoints/%s/atta_bank.npy' % args.exp_name
+    bank = attack.PerturbationBank(len(train_set), args.num_points, EPS, device=device,
+                                   path=bank_path, fold_jitter=args.atta_fold_jitter)
+
+    mp = MixedPrecision(args.amp_train, device, model)
+    prof = StageProfiler(args.profile, sync_cuda=args.profile_sync)
+    if args.profile_modules:
+        prof.attach(model)
+
+    checkpoints = CheckpointManager('checkpoints/%s/models' % args.exp_name, keep_last=args.keep_checkpoints)
+    start_epoch, _ = checkpoints.restore(args.resume, io, model, opt, scheduler, amp=mp, bank=bank)
+
+    for epoch in range(start_epoch, args.epochs):
+        if epoch > 0 and epoch % args.atta_reset == 0:
+            bank.reset()
+            io.cprint('Epoch %d, ATTA perturbations reset' % epoch)
+        train_loss = 0.0
+        count = 0.0
+        model.train()
+        confusion = ConfusionMatrix(device=device)
+
+        prof.reset_lap()
+        for data, label, item, (jitter, perm) in train_loader:
+            prof.lap('data')
+            data, label = data.to(device).permute(0, 2, 1), label.to(device).squeeze()
+            jitter, perm = jitter.to(device), perm.to(device)
+            batch_size = data.size()[0]
+            prof.lap('h2d')
+            prof.count('samples', batch_size)
+
+            start = data + bank.load(item, perm, jitter)
+            adv_data = attack.pgd_continue(model,data,start,label,eps=EPS,alpha=ALPHA,iters=args.atta_iters,amp=args.amp)
+            bank.save(item, perm, adv_data - data, jitter)
+            data = adv_data
+            model.train()
+            prof.lap('pgd')
+            prof.count('pgd_steps', args.atta_iters)
+
+            opt.zero_grad()
+            logits,trans,trans_feat = mp.forward(model,data)
+            loss = criterion(logits, trans_feat, label)
+            prof.lap('forward')
+            mp.backward(loss)
+            prof.lap('backward')
+            mp.step(opt)
+            prof.lap('optimizer')
+            count += batch_size
+            train_loss += loss.item() * batch_size
+            confusion.add_logits(logits.detach(), label)
+            prof.lap('metrics')
+
+        outstr = 'Train %d, loss: %.6f, train acc: %.6f, train avg acc: %.6f' % ((epoch, train_loss*1.0/count) + confusion.summary())
+        io.cprint(outstr)
+        scheduler.step()
+        prof.lap('epoch_summary')
+
+        test_acc = test(args,io,model=model, dataloader = test_loader)
+        test_train(args,io,model=model, dataloader = train_loader)
+        if epoch % 10 == 0:
+            adversarial(args,io,model=model, dataloader = test_loader)
+        prof.lap('eval')
+
+        checkpoints.save(epoch, model, opt, scheduler, metric=test_acc, amp=mp, bank=bank)
+        prof.lap('checkpoint')
+        prof.epoch_end(io, epoch)
+    checkpoints.close()
+    prof.export('checkpoints/%s/profile' % args.exp_name)
     return model
 
+def evaluate_epoch(args, io, model, epoch):
+    '''
+    The per-epoch evaluation of train(), run in the background with --async_eval.
+    The worker process has its own module globals and must not fork loader workers.
+    '''
+    global EPS, ALPHA, TEST_ITER
+    if args.adversarial:
+        EPS=args.eps
+        ALPHA=args.alpha
+        TEST_ITER=args.test_iter
+    if not args.jigsaw:
+        train_set = ModelNet40(partition='train', num_points=args.num_points, rotation=args.rotation, angles=args.angles)
+        test_set = ModelNet40(partition='test', num_points=args.num_points)
+    else:
+        train_set = ModelNet40_Jigsaw(partition='train', num_points=args.num_points, jigsaw=args.jigsaw, k=args.k1)
+        test_set = ModelNet40_Jigsaw(partition='test', num_points=args.num_points)
+    if args.eval_train_subset > 0:
+        train_set = Subset(train_set, range(min(args.eval_train_subset, len(train_set))))
+    train_loader = DataLoader(train_set, batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+    test_loader = DataLoader(test_set, batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+
+    test_acc = test(args,io,model=model, dataloader = test_loader)
+    test_train(args,io,model=model, dataloader = train_loader)
+    if epoch % 10 == 0:
+        adversarial(args,io,model=model, dataloader = test_loader)
+    return test_acc
+
 def test(args, io,model=None, dataloader=None):
 
     if dataloader == None:
@@ -366,23 +593,18 @@ def test(args, io,model=None, dataloader=None):
     model = model.eval()
     test_acc = 0.0
     count = 0.0
-    test_true = []
-    test_pred = []
+    confusion = ConfusionMatrix(device=device)
     for data, label, _, _ in test_loader:
 
         data, label = data.to(device), label.to(device).squeeze()
         data = data.permute(0, 2, 1)
         batch_size = data.size()[0]
         logits,trans,trans_feat = model(data)
-        preds = logits.max(dim=1)[1]
-        test_true.append(label.cpu().numpy())
-        test_pred.append(preds.detach().cpu().numpy())
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
-    test_acc = metrics.accuracy_score(test_true, test_pred)
-    avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
+        confusion.add_logits(logits, label)
+    test_acc, avg_per_class_acc = confusion.summary()
     outstr = 'Test :: test acc: %.6f, test avg acc: %.6f'%(test_acc, avg_per_class_acc)
     io.cprint(outstr)
+    return test_acc
 
 def test_train(args, io,model=None, dataloader=None):
     if dataloader == None:
@@ -412,25 +634,19 @@ def test_train(args, io,model=None, dataloader=None):
     model = model.eval()
     test_acc = 0.0
     count = 0.0
-    test_true = []
-    test_pred = []
+    confusion = ConfusionMatrix(device=device)
     for data, label, _, _ in test_loader:
 
         data, label = data.to(device), label.to(device).squeeze()
         data = data.permute(0, 2, 1)
         batch_size = data.size()[0]
         logits,trans,trans_feat = model(data)
-        preds = logits.max(dim=1)[1]
-        test_true.append(label.cpu().numpy())
-        test_pred.append(preds.detach().cpu().numpy())
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
-    test_acc = metrics.accuracy_score(test_true, test_pred)
-    avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
+        confusion.add_logits(logits, label)
+    test_acc, avg_per_class_acc = confusion.summary()
     outstr = 'Test_train :: test acc: %.6f, test avg acc: %.6f'%(test_acc, avg_per_class_acc)
     io.cprint(outstr)
 
-def adversarial(args,io,model=None, dataloader=None):
+def adversarial(args,io,model=None, dataloader=None, shard_path=None):
     if dataloader == None:
         test_loader = DataLoader(ModelNet40(partition='test', num_points=args.num_points),
                              batch_size=args.test_batch_size, shuffle=True, drop_last=False)
@@ -459,30 +675,111 @@ def adversarial(args,io,model=None, dataloader=None):
     model = model.eval()
     test_acc = 0.0
     count = 0.0
-    test_true = []
-    test_pred = []
+    confusion = ConfusionMatrix(device=device)
     for data, label, _, _ in test_loader:
         data, label = data.to(device), label.to(device).squeeze()
         data = data.permute(0, 2, 1)
         batch_size = data.size()[0]
         adv_data = attack.pgd_attack(model,data,label,eps=EPS,alpha=ALPHA,iters=TEST_ITER,repeat=1,mixup=False)
         logits,trans,trans_feat = model(adv_data)
-        preds = logits.max(dim=1)[1]
-        test_true.append(label.cpu().numpy())
-        test_pred.append(preds.detach().cpu().numpy())
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
-    test_acc = metrics.accuracy_score(test_true, test_pred)
-    avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
+        confusion.add_logits(logits, label)
+    if shard_path is not None:
+        save_shard(shard_path, confusion=confusion.matrix()[None])
+        return
+    test_acc, avg_per_class_acc = confusion.summary()
     outstr = 'Adversarial :: ADV_test acc: %.6f, ADV_test avg acc: %.6f'%(test_acc, avg_per_class_acc)
     io.cprint(outstr)
 
 
+def adversarial_shard(shard, args, path):
+    # spawned workers re-import this module, so the attack globals are back at their defaults
+    global EPS, ALPHA, TEST_ITER
+    EPS=args.eps
+    ALPHA=args.alpha
+    TEST_ITER=args.test_iter
+    io = IOStream(os.path.splitext(path)[0] + '.log')
+    test_loader = shard_loader(ModelNet40(partition='test', num_points=args.num_points),
+                               shard, args.shards, None, args.test_batch_size)
+    adversarial(args,io,model=None,dataloader=test_loader,shard_path=path)
+
+
+def sharded_adversarial(args,io):
+    shard_dir = args.shard_dir if args.shard_dir != '' else 'checkpoints/' + args.exp_name
+    shard_dir = os.path.join(shard_dir, 'shards_' + str(args.eps) + '_' + str(args.test_iter) + '_seed' + str(args.seed))
+    config = {'model_path': args.model_path, 'model': args.model, 'eps': args.eps, 'alpha': args.alpha,
+              'iters': args.test_iter, 'seed': args.seed, 'num_points': args.num_points, 'batch_size': args.test_batch_size}
+    merged = run_shards(adversarial_shard, args, shard_dir, config, io)
+    test_acc, avg_per_class_acc = ConfusionMatrix().merge(merged['confusion'].sum(axis=0)).summary()
+    outstr = 'Adversarial :: ADV_test acc: %.6f, ADV_test avg acc: %.6f (%d shards)'%(test_acc, avg_per_class_acc, args.shards)
+    io.cprint(outstr)
+
+
+def adversarial_sweep(args,io,model=None, dataloader=None):
+    '''
+    Robustness curve over --sweep_eps x --sweep_iters, see attack.pgd_sweep.
+    '''
+    if dataloader == None:
+        test_loader = DataLoader(ModelNet40(partition='test', num_points=args.num_points),
+                             batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+    else:
+        test_loader = dataloader
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+
+    #Try to load models
+    if model is None:
+        if args.model == 'pointnet':
+            model = PointNet(args).to(device)
+        elif args.model == 'pointnet_2':
+            model = PointNet_2(args).to(device)
+        elif args.model == 'dgcnn':
+            model = DGCNN(args).to(device)
+        elif args.model == 'set_transformer':
+            model = SetTransformer(args).to(device)
+        elif args.model == 'pointnet_3':
+            model = PointNet_3(args).to(device)
+        else:
+            raise Exception("Not implemented")
+        model = nn.DataParallel(model) 
+        model.load_state_dict(torch.load(args.model_path))
+
+    model = model.eval()
+    eps_list = sorted(args.sweep_eps)
+    iters_list = sorted(args.sweep_iters if args.sweep_iters else [args.test_iter])
+    clean = 0
+    robust = torch.zeros(len(iters_list), len(eps_list), device=device)
+    count = 0
+    steps = 0
+    for data, label, _, _ in test_loader:
+        data, label = data.to(device), label.to(device).squeeze(-1)
+        data = data.permute(0, 2, 1)
+        clean_correct, correct, batch_steps = attack.pgd_sweep(model,data,label,eps_list,iters_list,alpha_ratio=args.sweep_alpha_ratio,amp=args.amp)
+        clean += clean_correct.sum()
+        robust += correct.sum(dim=2)
+        count += data.size()[0]
+        steps += batch_steps
+    clean_acc = clean.item() / count
+    robust = (robust / count).cpu().numpy()
+    io.cprint('Sweep :: clean acc: %.6f' % clean_acc)
+    for ti, iters in enumerate(iters_list):
+        io.cprint('Sweep :: iters %d :: ' % iters + ', '.join(['eps %.4f: %.6f' % (eps, robust[ti, ei]) for ei, eps in enumerate(eps_list)]))
+    # independent runs would take every sample through every cell
+    independent = count * sum(iters_list) * len(eps_list)
+    io.cprint('Sweep :: %d gradient steps, %.2f%% of independent runs' % (steps, 100. * steps / max(independent, 1)))
+    with open('checkpoints/' + args.exp_name + '/sweep.json', 'w') as f:
+        json.dump({'eps': eps_list, 'iters': iters_list, 'clean_acc': clean_acc, 'robust_acc': robust.tolist()}, f, indent=2)
+    return robust
+
+
 if __name__ == "__main__":
     # Training settings
     parser = argparse.ArgumentParser(description='Point Cloud Recognition')
     parser.add_argument('--exp_name', type=str, default='exp', metavar='N',
                         help='Name of the experiment')
+    parser.add_argument('--resume', type=str, default='',
+                        help='Continue training from a checkpoint: latest, or a model_epoch/state_epoch file')
+    parser.add_argument('--keep_checkpoints', type=int, default=0,
+                        help='Keep only the last N epoch checkpoints plus the best one, 0 keeps all')
     parser.add_argument('--model', type=str, default='dgcnn', metavar='N',
                         choices=['pointnet', 'dgcnn','set_transformer', 'pointnet_2', 'pointnet_3', 'pointnet_jigsaw'],
                         help='Model to use, [pointnet, dgcnn]')
@@ -528,6 +825,10 @@ if __name__ == "__main__":
                         help="Number of steps epochs before resetting ATTA examples")
     parser.add_argument('--adversarial',type=bool,default=False,
                         help="Whether to use adversarial examples")
+    parser.add_argument('--adv_mode',type=str,default='pgd',choices=['pgd','free'],
+                        help="Adversarial training with --adversarial: pgd (train_iter steps per batch) or free (minibatch replay)")
+    parser.add_argument('--free_replays',type=int,default=4,
+                        help="Replays per batch in free adversarial training, divide --epochs by it to keep the clean-training cost")
     parser.add_argument('--fspool_local',type=bool,default=False,
                         help="Whether to use FSPool locally, defaults to max pool")
     parser.add_argument('--fspool_global',type=bool,default=False,
@@ -536,10 +837,18 @@ if __name__ == "__main__":
                         help="Whether to use MLPPool globally, defaults to max pool")
     parser.add_argument('--atta',type=bool,default=False,
                         help="Whether to train using ATTA")
+    parser.add_argument('--atta_iters',type=int,default=1,
+                        help="PGD steps per batch from the stored ATTA perturbation")
+    parser.add_argument('--atta_bank',type=str,default='device',choices=['device','memmap'],
+                        help="Keep the ATTA perturbations on the training device or in a memmap under the checkpoint directory")
+    parser.add_argument('--atta_fold_jitter',type=bool,default=False,
+                        help="Store ATTA perturbations relative to the un-jittered cloud, so they follow the jitter redrawn every epoch")
     parser.add_argument('--set_transformer_maxpool',type=bool,default=False,
                         help="Whether to use maxpool for set_transformer")
     parser.add_argument('--mixup',type=bool,default=False,
                         help="Whether to use mixup")
+    parser.add_argument('--emd_cache', type=int, default=0,
+                        help='Number of mixup EMD assignments cached by (i, j) sample pair, 0 disables')
     parser.add_argument('--cutout',type=bool,default=False,
                         help="Whether to use cutout")
     parser.add_argument('--trades',type=bool,default=False,
@@ -558,7 +867,36 @@ if __name__ == "__main__":
                         help="Hyper-parameter lambda")
     parser.add_argument('--k1', type=int, default=2, metavar='N',
                         help='Hyper-parameter k1')
+    parser.add_argument('--amp', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                        help='Autocast precision for adversarial example generation (bf16 on CPU)')
+    parser.add_argument('--amp_train', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                        help='Mixed-precision training (autocast, fp32 BatchNorm, GradScaler for fp16; bf16 on CPU)')
+    parser.add_argument('--compile', type=str, default='none', choices=BACKENDS,
+                        help='Run the model as a compiled graph: trace (TorchScript), inductor (torch.compile), auto picks the best available')
+    parser.add_argument('--async_eval',type=bool,default=False,
+                        help="Run the per-epoch evaluation in a background process")
+    parser.add_argument('--eval_train_subset',type=int,default=0,
+                        help="Training samples the background test_train pass uses, 0 for all")
+    parser.add_argument('--profile',type=bool,default=False,
+                        help="Log a per-epoch breakdown of data loading, host-to-device copy, attack, forward, backward and eval time")
+    parser.add_argument('--profile_sync',type=bool,default=False,
+                        help="Synchronise CUDA at every stage boundary so kernels are charged to the right stage")
+    parser.add_argument('--profile_modules',type=bool,default=False,
+                        help="Also time forward and backward of every leaf module (implies extra overhead)")
+    parser.add_argument('--sweep',type=bool,default=False,
+                        help="Evaluate a robustness curve over --sweep_eps and --sweep_iters")
+    parser.add_argument('--sweep_eps',type=float,nargs='+',default=[0.025,0.05,0.075,0.1],
+                        help="L_inf budgets of the robustness curve")
+    parser.add_argument('--sweep_iters',type=int,nargs='+',default=[],
+                        help="Attack step budgets of the robustness curve, defaults to --test_iter")
+    parser.add_argument('--sweep_alpha_ratio',type=float,default=0.1,
+                        help="Sweep step size as a fraction of eps")
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split the --eval robustness evaluation over this many worker processes')
+    parser.add_argument('--shard_dir', type=str, default='',
+                        help='Where per-shard predictions are kept (default: the experiment folder), rerunning resumes unfinished shards')
     args = parser.parse_args()
+    distributed.reject_launch(os.path.basename(__file__))
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     _init_()
@@ -590,20 +928,16 @@ if __name__ == "__main__":
             model = train(args,io)
         end = time.time()
         io.cprint("Training took %.6f hours" % ((end - start)/3600))
-    else:
+    elif not args.sweep:
         EPS=args.eps
         ALPHA=args.alpha
         TEST_ITER=args.test_iter
-        adversarial(args,io,model=model)
-    # start = time.time()
-    # if args.model != 'set_transformer': 
-    #     saliency_map(args,io,model=model)
-    # test(args, io,model=model)
-    # TEST_ITER=args.test_iter
-    # for eps in [0.025,0.05,0.075,0.1]:
-    #     print("EPS:",eps)
-    #     EPS=eps
-    #     ALPHA=eps/10
-    #     adversarial(args,io,model=model)
-    # end = time.time()
-    # io.cprint("Evaluation took %.6f hours" % ((end - start)/3600))
+        if args.shards > 1:
+            sharded_adversarial(args,io)
+        else:
+            adversarial(args,io,model=model)
+    if args.sweep:
+        start = time.time()
+        adversarial_sweep(args,io,model=model)
+        end = time.time()
+        io.cprint("Evaluation took %.6f hours" % ((end - start)/3600))
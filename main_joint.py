@@ -22,10 +22,13 @@ from torch.utils.data import DataLoader
 import sys
 sys.path.append("./emd/")
 import emd_module
-from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss
+from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss, MixedPrecision
 import sklearn.metrics as metrics
 import attack
 import time
+from stage_profiler import StageProfiler
+from checkpoint import CheckpointManager
+import distributed
 
 def _init_():
     if not os.path.exists(args.pre_path +'joint_checkpoints'):
@@ -127,9 +130,23 @@ def train(args, io):
 
     criterion = cal_loss
 
+    mp = MixedPrecision(args.amp_train, device, model)
+    prof = StageProfiler(args.profile, sync_cuda=args.profile_sync)
+    if args.profile_modules:
+        prof.attach(model)
+
+    free = None
+    free_aux = None
+    if args.adv_mode == 'free':
+        # the classification input is always attacked here, --adversarial adds the self-supervised input
+        free = attack.FreeAdversary(args.eps, replays=args.free_replays)
+        free_aux = attack.FreeAdversary(args.eps, replays=args.free_replays)
+
+    checkpoints = CheckpointManager(args.pre_path+'joint_checkpoints/%s/models' % args.exp_name, keep_last=args.keep_checkpoints)
+    start_epoch, _ = checkpoints.restore(args.resume, io, model, opt, scheduler, amp=mp)
 
     best_test_acc = 0
-    for epoch in range(args.epochs):
+    for epoch in range(start_epoch, args.epochs):
         ####################
         # Train
         ####################
@@ -150,30 +167,72 @@ def train(args, io):
 
         # test(args,io,model=model, dataloader = test_loader)
 
+        prof.reset_lap()
         for data, label, aug_data, aug_label in train_loader:
+            prof.lap('data')
             # print(rotated_data.shape)
             # print(rotation_label.shape)
             data, label = data.to(device).float(), label.to(device).long().squeeze()
             batch_size, N, C = data.size()
+            prof.count('samples', batch_size)
 
             data = data.permute(0, 2, 1)
             aug_data = aug_data.permute(0, 2, 1)
 
-            if args.rotation:
+            if args.rotation and free is not None:
+                rotated_data, rotation_label = aug_data.to(device).float(), aug_label.to(device).squeeze()
+                prof.lap('h2d')
+                # every replay's backward updates the weights and both perturbations
+                for _ in range(free.replays):
+                    opt.zero_grad()
+                    logits,trans,trans_feat = mp.forward(model,free.perturb(data),rotation = False)
+                    loss = criterion(logits, trans_feat, label)
+                    logits_rotation,_,_ = mp.forward(model,free_aux.perturb(rotated_data) if args.adversarial else rotated_data,rotation = True)
+                    loss_rotation = criterion(logits_rotation,None,rotation_label)
+                    loss_total = loss + args.lambda1 * loss_rotation
+                    prof.lap('forward')
+                    mp.backward(loss_total)
+                    free.step()
+                    if args.adversarial:
+                        free_aux.step()
+                    prof.lap('backward')
+                    mp.step(opt)
+                    prof.lap('optimizer')
+                prof.count('replays', free.replays)
+                preds = logits.max(dim=1)[1]
+                count += batch_size
+                train_loss += loss.item() * batch_size
+                train_true.append(label.cpu().numpy())
+                train_pred.append(preds.detach().cpu().numpy())    
+
+                preds_rotation = logits_rotation.max(dim=1)[1]
+                train_loss_rotation += loss_rotation.item() * batch_size
+                train_true_rotation.append(rotation_label.cpu().numpy())
+                train_pred_rotation.append(preds_rotation.detach().cpu().numpy())    
+                prof.lap('metrics')
+
+            elif args.rotation:
                 rotated_data, rotation_label = aug_data.to(device).float(), aug_label.to(device).squeeze()
+                prof.lap('h2d')
                 if args.adversarial:
                     rotated_data = attack.pgd_attack(model,rotated_data,rotation_label,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False,self=True) 
                     model.train()
+                    prof.count('pgd_steps', args.train_iter)
                 data = attack.pgd_attack(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False) 
                 model.train()
+                prof.lap('pgd')
+                prof.count('pgd_steps', args.train_iter)
                 opt.zero_grad()
-                logits,trans,trans_feat = model(data,rotation = False)
+                logits,trans,trans_feat = mp.forward(model,data,rotation = False)
                 loss = criterion(logits, trans_feat, label)
-                logits_rotation,_,_ = model(rotated_data,rotation = True)
+                logits_rotation,_,_ = mp.forward(model,rotated_data,rotation = True)
                 loss_rotation = criterion(logits_rotation,None,rotation_label)
                 loss_total = loss + args.lambda1 * loss_rotation
-                loss_total.backward()
-                opt.step()
+                prof.lap('forward')
+                mp.backward(loss_total)
+                prof.lap('backward')
+                mp.step(opt)
+                prof.lap('optimizer')
                 preds = logits.max(dim=1)[1]
                 count += batch_size
                 train_loss += loss.item() * batch_size
@@ -184,24 +243,66 @@ def train(args, io):
                 train_loss_rotation += loss_rotation.item() * batch_size
                 train_true_rotation.append(rotation_label.cpu().numpy())
                 train_pred_rotation.append(preds_rotation.detach().cpu().numpy())    
+                prof.lap('metrics')
+
+            elif args.jigsaw and free is not None:
+                jigsaw_data, jigsaw_label = aug_data.to(device).float(), aug_label.to(device).squeeze().long()
+                prof.lap('h2d')
+                # every replay's backward updates the weights and both perturbations
+                for _ in range(free.replays):
+                    opt.zero_grad()
+                    logits,trans,trans_feat = mp.forward(model,free.perturb(data),jigsaw = False)
+                    loss = criterion(logits, trans_feat, label)
+                    logits_jigsaw,_,_ = mp.forward(model,free_aux.perturb(jigsaw_data) if args.adversarial else jigsaw_data,jigsaw = True)
+                    logits_jigsaw = logits_jigsaw.view(-1,args.k1**3)
+                    loss_jigsaw = F.nll_loss(logits_jigsaw,jigsaw_label.view(-1,1)[:,0])
+                    loss_total = loss + args.lambda1 * loss_jigsaw
+                    prof.lap('forward')
+                    mp.backward(loss_total)
+                    free.step()
+                    if args.adversarial:
+                        free_aux.step()
+                    prof.lap('backward')
+                    mp.step(opt)
+                    prof.lap('optimizer')
+                prof.count('replays', free.replays)
+                jigsaw_label = jigsaw_label.view(-1,1)[:,0]
+                preds = logits.max(dim=1)[1]
+                count += batch_size
+                train_loss += loss.item() * batch_size
+                train_true.append(label.cpu().numpy())
+                train_pred.append(preds.detach().cpu().numpy())    
+
+                preds_jigsaw = logits_jigsaw.max(dim=1)[1]
+                train_loss_jigsaw += loss_jigsaw.item() * batch_size
+                train_true_jigsaw.append(jigsaw_label.cpu().numpy())
+                train_pred_jigsaw.append(preds_jigsaw.detach().cpu().numpy())
+                prof.lap('metrics')
 
             elif args.jigsaw:             
                 jigsaw_data, jigsaw_label = aug_data.to(device).float(), aug_label.to(device).squeeze().long()
+                prof.lap('h2d')
                 if args.adversarial:
                     jigsaw_data = attack.pgd_attack_seg(model,jigsaw_data,jigsaw_label,args.k1**3,eps=args.eps,alpha=args.alpha,iters=args.train_iter,self=True) 
                     model.train()
+                    prof.count('pgd_steps', args.train_iter)
                 data = attack.pgd_attack(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False) 
                 model.train()
+                prof.lap('pgd')
+                prof.count('pgd_steps', args.train_iter)
                 opt.zero_grad()
-                logits,trans,trans_feat = model(data,jigsaw = False)
+                logits,trans,trans_feat = mp.forward(model,data,jigsaw = False)
                 loss = criterion(logits, trans_feat, label)
-                logits_jigsaw,_,_ = model(jigsaw_data,jigsaw = True)
+                logits_jigsaw,_,_ = mp.forward(model,jigsaw_data,jigsaw = True)
                 logits_jigsaw = logits_jigsaw.view(-1,args.k1**3)
                 jigsaw_label = jigsaw_label.view(-1,1)[:,0]
                 loss_jigsaw = F.nll_loss(logits_jigsaw,jigsaw_label)
                 loss_total = loss + args.lambda1 * loss_jigsaw
-                loss_total.backward()
-                opt.step()
+                prof.lap('forward')
+                mp.backward(loss_total)
+                prof.lap('backward')
+                mp.step(opt)
+                prof.lap('optimizer')
                 preds = logits.max(dim=1)[1]
                 count += batch_size
                 train_loss += loss.item() * batch_size
@@ -212,6 +313,7 @@ def train(args, io):
                 train_loss_jigsaw += loss_jigsaw.item() * batch_size
                 train_true_jigsaw.append(jigsaw_label.cpu().numpy())
                 train_pred_jigsaw.append(preds_jigsaw.detach().cpu().numpy())
+                prof.lap('metrics')
 
         if args.rotation:
             train_true_rotation = np.concatenate(train_true_rotation)
@@ -253,6 +355,7 @@ def train(args, io):
                                                                                      )
         io.cprint(outstr)
         scheduler.step()
+        prof.lap('epoch_summary')
         
         test(args,io,model=model, dataloader = test_loader)
 
@@ -263,7 +366,11 @@ def train(args, io):
             adversarial(args,io,model=model, dataloader = test_loader)
             # io.cprint(outstr)
 
-            torch.save(model.state_dict(), args.pre_path+'joint_checkpoints/%s/models/model_epoch%d.t7' % (args.exp_name,epoch))
+            checkpoints.save(epoch, model, opt, scheduler, amp=mp)
+        prof.lap('eval')
+        prof.epoch_end(io, epoch)
+    checkpoints.close()
+    prof.export(args.pre_path+'joint_checkpoints/%s/profile' % args.exp_name)
     return model
 
 def test(args, io,model=None, dataloader=None):
@@ -409,6 +516,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Point Cloud Recognition')
     parser.add_argument('--exp_name', type=str, default='exp', metavar='N',
                         help='Name of the experiment')
+    parser.add_argument('--resume', type=str, default='',
+                        help='Continue training from a checkpoint: latest, or a model_epoch/state_epoch file')
+    parser.add_argument('--keep_checkpoints', type=int, default=0,
+                        help='Keep only the last N epoch checkpoints plus the best one, 0 keeps all')
     parser.add_argument('--model', type=str, default='dgcnn', metavar='N',
                         choices=['pointnet', 'dgcnn', 'pct'],
                         help='Model to use, [pointnet, dgcnn]')
@@ -453,6 +564,10 @@ if __name__ == "__main__":
                         help="Number of steps taken to create adversarial test inputs")
     parser.add_argument('--adversarial',type=bool,default=False,
                         help="Whether to use adversarial examples")
+    parser.add_argument('--adv_mode',type=str,default='pgd',choices=['pgd','free'],
+                        help="Adversarial training: pgd (train_iter steps per batch) or free (minibatch replay)")
+    parser.add_argument('--free_replays',type=int,default=4,
+                        help="Replays per batch in free adversarial training, divide --epochs by it to keep the clean-training cost")
     parser.add_argument('--gpu',type=str,default='0',
                         help="Which gpu to use")
     parser.add_argument('--scheduler',type=str,default='default',
@@ -469,7 +584,16 @@ if __name__ == "__main__":
                         help="Hyper-parameter lambda")
     parser.add_argument('--k1', type=int, default=2, metavar='N',
                         help='Hyper-parameter k1')
+    parser.add_argument('--amp_train', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                        help='Mixed-precision training (autocast, fp32 BatchNorm, GradScaler for fp16; bf16 on CPU)')
+    parser.add_argument('--profile',type=bool,default=False,
+                        help="Log a per-epoch breakdown of data loading, host-to-device copy, attack, forward, backward and eval time")
+    parser.add_argument('--profile_sync',type=bool,default=False,
+                        help="Synchronise CUDA at every stage boundary so kernels are charged to the right stage")
+    parser.add_argument('--profile_modules',type=bool,default=False,
+                        help="Also time forward and backward of every leaf module (implies extra overhead)")
     args = parser.parse_args()
+    distributed.reject_launch(os.path.basename(__file__))
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     _init_()
@@ -21,6 +21,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from util import sample_and_group 
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 from modules import ISAB, PMA, SAB
 
 class Dual_BN(nn.Module):
@@ -270,13 +271,8 @@ class Pct_Rotation(nn.Module):
         # new_xyz, new_feature = sample_and_group(npoint=256, radius=0.2, nsample=32, xyz=new_xyz, points=feature) 
         # feature_1 = self.gather_local_1(new_feature)
 
-        x = get_graph_feature(x, k=32)
-        x = self.seq1(x)
-        x1 = self.pool1(x)
-
-        x = get_graph_feature(x1, k=32)
-        x = self.seq2(x)
-        feature_1 = self.pool1(x)
+        x1 = edge_conv(self, 'graph1', x, 32, self.seq1, self.pool1)
+        feature_1 = edge_conv(self, 'graph2', x1, 32, self.seq2, self.pool1)
 
         x = self.pt_last(feature_1)
         x = torch.cat([x, feature_1], dim=1)
@@ -349,13 +345,8 @@ class Pct_Jigsaw(nn.Module):
         # feature = feature_0.permute(0, 2, 1)
         # new_xyz, new_feature = sample_and_group(npoint=256, radius=0.2, nsample=32, xyz=new_xyz, points=feature) 
         # feature_1 = self.gather_local_1(new_feature)
-        x = get_graph_feature(x, k=32)
-        x = self.seq1(x)
-        x1 = self.pool1(x)
-
-        x = get_graph_feature(x1, k=32)
-        x = self.seq2(x)
-        feature_1 = self.pool1(x)
+        x1 = edge_conv(self, 'graph1', x, 32, self.seq1, self.pool1)
+        feature_1 = edge_conv(self, 'graph2', x1, 32, self.seq2, self.pool1)
 
         x = self.pt_last(feature_1)
         x = torch.cat([x, feature_1], dim=1)
@@ -480,13 +471,8 @@ class Pct(nn.Module):
         x = F.relu(self.bn2(self.conv2(x)))
         # x = x.permute(0, 2, 1)
 
-        x = get_graph_feature(x, k=32)
-        x = self.seq1(x)
-        x1 = self.pool1(x)
-
-        x = get_graph_feature(x1, k=32)
-        x = self.seq2(x)
-        feature_1 = self.pool1(x)
+        x1 = edge_conv(self, 'graph1', x, 32, self.seq1, self.pool1)
+        feature_1 = edge_conv(self, 'graph2', x1, 32, self.seq2, self.pool1)
         # print(feature_1.shape)
         # x = x.permute(0, 2, 1)
         # new_xyz, new_feature = sample_and_group(npoint=512, radius=0.15, nsample=32, xyz=xyz, points=x)         
@@ -533,10 +519,10 @@ class Point_Transformer_Last(nn.Module):
         # B, D, N
         x = F.relu(self.bn1(self.conv1(x)))
         x = F.relu(self.bn2(self.conv2(x)))
-        x1 = self.sa1(x)
-        x2 = self.sa2(x1)
-        x3 = self.sa3(x2)
-        x4 = self.sa4(x3)
+        x1 = run_block(self, 'sa1', self.sa1, [self.sa1], x)
+        x2 = run_block(self, 'sa2', self.sa2, [self.sa2], x1)
+        x3 = run_block(self, 'sa3', self.sa3, [self.sa3], x2)
+        x4 = run_block(self, 'sa4', self.sa4, [self.sa4], x3)
         x = torch.cat((x1, x2, x3, x4), dim=1)
 
         return x
@@ -664,7 +650,7 @@ def get_graph_feature(x, k=20, idx=None):
     x = x.view(batch_size, -1, num_points)
     if idx is None:
         idx = knn(x, k=k)   # (batch_size, num_points, k)
-    device = torch.device('cuda')
+    device = x.device
 
     idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1)*num_points
 
@@ -684,6 +670,74 @@ def get_graph_feature(x, k=20, idx=None):
     return feature
 
 
+CHECKPOINT_BLOCKS = {'dgcnn': ['edge1', 'edge2', 'edge3', 'edge4'],
+                     'pct': ['graph1', 'graph2', 'sa1', 'sa2', 'sa3', 'sa4']}
+
+def _checkpointed(fn, modules, *inputs):
+    # BatchNorm layers of modules would update their running statistics again
+    # when backward recomputes fn, so the recomputation runs on throwaway copies
+    # of them (the recomputed graph saves those tensors, they must not be
+    # modified in place afterwards)
+    norms = [m for module in modules for m in module.modules()
+             if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    calls = [0]
+    def run(dummy, *args):
+        calls[0] += 1
+        if calls[0] == 1:
+            return fn(*args)
+        saved = [(m.running_mean, m.running_var, m.num_batches_tracked) for m in norms]
+        for m, (mean, var, n) in zip(norms, saved):
+            m.running_mean, m.running_var, m.num_batches_tracked = mean.clone(), var.clone(), n.clone()
+        try:
+            return fn(*args)
+        finally:
+            for m, (mean, var, n) in zip(norms, saved):
+                m.running_mean, m.running_var, m.num_batches_tracked = mean, var, n
+    # an input that requires grad, otherwise the parameters inside fn get no
+    # gradient when x itself does not require one (clean training)
+    dummy = torch.ones(1, device=inputs[0].device, requires_grad=True)
+    return checkpoint(run, dummy, *inputs)
+
+def run_block(model, name, fn, modules, *inputs):
+    """
+    fn(*inputs); if name is one of model's checkpointed blocks the activations
+    inside fn are not kept for backward but recomputed from inputs.
+    """
+    if name in getattr(model, 'checkpoint_blocks', ()) and torch.is_grad_enabled():
+        return _checkpointed(fn, modules, *inputs)
+    return fn(*inputs)
+
+def edge_conv(model, name, x, k, conv, pool):
+    # graph feature -> conv -> max over neighbours, (B, C, N, k) in between
+    return run_block(model, name, lambda t: pool(conv(get_graph_feature(t, k=k))), [conv], x)
+
+def set_activation_checkpointing(model, blocks):
+    """
+    Trade compute for memory in DGCNN, DGCNN_Rotation, DGCNN_Jigsaw (blocks
+    edge1-edge4) and Pct, Pct_Rotation, Pct_Jigsaw (graph1, graph2, sa1-sa4).
+    blocks is a comma separated list of those names, 'all', or '' / 'none'.
+    """
+    if isinstance(model, (DGCNN, DGCNN_Rotation, DGCNN_Jigsaw)):
+        names = CHECKPOINT_BLOCKS['dgcnn']
+    elif isinstance(model, (Pct, Pct_Rotation, Pct_Jigsaw)):
+        names = CHECKPOINT_BLOCKS['pct']
+    else:
+        names = []
+    if blocks in ('', 'none'):
+        chosen = []
+    elif blocks == 'all':
+        chosen = names
+    else:
+        chosen = blocks.split(',')
+    unknown = [b for b in chosen if b not in names]
+    if len(unknown) > 0:
+        raise Exception("%s has no checkpointable blocks %s" % (type(model).__name__, ','.join(unknown)))
+    model.checkpoint_blocks = set(chosen)
+    if hasattr(model, 'pt_last'):
+        model.pt_last.checkpoint_blocks = model.checkpoint_blocks
+    return model
+
+
 class MLPPool(nn.Module):
     def __init__(self,num_in_features,num_out_features,num_points):
         super().__init__()
@@ -1147,21 +1201,11 @@ class DGCNN(nn.Module):
     
     def forward(self, x):
         batch_size = x.size(0)
-        x = get_graph_feature(x, k=self.k)
-        x = self.conv1(x)
-        x1 = self.pool1(x)
+        x1 = edge_conv(self, 'edge1', x, self.k, self.conv1, self.pool1)
+        x2 = edge_conv(self, 'edge2', x1, self.k, self.conv2, self.pool2)
 
-        x = get_graph_feature(x1, k=self.k)
-        x = self.conv2(x)
-        x2 = self.pool2(x)
-
-        x = get_graph_feature(x2, k=self.k)
-        x = self.conv3(x)
-        x3 = self.pool3(x)
-
-        x = get_graph_feature(x3, k=self.k)
-        x = self.conv4(x)
-        x4 = self.pool4(x)
+        x3 = edge_conv(self, 'edge3', x2, self.k, self.conv3, self.pool3)
+        x4 = edge_conv(self, 'edge4', x3, self.k, self.conv4, self.pool4)
 
         x = torch.cat((x1, x2, x3, x4), dim=1)
 
@@ -1244,21 +1288,11 @@ class DGCNN_Rotation(nn.Module):
     
     def forward(self, x):
         batch_size = x.size(0)
-        x = get_graph_feature(x, k=self.k)
-        x = self.conv1(x)
-        x1 = self.pool1(x)
+        x1 = edge_conv(self, 'edge1', x, self.k, self.conv1, self.pool1)
+        x2 = edge_conv(self, 'edge2', x1, self.k, self.conv2, self.pool2)
 
-        x = get_graph_feature(x1, k=self.k)
-        x = self.conv2(x)
-        x2 = self.pool2(x)
-
-        x = get_graph_feature(x2, k=self.k)
-        x = self.conv3(x)
-        x3 = self.pool3(x)
-
-        x = get_graph_feature(x3, k=self.k)
-        x = self.conv4(x)
-        x4 = self.pool4(x)
+        x3 = edge_conv(self, 'edge3', x2, self.k, self.conv3, self.pool3)
+        x4 = edge_conv(self, 'edge4', x3, self.k, self.conv4, self.pool4)
 
         x = torch.cat((x1, x2, x3, x4), dim=1)
 
@@ -1462,23 +1496,13 @@ class DGCNN_Jigsaw(nn.Module):
     
     def forward(self, x):
         batch_size = x.size(0)
-        x = get_graph_feature(x, k=self.k)
-        x = self.conv1(x)
-        x1 = self.pool1(x)
-
-        x = get_graph_feature(x1, k=self.k)
-        x = self.conv2(x)
-        x2 = self.pool2(x)
+        x1 = edge_conv(self, 'edge1', x, self.k, self.conv1, self.pool1)
+        x2 = edge_conv(self, 'edge2', x1, self.k, self.conv2, self.pool2)
 
         pointfeat = x2
 
-        x = get_graph_feature(x2, k=self.k)
-        x = self.conv3(x)
-        x3 = self.pool3(x)
-
-        x = get_graph_feature(x3, k=self.k)
-        x = self.conv4(x)
-        x4 = self.pool4(x)
+        x3 = edge_conv(self, 'edge3', x2, self.k, self.conv3, self.pool3)
+        x4 = edge_conv(self, 'edge4', x3, self.k, self.conv4, self.pool4)
 
         x = torch.cat((x1, x2, x3, x4), dim=1)
 
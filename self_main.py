@@ -18,16 +18,22 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.optim.lr_scheduler import CosineAnnealingLR, ExponentialLR, StepLR, MultiStepLR, ReduceLROnPlateau
 from data import PCData_SSL, PCData, PCData_Jigsaw
-from model_finetune import PointNet_Rotation, DGCNN_Rotation, PointNet_Jigsaw, DGCNN_Jigsaw, DeepSym_Rotation, DeepSym_Jigsaw, Pct_Jigsaw, Pct_Rotation, PointNet_Simple_Rotation, PointNet_Simple_Jigsaw, DGCNN_Noise, PointNet_Simple_Noise
+from model_finetune import PointNet_Rotation, DGCNN_Rotation, PointNet_Jigsaw, DGCNN_Jigsaw, DeepSym_Rotation, DeepSym_Jigsaw, Pct_Jigsaw, Pct_Rotation, PointNet_Simple_Rotation, PointNet_Simple_Jigsaw, DGCNN_Noise, PointNet_Simple_Noise, set_activation_checkpointing
 import numpy as np
 from torch.utils.data import DataLoader
 import sys
 sys.path.append("./emd/")
 import emd_module
-from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss
+from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss, MixedPrecision
 import sklearn.metrics as metrics
 import attack
 import time
+from shard_eval import run_shards, save_shard, shard_loader
+from stream_metrics import ConfusionMatrix
+from async_eval import AsyncEvaluator
+from stage_profiler import StageProfiler
+from checkpoint import CheckpointManager
+import distributed
 
 def _init_():
     if not os.path.exists(args.pre_path + 'ssl_checkpoints'):
@@ -100,6 +106,7 @@ def train(args, io):
                     
     print(str(model))
 
+    set_activation_checkpointing(model, args.checkpoint_blocks)
     model = nn.DataParallel(model)
     print("Let's use", torch.cuda.device_count(), "GPUs!")
 
@@ -124,9 +131,20 @@ def train(args, io):
 
     criterion = cal_loss
 
+    evaluator = None
+    if args.async_eval:
+        evaluator = AsyncEvaluator(model, evaluate_epoch, args.pre_path + 'ssl_checkpoints/' + args.exp_name + '/run.log')
+
+    mp = MixedPrecision(args.amp_train, device, model)
+    prof = StageProfiler(args.profile, sync_cuda=args.profile_sync)
+    if args.profile_modules:
+        prof.attach(model)
+
+    checkpoints = CheckpointManager(args.pre_path + 'ssl_checkpoints/%s/models' % args.exp_name, keep_last=args.keep_checkpoints)
+    start_epoch, _ = checkpoints.restore(args.resume, io, model, opt, scheduler, amp=mp)
 
     best_test_acc = 0
-    for epoch in range(args.epochs):
+    for epoch in range(start_epoch, args.epochs):
         ####################
         # Train
         ####################
@@ -142,7 +160,9 @@ def train(args, io):
             train_pred_jigsaw = []
             train_true_jigsaw = []
 
+        prof.reset_lap()
         for aug_data, aug_label in train_loader:
+            prof.lap('data')
             # print(rotated_data.shape)
             # print(rotation_label.shape)
             # data, label = data.to(device), label.to(device).squeeze()
@@ -152,23 +172,30 @@ def train(args, io):
 
             if args.rotation or args.noise:
                 rotated_data, rotation_label = aug_data.to(device).float(), aug_label.to(device).squeeze()
+                prof.lap('h2d')
+                prof.count('samples', batch_size)
                 if args.adversarial:
                     if not args.feature:
                         rotated_data = attack.pgd_attack(model,rotated_data,rotation_label,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False) 
                     else:
-                        _,feature_interest_clean,_ = model(rotated_data)
+                        _,feature_interest_clean,_ = mp.forward(model,rotated_data)
                         rotated_data = attack.pgd_attack_feature(model,rotated_data,feature_interest_clean,eps=args.eps,alpha=args.alpha,iters=args.train_iter,mixup=False) 
                     model.train()
+                    prof.lap('pgd')
+                    prof.count('pgd_steps', args.train_iter)
                 opt.zero_grad()
-                logits_rotation,feature_interest,trans_feat = model(rotated_data)
+                logits_rotation,feature_interest,trans_feat = mp.forward(model,rotated_data)
 
                 if args.feature and args.adversarial:
                     loss_tv = torch.mean(torch.abs(feature_interest_clean - feature_interest))
                 else:
                     loss_tv = 0
                 loss_rotation = criterion(logits_rotation,trans_feat,rotation_label) + loss_tv
-                loss_rotation.backward()
-                opt.step()
+                prof.lap('forward')
+                mp.backward(loss_rotation)
+                prof.lap('backward')
+                mp.step(opt)
+                prof.lap('optimizer')
                 # preds = logits.max(dim=1)[1]
                 count += batch_size 
 
@@ -176,18 +203,23 @@ def train(args, io):
                 train_loss_rotation += loss_rotation.item() * batch_size
                 train_true_rotation.append(rotation_label.cpu().numpy())
                 train_pred_rotation.append(preds_rotation.detach().cpu().numpy())    
+                prof.lap('metrics')
 
             elif args.jigsaw:             
                 jigsaw_data, jigsaw_label = aug_data.to(device).float(), aug_label.to(device).squeeze().long()
+                prof.lap('h2d')
+                prof.count('samples', batch_size)
                 if args.adversarial:
                     if not args.feature:
                         jigsaw_data = attack.pgd_attack_seg(model,jigsaw_data,jigsaw_label,args.k1**3,eps=args.eps,alpha=args.alpha,iters=args.train_iter) 
                     else:
-                        _,feature_interest_clean,_ = model(jigsaw_data)
+                        _,feature_interest_clean,_ = mp.forward(model,jigsaw_data)
                         jigsaw_data = attack.pgd_attack_seg_feature(model,jigsaw_data,feature_interest_clean,args.k1**3,eps=args.eps,alpha=args.alpha,iters=args.train_iter) 
                     model.train()
+                    prof.lap('pgd')
+                    prof.count('pgd_steps', args.train_iter)
                 opt.zero_grad()
-                logits_jigsaw,feature_interest,_ = model(jigsaw_data)
+                logits_jigsaw,feature_interest,_ = mp.forward(model,jigsaw_data)
                 logits_jigsaw = logits_jigsaw.view(-1,args.k1**3)
                 jigsaw_label = jigsaw_label.view(-1,1)[:,0]
 
@@ -197,14 +229,18 @@ def train(args, io):
                     loss_tv = 0
 
                 loss_jigsaw = F.nll_loss(logits_jigsaw,jigsaw_label) + loss_tv
-                loss_jigsaw.backward()
-                opt.step()
+                prof.lap('forward')
+                mp.backward(loss_jigsaw)
+                prof.lap('backward')
+                mp.step(opt)
+                prof.lap('optimizer')
                 count += batch_size   
 
                 preds_jigsaw = logits_jigsaw.max(dim=1)[1]
                 train_loss_jigsaw += loss_jigsaw.item() * batch_size
                 train_true_jigsaw.append(jigsaw_label.cpu().numpy())
                 train_pred_jigsaw.append(preds_jigsaw.detach().cpu().numpy())
+                prof.lap('metrics')
 
 
 
@@ -245,8 +281,13 @@ def train(args, io):
 
         io.cprint(outstr)
         scheduler.step()
+        prof.lap('epoch_summary')
         
-        test(args,io,model=model, dataloader = test_loader)
+        if evaluator is not None:
+            evaluator.submit(epoch, model, args)
+        else:
+            test(args,io,model=model, dataloader = test_loader)
+        prof.lap('eval')
         # io.cprint(outstr)
 
         # test_train(args,io,model=model, dataloader = train_loader)
@@ -256,9 +297,25 @@ def train(args, io):
             # adversarial(args,io,model=model, dataloader = test_loader)
             # io.cprint(outstr)
 
-            torch.save(model.state_dict(), args.pre_path + 'ssl_checkpoints/%s/models/model_epoch%d.t7' % (args.exp_name,epoch))
+            checkpoints.save(epoch, model, opt, scheduler, amp=mp)
+        prof.lap('checkpoint')
+        prof.epoch_end(io, epoch)
+    checkpoints.close()
+    prof.export(args.pre_path + 'ssl_checkpoints/%s/profile' % args.exp_name)
+    if evaluator is not None:
+        evaluator.close()
     return model
 
+def evaluate_epoch(args, io, model, epoch):
+    '''
+    The per-epoch evaluation of train(), run in the background with --async_eval.
+    '''
+    # no loader workers, the evaluator process is daemonic
+    test_loader = DataLoader(PCData_SSL(name=args.dataset,partition='test', num_points=args.num_points, rotation=args.rotation, angles=args.angles, jigsaw=args.jigsaw, k=args.k1, 
+                             noise=args.noise, level=args.level),
+                             batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+    test(args,io,model=model, dataloader = test_loader)
+
 def test(args, io,model=None, dataloader=None):
 
     if dataloader == None:
@@ -303,8 +360,7 @@ def test(args, io,model=None, dataloader=None):
     model = model.eval()
     test_acc = 0.0
     count = 0.0
-    test_true = []
-    test_pred = []
+    confusion = ConfusionMatrix(device=device)
     for data, label in test_loader:
 
         data, label = data.to(device).float(), label.to(device).squeeze()
@@ -315,18 +371,13 @@ def test(args, io,model=None, dataloader=None):
             logits = logits.view(-1,args.k1**3)
             label = label.view(-1,1)[:,0]
 
-        preds = logits.max(dim=1)[1]
-        test_true.append(label.cpu().numpy())
-        test_pred.append(preds.detach().cpu().numpy())
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
-    test_acc = metrics.accuracy_score(test_true, test_pred)
-    avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
+        confusion.add_logits(logits, label)
+    test_acc, avg_per_class_acc = confusion.summary()
     outstr = 'Test :: test acc: %.6f, test avg acc: %.6f'%(test_acc, avg_per_class_acc)
     io.cprint(outstr)
 
 
-def adversarial(args,io,model=None, dataloader=None):
+def adversarial(args,io,model=None, dataloader=None, shard_path=None):
 
     if dataloader == None:
         test_loader = DataLoader(PCData_SSL(name=args.dataset,partition='test', num_points=args.num_points, rotation=args.rotation, angles=args.angles, jigsaw=args.jigsaw, k=args.k1,
@@ -371,24 +422,38 @@ def adversarial(args,io,model=None, dataloader=None):
     model = model.eval()
     test_acc = 0.0
     count = 0.0
-    test_true = []
-    test_pred = []
+    confusion = ConfusionMatrix(device=device)
     for data, label in test_loader:
         data, label = data.to(device).float(), label.to(device).squeeze()
         data = data.permute(0, 2, 1)
         batch_size = data.size()[0]
         adv_data = attack.pgd_attack(model,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
         logits,trans,trans_feat = model(adv_data)
-        preds = logits.max(dim=1)[1]
-        test_true.append(label.cpu().numpy())
-        test_pred.append(preds.detach().cpu().numpy())
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
-    test_acc = metrics.accuracy_score(test_true, test_pred)
-    avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
+        confusion.add_logits(logits, label)
+    if shard_path is not None:
+        save_shard(shard_path, confusion=confusion.matrix()[None])
+        return
+    test_acc, avg_per_class_acc = confusion.summary()
     outstr = 'Adversarial :: ADV_test acc: %.6f, ADV_test avg acc: %.6f'%(test_acc, avg_per_class_acc)
     io.cprint(outstr)
 
+def adversarial_shard(shard, args, path):
+    io = IOStream(os.path.splitext(path)[0] + '.log')
+    test_loader = shard_loader(PCData_SSL(name=args.dataset,partition='test', num_points=args.num_points, rotation=args.rotation, angles=args.angles, jigsaw=args.jigsaw, k=args.k1,
+                             noise=args.noise, level=args.level),
+                               shard, args.shards, None, args.test_batch_size)
+    adversarial(args,io,model=None,dataloader=test_loader,shard_path=path)
+
+def sharded_adversarial(args,io):
+    shard_dir = args.shard_dir if args.shard_dir != '' else args.pre_path + 'ssl_checkpoints/' + args.exp_name
+    shard_dir = os.path.join(shard_dir, 'shards_' + str(args.eps) + '_' + str(args.test_iter) + '_seed' + str(args.seed))
+    config = {'model_path': args.model_path, 'model': args.model, 'eps': args.eps, 'alpha': args.alpha,
+              'iters': args.test_iter, 'seed': args.seed, 'num_points': args.num_points, 'batch_size': args.test_batch_size}
+    merged = run_shards(adversarial_shard, args, shard_dir, config, io)
+    test_acc, avg_per_class_acc = ConfusionMatrix().merge(merged['confusion'].sum(axis=0)).summary()
+    outstr = 'Adversarial :: ADV_test acc: %.6f, ADV_test avg acc: %.6f (%d shards)'%(test_acc, avg_per_class_acc, args.shards)
+    io.cprint(outstr)
+
 
 if __name__ == "__main__":
     # Training settings
@@ -397,6 +462,10 @@ if __name__ == "__main__":
                         help='Name of the experiment')
     parser.add_argument('--exp_name', type=str, default='exp', metavar='N',
                         help='Name of the experiment')
+    parser.add_argument('--resume', type=str, default='',
+                        help='Continue training from a checkpoint: latest, or a model_epoch/state_epoch file')
+    parser.add_argument('--keep_checkpoints', type=int, default=0,
+                        help='Keep only the last N epoch checkpoints plus the best one, 0 keeps all')
     parser.add_argument('--model', type=str, default='dgcnn', metavar='N',
                         choices=['pointnet_rotation', 'dgcnn_rotation', 'pointnet_jigsaw', 'dgcnn_jigsaw', 'deepsym_jigsaw', 'deepsym_rotation','pct_rotation',
                             'pct_jigsaw','pointnet_simple_rotation','pointnet_simple_jigsaw','dgcnn_noise','pointnet_simple_noise'],
@@ -460,7 +529,24 @@ if __name__ == "__main__":
                         help='Hyper-parameter noise level')
     parser.add_argument('--scheduler',type=str,default='default',
                         help="Which lr scheduler to use")
+    parser.add_argument('--async_eval',type=bool,default=False,
+                        help="Run the per-epoch evaluation in a background process")
+    parser.add_argument('--amp_train', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                        help='Mixed-precision training (autocast, fp32 BatchNorm, GradScaler for fp16; bf16 on CPU)')
+    parser.add_argument('--checkpoint_blocks', type=str, default='',
+                        help='Recompute these blocks in backward instead of storing activations: all, or comma separated edge1-edge4 (dgcnn) / graph1,graph2,sa1-sa4 (pct)')
+    parser.add_argument('--profile',type=bool,default=False,
+                        help="Log a per-epoch breakdown of data loading, host-to-device copy, attack, forward, backward and eval time")
+    parser.add_argument('--profile_sync',type=bool,default=False,
+                        help="Synchronise CUDA at every stage boundary so kernels are charged to the right stage")
+    parser.add_argument('--profile_modules',type=bool,default=False,
+                        help="Also time forward and backward of every leaf module (implies extra overhead)")
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split the --eval robustness evaluation over this many worker processes')
+    parser.add_argument('--shard_dir', type=str, default='',
+                        help='Where per-shard predictions are kept (default: the experiment folder), rerunning resumes unfinished shards')
     args = parser.parse_args()
+    distributed.reject_launch(os.path.basename(__file__))
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     _init_()
@@ -486,6 +572,8 @@ if __name__ == "__main__":
         model=train(args,io)
         end = time.time()
         io.cprint("Training took %.6f hours" % ((end - start)/3600))
+    elif args.shards > 1:
+        sharded_adversarial(args,io)
     else:
         pass
         # EPS=args.eps
@@ -0,0 +1,123 @@
+'''
+Description: split a test-set evaluation over worker processes and merge the per-shard predictions
+Autor: Jiachen Sun
+Date: 2021-08-09 09:41:27
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-09 15:02:46
+'''
+import os
+import json
+import random
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+
+def shard_bounds(n, shard, shards):
+    """
+    Contiguous [start, end) slice of range(n) owned by shard, sizes differ by at most one.
+    """
+    base, extra = divmod(n, shards)
+    start = shard * base + min(shard, extra)
+    end = start + base + (1 if shard < extra else 0)
+    return start, end
+
+
+def shard_seed(seed, shard):
+    return seed * 1000003 + shard
+
+
+def shard_loader(dataset, shard, shards, total, batch_size, num_workers=8):
+    """
+    Loader over this shard's part of the first `total` samples, in dataset order.
+    """
+    n = min(total, len(dataset)) if total is not None else len(dataset)
+    start, end = shard_bounds(n, shard, shards)
+    return DataLoader(Subset(dataset, range(start, end)), num_workers=num_workers,
+                      batch_size=batch_size, shuffle=False, drop_last=False)
+
+
+def shard_file(shard_dir, shard, shards):
+    return os.path.join(shard_dir, 'shard_%03d_of_%03d.npz' % (shard, shards))
+
+
+def save_shard(path, **arrays):
+    # written under a temporary name so a killed worker never leaves a file that looks finished
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+def merge_shards(shard_dir, shards):
+    """
+    Concatenate every array over the shards in shard order, 0-d arrays (sums) are added up.
+    """
+    merged = {}
+    for shard in range(shards):
+        with np.load(shard_file(shard_dir, shard, shards)) as f:
+            for name in f.files:
+                merged.setdefault(name, []).append(f[name])
+    for name, parts in merged.items():
+        if parts[0].ndim == 0:
+            merged[name] = np.sum(parts)
+        else:
+            merged[name] = np.concatenate(parts, axis=0)
+    return merged
+
+
+def _shard_main(fn, shard, args, path):
+    # pin the worker to one device before anything touches CUDA
+    if args.cuda:
+        gpus = args.gpu.split(',')
+        os.environ['CUDA_VISIBLE_DEVICES'] = gpus[shard % len(gpus)]
+    else:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.shards))
+    args.shard = shard
+    args.seed = shard_seed(args.seed, shard)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.cuda:
+        torch.cuda.manual_seed_all(args.seed)
+    fn(shard, args, path)
+
+
+def run_shards(fn, args, shard_dir, config, io=None):
+    """
+    Run fn(shard, args, path) for every shard of args.shards without a finished
+    file in shard_dir, one spawned process each, and return the merged arrays.
+    fn must save its predictions to path with save_shard. Rerunning with the same
+    config resumes: finished shards are kept and only the missing ones are rerun.
+    """
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    config_path = os.path.join(shard_dir, 'config.json')
+    config = json.loads(json.dumps(dict(config, shards=args.shards), sort_keys=True, default=str))
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            if json.load(f) != config:
+                raise Exception("%s holds shards of a different evaluation" % shard_dir)
+    else:
+        with open(config_path, 'w') as f:
+            json.dump(config, f, indent=2, sort_keys=True)
+
+    ctx = torch.multiprocessing.get_context('spawn')
+    procs = []
+    for shard in range(args.shards):
+        path = shard_file(shard_dir, shard, args.shards)
+        if os.path.exists(path):
+            if io is not None:
+                io.cprint('Shard %d/%d already finished, skipping' % (shard, args.shards))
+            continue
+        p = ctx.Process(target=_shard_main, args=(fn, shard, args, path))
+        p.start()
+        procs.append((shard, p))
+    failed = []
+    for shard, p in procs:
+        p.join()
+        if p.exitcode != 0:
+            failed.append(shard)
+    if len(failed) > 0:
+        raise Exception("Shards %s failed, rerun to resume them" % str(failed))
+    return merge_shards(shard_dir, args.shards)
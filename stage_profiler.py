@@ -0,0 +1,157 @@
+'''
+Description: named stage timers, counters and per-module hooks for the training loops
+Autor: Jiachen Sun
+Date: 2021-08-13 10:12:37
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-13 17:55:09
+'''
+import json
+import time
+import contextlib
+from collections import OrderedDict
+import torch
+
+
+class StageProfiler():
+    """
+    Accumulates wall time per named stage and per-epoch counters. Stages are
+    timed either as laps, lap(name) charging the time since the previous lap
+    to name, which needs no re-indentation of the loop body, or with
+    `with prof.stage(name):`. Every call returns immediately when disabled.
+
+    CUDA work is asynchronous, so with sync_cuda the device is synchronised
+    at every boundary to charge kernels to the stage that launched them.
+    """
+    def __init__(self, enabled=False, sync_cuda=False, max_events=1000000):
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.max_events = max_events
+        self.origin = time.time()
+        self.last = None
+        self.totals = OrderedDict()
+        self.counters = OrderedDict()
+        self.epochs = []
+        self.events = []
+        self.handles = []
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.time()
+
+    def _record(self, name, start, end, tid=0):
+        self.totals[name] = self.totals.get(name, 0.) + end - start
+        if len(self.events) < self.max_events:
+            self.events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': tid,
+                                'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6})
+
+    def reset_lap(self):
+        if not self.enabled:
+            return
+        self.last = self._now()
+
+    def lap(self, name):
+        if not self.enabled:
+            return
+        now = self._now()
+        if self.last is not None:
+            self._record(name, self.last, now)
+        self.last = now
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        start = self._now()
+        try:
+            yield
+        finally:
+            end = self._now()
+            self._record(name, start, end)
+            # keep the lap clock from charging this stage twice
+            self.last = end
+
+    def stage(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._stage(name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def attach(self, model):
+        """
+        Time forward and backward of every leaf module under module:<name>.
+        Backward spans from the gradient reaching the module output to the
+        gradient w.r.t. its input being ready.
+        """
+        if not self.enabled:
+            return
+        for name, module in model.named_modules():
+            if len(list(module.children())) > 0:
+                continue
+            self.handles.append(module.register_forward_pre_hook(self._forward_pre(name)))
+            self.handles.append(module.register_forward_hook(self._forward_post(name)))
+            if hasattr(module, 'register_full_backward_hook'):
+                self.handles.append(module.register_full_backward_hook(self._backward_post(name)))
+            else:
+                self.handles.append(module.register_backward_hook(self._backward_post(name)))
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _forward_pre(self, name):
+        def hook(module, inputs):
+            module._profile_start = self._now()
+        return hook
+
+    def _forward_post(self, name):
+        def hook(module, inputs, output):
+            self._record('module:%s:forward' % name, module._profile_start, self._now(), tid=1)
+            out = output[0] if isinstance(output, (tuple, list)) else output
+            if torch.is_tensor(out) and out.requires_grad:
+                def grad_hook(grad):
+                    module._profile_backward = self._now()
+                out.register_hook(grad_hook)
+        return hook
+
+    def _backward_post(self, name):
+        def hook(module, grad_input, grad_output):
+            start = getattr(module, '_profile_backward', None)
+            if start is not None:
+                self._record('module:%s:backward' % name, start, self._now(), tid=2)
+                module._profile_backward = None
+        return hook
+
+    def epoch_end(self, io, epoch):
+        """
+        Log this epoch's stage breakdown and counters through io, then reset them.
+        """
+        if not self.enabled:
+            return
+        stages = OrderedDict((k, v) for k, v in self.totals.items() if not k.startswith('module:'))
+        modules = OrderedDict((k, v) for k, v in self.totals.items() if k.startswith('module:'))
+        total = sum(stages.values())
+        io.cprint('Profile %d, total %.3fs :: ' % (epoch, total) + ', '.join(
+            ['%s %.3fs (%.1f%%)' % (k, v, 100. * v / max(total, 1e-12)) for k, v in stages.items()]))
+        if len(self.counters) > 0:
+            io.cprint('Profile %d, counters :: ' % epoch + ', '.join(['%s %d' % (k, v) for k, v in self.counters.items()]))
+        if len(modules) > 0:
+            top = sorted(modules.items(), key=lambda kv: -kv[1])[:10]
+            io.cprint('Profile %d, slowest modules :: ' % epoch + ', '.join(['%s %.3fs' % (k[7:], v) for k, v in top]))
+        self.epochs.append({'epoch': epoch, 'stages': dict(self.totals), 'counters': dict(self.counters)})
+        self.totals = OrderedDict()
+        self.counters = OrderedDict()
+
+    def export(self, prefix):
+        """
+        Write <prefix>_trace.json (chrome://tracing / Perfetto) and <prefix>_stages.json (per-epoch totals).
+        """
+        if not self.enabled:
+            return
+        with open(prefix + '_trace.json', 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        with open(prefix + '_stages.json', 'w') as f:
+            json.dump(self.epochs, f, indent=2)
@@ -0,0 +1,190 @@
+'''
+Description: running confusion matrices kept on the model's device, read back to the host only on demand
+Autor: Jiachen Sun
+Date: 2021-08-10 10:22:05
+LastEditors: Jiachen Sun
+LastEditTime: 2021-08-10 16:48:31
+'''
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+class ConfusionMatrix():
+    """
+    mat[i, j] counts samples of class i predicted as j. Updates are one bincount
+    on the device, nothing is synchronised until a metric is read. With
+    n_classes=None the size is taken from the first logits passed to add_logits.
+    """
+    def __init__(self, n_classes=None, device='cpu'):
+        self.n_classes = n_classes
+        self.device = device
+        self.mat = None
+        if n_classes is not None:
+            self._allocate(n_classes, device)
+
+    def _allocate(self, n_classes, device):
+        self.n_classes = n_classes
+        self.mat = torch.zeros(n_classes, n_classes, dtype=torch.long, device=device)
+
+    def add(self, preds, labels):
+        labels = labels.reshape(-1).long()
+        preds = preds.reshape(-1).long()
+        if self.mat is None:
+            raise Exception("n_classes is unknown, use add_logits or pass n_classes")
+        self.mat += torch.bincount(labels * self.n_classes + preds,
+                                   minlength=self.n_classes ** 2).view(self.n_classes, self.n_classes)
+
+    def add_logits(self, logits, labels):
+        if self.mat is None:
+            self._allocate(logits.size(1), logits.device)
+        self.add(logits.max(dim=1)[1], labels)
+
+    def merge(self, other):
+        """
+        Add another accumulator (or a raw matrix, e.g. loaded from a shard file).
+        """
+        mat = other.mat if isinstance(other, ConfusionMatrix) else other
+        if not torch.is_tensor(mat):
+            mat = torch.from_numpy(np.asarray(mat))
+        if self.mat is None:
+            self._allocate(mat.shape[0], self.device)
+        self.mat += mat.long().to(self.mat.device)
+        return self
+
+    def all_reduce(self):
+        # sum over every process of the default group
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.mat)
+        return self
+
+    def matrix(self):
+        return self.mat.cpu().numpy()
+
+    def count(self):
+        return int(self.mat.sum().item())
+
+    def accuracy(self):
+        mat = self.matrix()
+        return float(np.trace(mat)) / max(mat.sum(), 1)
+
+    def per_class_accuracy(self):
+        """
+        Recall of every class, nan for classes without samples.
+        """
+        mat = self.matrix()
+        support = mat.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.diag(mat) / support.astype(np.float64)
+
+    def balanced_accuracy(self):
+        # same as sklearn's balanced_accuracy_score: classes absent from the labels are left out
+        per_class = self.per_class_accuracy()
+        per_class = per_class[~np.isnan(per_class)]
+        return float(per_class.mean()) if per_class.size > 0 else 0.
+
+    def summary(self):
+        return self.accuracy(), self.balanced_accuracy()
+
+
+class RobustAccuracy():
+    """
+    One ConfusionMatrix per prediction source (e.g. 'clean', 'pgd', 'apgd') plus
+    'worst', where a sample only counts as correct if every attack passed to the
+    same update got it right.
+    """
+    def __init__(self, names, n_classes=None, device='cpu'):
+        self.names = list(names)
+        self.meters = {name: ConfusionMatrix(n_classes, device) for name in self.names + ['worst']}
+
+    def update(self, labels, **logits):
+        self.update_preds(labels, **{name: out.max(dim=1)[1] for name, out in logits.items()},
+                          n_classes=max(out.size(1) for out in logits.values()))
+
+    def update_preds(self, labels, n_classes=None, **preds):
+        """
+        Same as update, from predicted classes. n_classes sizes meters that
+        were created without it.
+        """
+        labels = labels.reshape(-1).long()
+        worst = None
+        for name in list(preds.keys()) + ['worst']:
+            if self.meters[name].mat is None:
+                if n_classes is None:
+                    raise Exception("n_classes is unknown, pass it to RobustAccuracy or update_preds")
+                self.meters[name]._allocate(n_classes, labels.device)
+        for name, pred in preds.items():
+            pred = pred.reshape(-1).long()
+            self.meters[name].add(pred, labels)
+            if name == 'clean':
+                continue
+            # keep the first wrong prediction, the confusion matrix needs an actual class
+            worst = pred if worst is None else torch.where(worst == labels, pred, worst)
+        if worst is not None:
+            self.meters['worst'].add(worst, labels)
+
+    def matrices(self):
+        """
+        name -> confusion matrix of every meter in use, e.g. for save_shard.
+        """
+        return {name: meter.matrix() for name, meter in self.meters.items() if meter.mat is not None}
+
+    def merge(self, other):
+        """
+        Add another RobustAccuracy, or a dict name -> matrix as returned by matrices().
+        """
+        mats = other.meters if isinstance(other, RobustAccuracy) else other
+        for name, meter in mats.items():
+            if not isinstance(meter, ConfusionMatrix) or meter.mat is not None:
+                self.meters[name].merge(meter)
+        return self
+
+    def all_reduce(self):
+        for meter in self.meters.values():
+            if meter.mat is not None:
+                meter.all_reduce()
+        return self
+
+    def __getitem__(self, name):
+        return self.meters[name]
+
+    def summary(self):
+        return {name: meter.summary() for name, meter in self.meters.items() if meter.mat is not None}
+
+
+# ShapeNetPart: parts per object category and the first global part id of each category
+seg_num = [4, 2, 2, 4, 4, 3, 3, 2, 4, 2, 6, 2, 3, 3, 3, 3]
+index_start = [0, 4, 6, 8, 12, 16, 19, 22, 24, 28, 30, 36, 38, 41, 44, 47]
+
+def calculate_shape_IoU(pred_np, seg_np, label, class_choice):
+    """
+    Mean part IoU of every shape, from one bincount over (shape, pred, gt) codes.
+    Inputs are numpy arrays or tensors (computed on the tensor's device). Without
+    class_choice a shape's parts are its category's global part ids, with it the
+    parts are 0..seg_num[label[0]]-1. A part whose union is empty counts as IoU 1.
+    """
+    device = pred_np.device if torch.is_tensor(pred_np) else 'cpu'
+    pred = torch.as_tensor(pred_np, device=device).long().reshape(pred_np.shape[0], -1)
+    seg = torch.as_tensor(seg_np, device=device).long().reshape(pred.shape)
+    label = torch.as_tensor(label, device=device).long().reshape(-1)
+    n_shapes = pred.shape[0]
+
+    num = torch.tensor(seg_num, device=device)
+    if not class_choice:
+        start = torch.tensor(index_start, device=device)[label]
+        num = num[label]
+    else:
+        start = torch.zeros_like(label)
+        num = num[label[0]].expand_as(label)
+    n_parts = max(int(torch.max(pred.max(), seg.max()).item()) + 1, int((start + num).max().item()))
+
+    shape_idx = torch.arange(n_shapes, device=device)[:, None]
+    codes = (shape_idx * n_parts + pred) * n_parts + seg
+    hist = torch.bincount(codes.reshape(-1), minlength=n_shapes * n_parts ** 2).view(n_shapes, n_parts, n_parts)
+    inter = torch.diagonal(hist, dim1=1, dim2=2)
+    union = hist.sum(dim=2) + hist.sum(dim=1) - inter
+    iou = torch.where(union == 0, torch.ones_like(union, dtype=torch.float64), inter.double() / union.clamp(min=1).double())
+
+    parts = torch.arange(n_parts, device=device)[None]
+    mask = (parts >= start[:, None]) & (parts < (start + num)[:, None])
+    return ((iou * mask).sum(dim=1) / mask.sum(dim=1)).cpu().numpy()
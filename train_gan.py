@@ -22,11 +22,12 @@ from torch.utils.data import DataLoader
 import sys
 sys.path.append("./emd/")
 import emd_module
-from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss
+from util import cal_loss, IOStream, cross_entropy_with_probs,trades_loss, MixedPrecision, keep_norm_fp32
 import sklearn.metrics as metrics
 import attack
 import time
 import model_combine
+from stage_profiler import StageProfiler
 # EPS=0.05
 # ALPHA=0.01
 # TRAIN_ITER=7
@@ -177,6 +178,13 @@ def train(args, io):
     best_model = None
     best_epoch = 0
 
+    mp = MixedPrecision(args.amp_train, device, gan)
+    if mp.enabled:
+        keep_norm_fp32(model)
+    prof = StageProfiler(args.profile, sync_cuda=args.profile_sync)
+    if args.profile_modules:
+        prof.attach(gan)
+        prof.attach(model)
 
     for epoch in range(args.epochs):
         ####################
@@ -202,24 +210,33 @@ def train(args, io):
 
         # test(args,io,model=model, dataloader = test_loader)
 
+        prof.reset_lap()
         for data, label, _, _ in train_loader:
+            prof.lap('data')
             # print(rotated_data.shape)
             # print(rotation_label.shape)
             data, label = data.to(device).float(), label.to(device).long().squeeze()
             batch_size, N, C = data.size()
             data = data.permute(0, 2, 1)
+            prof.lap('h2d')
+            prof.count('samples', batch_size)
             opt.zero_grad()
-            perturbation = gan(data)
+            perturbation = mp.forward(gan,data)
             data += perturbation
-            logits,trans,trans_feat = model(data)
+            prof.lap('generator')
+            logits,trans,trans_feat = mp.forward(model,data)
             loss = -criterion(logits, trans_feat, label)
-            loss.backward()
-            opt.step()
+            prof.lap('forward')
+            mp.backward(loss)
+            prof.lap('backward')
+            mp.step(opt)
+            prof.lap('optimizer')
             preds = logits.max(dim=1)[1]
             count += batch_size
             train_loss += loss.item() * batch_size
             train_true.append(label.cpu().numpy())
             train_pred.append(preds.detach().cpu().numpy())
+            prof.lap('metrics')
 
         train_true = np.concatenate(train_true)
         train_pred = np.concatenate(train_pred)
@@ -236,8 +253,10 @@ def train(args, io):
             scheduler.step(train_loss*1.0/count)
         else:
             scheduler.step()
+        prof.lap('epoch_summary')
         
         acc = test(args,io,model=model, gan=gan, dataloader = test_loader)
+        prof.lap('eval')
 
         if epoch % 10 == 0 or epoch == args.epochs-1:
             # if epoch == args.epochs-1:
@@ -254,6 +273,9 @@ def train(args, io):
             #     best_epoch = epoch
             #     best_test_acc_adv = acc_adv
             torch.save(gan.state_dict(), args.pre_path+'finetune_checkpoints/%s/models/gan_epoch%d.t7' % (args.exp_name,epoch))
+        prof.lap('checkpoint')
+        prof.epoch_end(io, epoch)
+    prof.export(args.pre_path+'finetune_checkpoints/%s/profile' % args.exp_name)
     return model
 
 def test(args, io,model=None, gan=None, dataloader=None):
@@ -391,6 +413,14 @@ if __name__ == "__main__":
                         help="Which lr scheduler to use")
     parser.add_argument('--attack',type=str,default='pgd',
                         help="Which attack to use")
+    parser.add_argument('--amp_train', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                        help='Mixed-precision training (autocast, fp32 BatchNorm, GradScaler for fp16; bf16 on CPU)')
+    parser.add_argument('--profile',type=bool,default=False,
+                        help="Log a per-epoch breakdown of data loading, host-to-device copy, attack, forward, backward and eval time")
+    parser.add_argument('--profile_sync',type=bool,default=False,
+                        help="Synchronise CUDA at every stage boundary so kernels are charged to the right stage")
+    parser.add_argument('--profile_modules',type=bool,default=False,
+                        help="Also time forward and backward of every leaf module (implies extra overhead)")
     args = parser.parse_args()
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
@@ -8,6 +8,8 @@ LastEditTime: 2021-04-14 17:45:04
 from __future__ import print_function
 import os
 import argparse
+import json
+from queue import Empty
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -25,6 +27,8 @@ import sklearn.metrics as metrics
 import attack
 import time
 import model_combine
+from adv_cache import AdvCache, attack_config, data_config
+from eval_adv import generate_adv
 # EPS=0.05
 # ALPHA=0.01
 # TRAIN_ITER=7
@@ -95,6 +99,7 @@ def adversarial(args,io,model=None, dataloader=None):
     model2 = model2.eval()
     model3 = model3.eval()
 
+    apgd = None
     if args.attack == 'apgd':
         apgd = attack.APGDAttack(model1,n_iter=args.test_iter,eps=args.eps,seed=args.seed)
     elif args.attack == 'apgd_margin':
@@ -108,29 +113,19 @@ def adversarial(args,io,model=None, dataloader=None):
     total = args.total
     counter = 0
     
-    for data, label,_,_ in test_loader:
+    cache = AdvCache(args.adv_cache, args.adv_cache_gb) if args.adv_cache != '' else None
+    for batch_idx, (data, label,_,_) in enumerate(test_loader):
         data, label = data.to(device).float(), label.to(device).long().squeeze()
         data = data.permute(0, 2, 1)
         batch_size = data.size()[0]
 
-        if args.attack == 'pgd':
-            adv_data = attack.pgd_attack(model1,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        elif args.attack == 'pgd_margin':
-            adv_data = attack.pgd_attack_margin(model1,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        elif args.attack == 'nattack':
-            adv_data = attack.nattack(model1,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,variance=0.1,samples=args.samples)
-        elif args.attack == 'spsa':
-            adv_data = attack.spsa(model1,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,samples=args.samples)
-        elif args.attack == 'nes':
-            adv_data = attack.nes(model1,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,variance=0.001,samples=args.samples)
-        elif args.attack == 'evolution':
-            adv_data = attack.evolution(model1,data,label,eps=args.eps,iters=args.test_iter,variance=0.005,samples=args.samples,k=args.samples // 4)
-        elif args.attack == 'apgd' or args.attack == 'apgd_margin':
-            _,adv_data = apgd.perturb(data,label)
-        elif args.attack == 'mim':
-            adv_data = attack.mim(model1,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
-        elif args.attack == 'mim_margin':
-            adv_data = attack.mim_margin(model1,data,label,eps=args.eps,alpha=args.alpha,iters=args.test_iter,repeat=1,mixup=False)
+        if cache is not None:
+            # seed per batch so a cached entry does not depend on which batches came before it
+            torch.manual_seed(args.seed * 100003 + batch_idx)
+            adv_data = cache.fetch(model1, attack_config(args), data_config(args, batch_idx),
+                                   lambda: generate_adv(args, model1, apgd, data, label), device)
+        else:
+            adv_data = generate_adv(args, model1, apgd, data, label)
             
         logits,_,_ = model1(adv_data)
         logits2,_,_ = model2(adv_data)
@@ -158,6 +153,161 @@ def adversarial(args,io,model=None, dataloader=None):
     io.cprint(args.attack + outstr)
     return 
 
+def output_channels(dataset):
+    if dataset == 'modelnet40':
+        return 40
+    elif dataset == 'modelnet10':
+        return 10
+    elif dataset == 'scanobjectnn':
+        return 15
+    elif dataset == 'shapenet':
+        return 57
+    raise Exception("Not implemented")
+
+def build_model(arch, args, device):
+    output_channel = output_channels(args.dataset)
+    if arch == 'pointnet':
+        model = PointNet(args,output_channels=output_channel).to(device)
+    elif arch == 'dgcnn':
+        model = DGCNN(args,output_channels=output_channel).to(device)
+    elif arch == 'pointnet_simple':
+        model = PointNet_Simple(args,output_channels=output_channel).to(device)
+    elif arch == 'pct':
+        model = Pct(args,output_channels=output_channel).to(device)
+    elif arch == 'deepsym':
+        model = DeepSym(args).to(device)
+    else:
+        raise Exception("Not implemented")
+    if device.type == 'cuda' and device.index is not None:
+        # a worker pinned to one GPU, DataParallel would otherwise expect the model on cuda:0
+        return nn.DataParallel(model, device_ids=[device.index])
+    return nn.DataParallel(model)
+
+def parse_checkpoint(spec, args):
+    """
+    'arch:path/to/model.t7' or just a path, which then uses --model
+    """
+    if ':' in spec and spec.split(':', 1)[0] in ['pointnet', 'dgcnn', 'pointnet_simple', 'pct', 'deepsym']:
+        return spec.split(':', 1)
+    return args.model, spec
+
+def load_checkpoint(spec, args, device):
+    arch, path = parse_checkpoint(spec, args)
+    model = build_model(arch, args, device)
+    model.load_state_dict(torch.load(path, map_location=device))
+    return model.eval()
+
+def generate_set(args, io):
+    """
+    Stage one: attack the source checkpoint once and write the adversarial set
+    to args.adv_set as one adv_/label_ .npy pair per batch plus meta.json.
+    """
+    device = torch.device("cuda" if args.cuda else "cpu")
+    test_loader = DataLoader(PCData(name=args.dataset,partition='test', num_points=args.num_points), num_workers=8,
+                             batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+    source = args.source if args.source != '' else args.model_path1 + '/model_epoch' + str(args.epochs) + '.t7'
+    model = load_checkpoint(source, args, device)
+    apgd = None
+    if args.attack == 'apgd':
+        apgd = attack.APGDAttack(model,n_iter=args.test_iter,eps=args.eps,seed=args.seed,device=device)
+    elif args.attack == 'apgd_margin':
+        apgd = attack.APGDAttack(model,n_iter=args.test_iter,loss='ce_margin',eps=args.eps,seed=args.seed,device=device)
+    if not os.path.exists(args.adv_set):
+        os.makedirs(args.adv_set)
+
+    cache = AdvCache(args.adv_cache, args.adv_cache_gb) if args.adv_cache != '' else None
+    counter = 0
+    n_batches = 0
+    for batch_idx, (data, label,_,_) in enumerate(test_loader):
+        data, label = data.to(device).float(), label.to(device).long().squeeze(-1)
+        data = data.permute(0, 2, 1)
+        if cache is not None:
+            torch.manual_seed(args.seed * 100003 + batch_idx)
+            adv_data = cache.fetch(model, attack_config(args), data_config(args, batch_idx),
+                                   lambda: generate_adv(args, model, apgd, data, label), device)
+        else:
+            adv_data = generate_adv(args, model, apgd, data, label)
+        np.save(os.path.join(args.adv_set, 'adv_%05d.npy' % batch_idx), adv_data.detach().cpu().numpy())
+        np.save(os.path.join(args.adv_set, 'label_%05d.npy' % batch_idx), label.cpu().numpy())
+        counter += data.size(0)
+        n_batches += 1
+        if counter >= args.total:
+            break
+    meta = {'source': source, 'attack': attack_config(args), 'n_batches': n_batches, 'n_samples': counter}
+    with open(os.path.join(args.adv_set, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    io.cprint('Generated %d adversarial samples from %s into %s' % (counter, source, args.adv_set))
+
+def evaluate_worker(rank, args, jobs, queue):
+    """
+    Stage two worker: for every target checkpoint in jobs, stream every
+    adversarial set from disk and report (set, target, correct, total).
+    """
+    if args.cuda:
+        device = torch.device('cuda:%d' % (rank % torch.cuda.device_count()))
+    else:
+        device = torch.device('cpu')
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+    for target in jobs:
+        model = load_checkpoint(target, args, device)
+        for adv_set in args.adv_sets:
+            with open(os.path.join(adv_set, 'meta.json')) as f:
+                n_batches = json.load(f)['n_batches']
+            correct = 0
+            count = 0
+            with torch.no_grad():
+                for i in range(n_batches):
+                    adv_data = torch.from_numpy(np.array(np.load(os.path.join(adv_set, 'adv_%05d.npy' % i), mmap_mode='r'))).to(device)
+                    label = torch.from_numpy(np.load(os.path.join(adv_set, 'label_%05d.npy' % i))).to(device)
+                    logits,_,_ = model(adv_data)
+                    correct += (logits.max(dim=1)[1] == label).sum().item()
+                    count += label.shape[0]
+            queue.put((adv_set, target, correct, count))
+        del model
+
+def evaluate_sets(args, io):
+    """
+    Stage two: robust accuracy of every target on every adversarial set,
+    targets split round-robin over args.workers processes.
+    """
+    workers = max(1, min(args.workers, len(args.targets)))
+    args.workers = workers
+    ctx = torch.multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    procs = []
+    for rank in range(workers):
+        p = ctx.Process(target=evaluate_worker, args=(rank, args, args.targets[rank::workers], queue))
+        p.start()
+        procs.append(p)
+    results = {}
+    while len(results) < len(args.targets) * len(args.adv_sets):
+        try:
+            adv_set, target, correct, count = queue.get(timeout=10)
+        except Empty:
+            # a worker that died (bad checkpoint, missing meta.json, device error) never reports
+            failed = [rank for rank, p in enumerate(procs) if p.exitcode is not None and p.exitcode != 0]
+            if len(failed) > 0 or all(not p.is_alive() for p in procs):
+                for p in procs:
+                    if p.is_alive():
+                        p.terminate()
+                raise Exception("Transfer evaluation workers %s failed before reporting every result" % str(failed))
+            continue
+        results[(adv_set, target)] = correct / float(max(count, 1))
+    for p in procs:
+        p.join()
+
+    io.cprint('Transfer matrix (robust accuracy, rows: adversarial sets, columns: targets)')
+    for j, target in enumerate(args.targets):
+        io.cprint('  [%d] %s' % (j, target))
+    io.cprint('%-40s' % '' + ''.join(['%10s' % ('[%d]' % j) for j in range(len(args.targets))]))
+    for adv_set in args.adv_sets:
+        io.cprint('%-40s' % adv_set[-40:] + ''.join(['%10.4f' % results[(adv_set, t)] for t in args.targets]))
+    report = {'targets': args.targets, 'adv_sets': args.adv_sets,
+              'acc': [[results[(a, t)] for t in args.targets] for a in args.adv_sets]}
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
 if __name__ == "__main__":
     # Training settings
     parser = argparse.ArgumentParser(description='Point Cloud Recognition')
@@ -211,6 +361,24 @@ if __name__ == "__main__":
                         help='Attack method')
     parser.add_argument('--samples', type=int, default=64, 
                         help='black box samples')
+    parser.add_argument('--adv_cache', type=str, default='',
+                        help='Directory of the adversarial example cache, disabled if empty')
+    parser.add_argument('--adv_cache_gb', type=float, default=20.,
+                        help='Size limit of the adversarial example cache')
+    parser.add_argument('--stage', type=str, default='all', choices=['all', 'generate', 'evaluate'],
+                        help='all: attack model_path1 and evaluate model_path1-3 per batch; generate/evaluate: two-stage pipeline')
+    parser.add_argument('--source', type=str, default='',
+                        help='[arch:]checkpoint to attack in the generate stage, defaults to model_path1')
+    parser.add_argument('--adv_set', type=str, default='',
+                        help='Directory the generate stage writes the adversarial set to')
+    parser.add_argument('--adv_sets', type=str, nargs='+', default=[],
+                        help='Adversarial set directories to evaluate')
+    parser.add_argument('--targets', type=str, nargs='+', default=[],
+                        help='[arch:]checkpoints to evaluate the adversarial sets on')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Evaluation worker processes')
+    parser.add_argument('--report', type=str, default='transfer_matrix.json',
+                        help='Where the evaluate stage writes the transfer matrix')
 
     args = parser.parse_args()
 
@@ -229,6 +397,13 @@ if __name__ == "__main__":
     else:
         io.cprint('Using CPU')
 
+    if args.stage == 'generate':
+        generate_set(args, io)
+        sys.exit(0)
+    elif args.stage == 'evaluate':
+        evaluate_sets(args, io)
+        sys.exit(0)
+
     adversarial(args=args,io=io)
     args.model_path1, args.model_path2, args.model_path3 = args.model_path2, args.model_path1, args.model_path3 
     adversarial(args=args,io=io)
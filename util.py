@@ -9,6 +9,7 @@ LastEditTime: 2021-04-05 17:36:50
 '''
 
 
+import contextlib
 import numpy as np
 import torch
 np.random.seed(666)
@@ -111,7 +112,7 @@ def cross_entropy_with_probs(
         y_loss = F.cross_entropy(input, target_temp, reduction="none")
         if weight is not None:
             y_loss = y_loss * weight[y]
-        cum_losses += target[:, y].float().cuda() * y_loss
+        cum_losses += target[:, y].float().to(input.device) * y_loss
 
     if reduction == "none":
         return cum_losses
@@ -131,6 +132,142 @@ class CrossEntropyLoss_with_prob(torch.nn.Module):
     def forward(self, input, target):
         return cross_entropy_with_probs(input, target)
 
+def mixup_labels(label_main, label_minor, mixrates, num_classes=40):
+    """
+    Soft mixup targets: 1 - rate on label_main and rate on label_minor for every
+    sample, accumulated with scatter_add so a pair of equal labels sums to 1.
+    """
+    rates = torch.as_tensor(mixrates, dtype=torch.float, device=label_main.device).view(-1, 1)
+    target = torch.zeros(label_main.size(0), num_classes, device=label_main.device)
+    target.scatter_add_(1, label_main.view(-1, 1).long(), 1 - rates)
+    target.scatter_add_(1, label_minor.view(-1, 1).long(), rates)
+    return target
+
+def cutout(data, k=100, centers=None):
+    """
+    Zero the k nearest neighbours (center included) of one center per cloud.
+    data: [B, N, C]; centers: [B] point indices, drawn uniformly if None.
+    """
+    B, N, _ = data.size()
+    if centers is None:
+        centers = torch.randint(N, (B,), device=data.device)
+    picked = data[torch.arange(B, device=data.device), centers.to(data.device)].unsqueeze(1)
+    dist = torch.sum((data - picked) ** 2, dim=2)
+    idx = dist.topk(k=min(k, N), largest=False, dim=1)[1]
+    keep = torch.ones(B, N, dtype=data.dtype, device=data.device).scatter_(1, idx, 0)
+    return data * keep.unsqueeze(2)
+
+
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+AMP_LOSS_SCALE = 2.0 ** 10
+
+def amp_autocast(amp, device):
+    ''' Autocast region for amp in [None, 'fp32', 'bf16', 'fp16'] on the given device. '''
+    if amp is None or amp == 'fp32':
+        return contextlib.nullcontext()
+    if amp not in AMP_DTYPES:
+        raise ValueError("amp must be one of [None, 'fp32', 'bf16', 'fp16']")
+    if not hasattr(torch, 'autocast'):
+        raise RuntimeError('mixed precision requires torch.autocast (torch >= 1.10)')
+    device_type = torch.device(device).type
+    if device_type == 'cpu' and amp == 'fp16':
+        raise ValueError('fp16 autocast is not supported on CPU, use bf16')
+    return torch.autocast(device_type=device_type, dtype=AMP_DTYPES[amp])
+
+def amp_loss_scale(amp):
+    ''' Static loss scale for gradients w.r.t. the input, only fp16 can underflow. '''
+    return AMP_LOSS_SCALE if amp == 'fp16' else 1.0
+
+def amp_input_grad(grad):
+    ''' Bring an (optionally scaled) input gradient back to fp32 for sign steps.
+    Entries that overflowed are zeroed, so they take no step this iteration. '''
+    grad = grad.float()
+    return torch.where(torch.isfinite(grad), grad, torch.zeros_like(grad))
+
+
+class FP32BatchNorm1d(nn.BatchNorm1d):
+    ''' BatchNorm1d that normalises (and keeps its running statistics) in fp32 inside autocast regions. '''
+    def forward(self, x):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return super().forward(x.float())
+
+class FP32BatchNorm2d(nn.BatchNorm2d):
+    ''' BatchNorm2d that normalises (and keeps its running statistics) in fp32 inside autocast regions. '''
+    def forward(self, x):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return super().forward(x.float())
+
+def keep_norm_fp32(model):
+    ''' Switch the BatchNorm layers of model (including the two inside every Dual_BN) to the fp32
+    versions in place. Parameters and state dict keys are unchanged. '''
+    for m in model.modules():
+        if type(m) == nn.BatchNorm1d:
+            m.__class__ = FP32BatchNorm1d
+        elif type(m) == nn.BatchNorm2d:
+            m.__class__ = FP32BatchNorm2d
+    return model
+
+
+class MixedPrecision():
+    '''
+    Opt-in mixed-precision training step shared by the training scripts, for amp in
+    [None, 'fp32', 'bf16', 'fp16'] (bf16 also on CPU). Weights stay fp32, forward passes
+    run under autocast with fp32 BatchNorm and return fp32 outputs, so losses are computed
+    in fp32. fp16 adds a GradScaler. With amp None or 'fp32' every call is the plain fp32 op.
+
+        logits,_,trans_feat = mp.forward(model, data)
+        mp.backward(criterion(logits, trans_feat, label))
+        mp.step(opt)
+    '''
+    def __init__(self, amp, device, model=None):
+        self.amp = None if amp == 'fp32' else amp
+        self.device = torch.device(device)
+        self.scaler = None
+        if self.amp is not None:
+            # fails early for fp16 on CPU or a torch without autocast
+            with amp_autocast(self.amp, self.device):
+                pass
+            if model is not None:
+                keep_norm_fp32(model)
+        if self.amp == 'fp16':
+            self.scaler = torch.cuda.amp.GradScaler()
+
+    @property
+    def enabled(self):
+        return self.amp is not None
+
+    def autocast(self):
+        return amp_autocast(self.amp, self.device)
+
+    def forward(self, model, *inputs, **kwargs):
+        if self.amp is None:
+            return model(*inputs, **kwargs)
+        with self.autocast():
+            outputs = model(*inputs, **kwargs)
+        if torch.is_tensor(outputs):
+            return outputs.float()
+        return type(outputs)(o.float() if torch.is_tensor(o) and o.is_floating_point() else o for o in outputs)
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def step(self, opt):
+        ''' Optimizer step; with fp16, steps whose gradients overflowed are skipped and the scale adapts. '''
+        if self.scaler is None:
+            opt.step()
+            return
+        self.scaler.step(opt)
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict() if self.scaler is not None else {}
+
+    def load_state_dict(self, state):
+        if self.scaler is not None and len(state) > 0:
+            self.scaler.load_state_dict(state)
+
 
 class IOStream():
     def __init__(self, path):
@@ -145,6 +282,60 @@ class IOStream():
         self.f.close()
 
 
+class split_batchnorm():
+    '''
+    Inside this context every BatchNorm of model in train mode normalises the
+    `parts` equal slices of its batch separately, in order, so one forward of
+    torch.cat([x_1, ..., x_parts]) gives each x_i the batch statistics (and the
+    running statistic updates) of a forward on its own. Running statistics of
+    the slices listed in replay are updated once more afterwards, to reproduce
+    a sequence of separate forwards that revisits them. Layers that fold other
+    dimensions into the batch (e.g. Local_op) keep it sample-major, so slicing
+    dim 0 still separates the inputs.
+    '''
+    def __init__(self, model, parts=2, replay=()):
+        self.model = model
+        self.parts = parts
+        self.replay = replay
+        self.patched = []
+
+    def _forward(self, bn):
+        def forward(x):
+            if not bn.training or x.size(0) % self.parts != 0:
+                return type(bn).forward(bn, x)
+            chunks = x.chunk(self.parts, 0)
+            out = torch.cat([type(bn).forward(bn, c) for c in chunks], 0)
+            if bn.track_running_stats:
+                with torch.no_grad():
+                    for i in self.replay:
+                        type(bn).forward(bn, chunks[i].detach())
+            return out
+        return forward
+
+    def __enter__(self):
+        for m in self.model.modules():
+            if isinstance(m, nn.modules.batchnorm._BatchNorm):
+                m.forward = self._forward(m)
+                self.patched.append(m)
+        return self.model
+
+    def __exit__(self, *exc):
+        for m in self.patched:
+            del m.forward
+        self.patched = []
+        return False
+
+def _fusable(model):
+    # DataParallel over several GPUs scatters the concatenated batch across devices,
+    # and a compiled forward (compile_model) would not see the patched BatchNorm
+    if isinstance(model, nn.DataParallel):
+        if len(model.device_ids) > 1:
+            return False
+        model = model.module
+    elif isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+    return 'forward' not in model.__dict__
+
 def trades_loss(model,
                 x_natural,
                 y,
@@ -153,21 +344,41 @@ def trades_loss(model,
                 epsilon=0.05,
                 perturb_steps=7,
                 beta=1.0,
-                distance='l_inf'):
+                distance='l_inf',
+                amp=None,
+                train_amp=None,
+                fused=True,
+                return_adv=False):
+    '''
+    TRADES loss. The clean logits of the (eval mode) inner maximisation are
+    computed once and their softmax is reused by every step. With fused the
+    final natural and adversarial forwards run as one concatenated batch under
+    split_batchnorm, so BatchNorm sees the same per-input statistics as the
+    separate forwards; fused=False keeps the three separate forwards.
+    With return_adv the adversarial batch of the inner maximisation is
+    returned as well, as (loss, x_adv).
+    '''
     # define KL-loss
     criterion_kl = nn.KLDivLoss(size_average=False)
     model.eval()
     batch_size = len(x_natural)
+    # the clean prediction does not depend on the perturbation
+    with torch.no_grad():
+        with amp_autocast(amp, x_natural.device):
+            logits_natural = model(x_natural)[0]
+        prob_natural = F.softmax(logits_natural.float(), dim=1)
     # generate adversarial example
-    x_adv = x_natural.detach() + 0.001 * torch.randn(x_natural.shape).cuda().detach()
+    x_adv = x_natural.detach() + 0.001 * torch.randn(x_natural.shape).to(x_natural.device).detach()
     if distance == 'l_inf':
         for _ in range(perturb_steps):
             x_adv.requires_grad_()
             with torch.enable_grad():
-                loss_kl = criterion_kl(F.log_softmax(model(x_adv)[0], dim=1),
-                                       F.softmax(model(x_natural)[0], dim=1))
-            grad = torch.autograd.grad(loss_kl, [x_adv])[0]
-            x_adv = x_adv.detach() + step_size * torch.sign(grad.detach())
+                with amp_autocast(amp, x_natural.device):
+                    logits_adv = model(x_adv)[0]
+                loss_kl = criterion_kl(F.log_softmax(logits_adv.float(), dim=1), prob_natural)
+            grad = torch.autograd.grad(loss_kl * amp_loss_scale(amp), [x_adv])[0]
+            # the sign step itself stays in fp32
+            x_adv = x_adv.detach() + step_size * torch.sign(amp_input_grad(grad.detach()))
             x_adv = torch.min(torch.max(x_adv, x_natural - epsilon), x_natural + epsilon)
             # x_adv = torch.clamp(x_adv, 0.0, 1.0)
     elif distance == 'l_2':
@@ -183,8 +394,7 @@ def trades_loss(model,
             # optimize
             optimizer_delta.zero_grad()
             with torch.enable_grad():
-                loss = (-1) * criterion_kl(F.log_softmax(model(adv)[0], dim=1),
-                                           F.softmax(model(x_natural)[0], dim=1))
+                loss = (-1) * criterion_kl(F.log_softmax(model(adv)[0], dim=1), prob_natural)
             loss.backward()
             # renorming gradient
             grad_norms = delta.grad.view(batch_size, -1).norm(p=2, dim=1)
@@ -207,11 +417,22 @@ def trades_loss(model,
     # zero gradient
     optimizer.zero_grad()
     # calculate robust loss
-    logits = model(x_natural)[0]
-    loss_natural = F.cross_entropy(logits, y)
-    loss_robust = (1.0 / batch_size) * criterion_kl(F.log_softmax(model(x_adv)[0], dim=1),
-                                                    F.softmax(model(x_natural)[0], dim=1))
+    if fused and _fusable(model):
+        # natural, adversarial, natural again: the running statistics end as after the three separate forwards
+        with split_batchnorm(model, parts=2, replay=(0,)), amp_autocast(train_amp, x_natural.device):
+            logits, logits_adv = model(torch.cat([x_natural, x_adv.detach()], 0))[0].chunk(2, 0)
+        logits_natural = logits
+    else:
+        with amp_autocast(train_amp, x_natural.device):
+            logits = model(x_natural)[0]
+            logits_adv = model(x_adv)[0]
+            logits_natural = model(x_natural)[0]
+    loss_natural = F.cross_entropy(logits.float(), y)
+    loss_robust = (1.0 / batch_size) * criterion_kl(F.log_softmax(logits_adv.float(), dim=1),
+                                                    F.softmax(logits_natural.float(), dim=1))
     loss = loss_natural + beta * loss_robust
+    if return_adv:
+        return loss, x_adv.detach()
     return loss
 
 def square_distance(src, dst):